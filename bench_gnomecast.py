@@ -0,0 +1,326 @@
+"""
+Benchmarks for gnomecast's startup, probe, transcode, serve, playback and subtitle paths, on media generated with ffmpeg's
+lavfi sources (so it's the same on every machine, and no network or Chromecast is needed).  Exits 1 if startup is over
+STARTUP_BUDGET.
+
+$ python3 bench_gnomecast.py [--output results.json] [--compare old_results.json] [--duration <seconds>]
+"""
+
+import contextlib, http.client, json, os, platform, random, socket, subprocess, sys, tempfile, threading, time
+
+import fakecast
+import gnomecast
+
+# name: (container, ffmpeg encoding args); variants whose encoders this ffmpeg lacks are skipped
+MEDIA = {
+    'mp4_h264_aac': ('mp4', ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac']),
+    'mkv_h264_ac3_51': ('mkv', ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'ac3', '-ac', '6']),
+    'mkv_hevc_opus': ('mkv', ['-c:v', 'libx265', '-pix_fmt', 'yuv420p', '-c:a', 'libopus']),
+    'webm_vp9_opus': ('webm', ['-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-c:a', 'libopus']),
+    'avi_mpeg4_mp3': ('avi', ['-c:v', 'mpeg4', '-c:a', 'libmp3lame']),
+}
+
+# seconds from process start; going over these fails the run
+STARTUP_BUDGET = {
+    'import_seconds': 0.5,  # `import gnomecast`, which mustn't pull in GTK, pychromecast, bottle or pycaption
+    'first_draw_seconds': 2.0,  # launching the GUI, to the window's first draw (only measured given a display)
+}
+
+
+def encoders():
+    output = subprocess.check_output(['ffmpeg', '-v', 'error', '-encoders']).decode()
+    return {line.split()[1] for line in output.split('\n')[1:] if len(line.split()) > 1}
+
+
+def make_media(dir, duration=30, size='1280x720', rate=30):
+    """ Writes each MEDIA variant of duration seconds of testsrc + sine into dir, returning {name: fn} """
+    available = encoders()
+    media = {}
+    for name, (container, args) in sorted(MEDIA.items()):
+        codecs = [args[i + 1] for i, arg in enumerate(args) if arg in ('-c:v', '-c:a')]
+        if not all(codec in available for codec in codecs):
+            print('skipping', name, '(ffmpeg has no %s)' % ', '.join(c for c in codecs if c not in available))
+            continue
+        fn = os.path.join(dir, '%s.%s' % (name, container))
+        subprocess.check_call(
+            ['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=%i:size=%s:rate=%i' % (
+                duration, size, rate), '-f', 'lavfi', '-i', 'sine=frequency=440:duration=%i' % duration] + args +
+            ['-shortest', fn])
+        media[name] = fn
+    return media
+
+
+def make_srt(fn, cues=5000):
+    def timestamp(seconds, ms):
+        return '%02i:%02i:%02i,%03i' % (seconds // 3600, seconds // 60 % 60, seconds % 60, ms)
+
+    with open(fn, 'w') as f:
+        for i in range(cues):
+            f.write('%i\n%s --> %s\n<i>Line %i</i> of the subtitles\n\n' % (
+                i + 1, timestamp(i * 2, 0), timestamp(i * 2 + 1, 500), i))
+
+
+@contextlib.contextmanager
+def fresh_cache():
+    """ Points gnomecast's caches at an empty directory, so nothing comes from earlier runs """
+    old = os.environ.get('XDG_CACHE_HOME')
+    with tempfile.TemporaryDirectory() as cache_home:
+        os.environ['XDG_CACHE_HOME'] = cache_home
+        try:
+            yield cache_home
+        finally:
+            if old is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = old
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+
+def bench_startup(repeat=5):
+    """ Time from process start to `import gnomecast` done and, given a display, to the GUI's first window draw """
+    imports, draws = [], []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', 'import json, gnomecast; '
+                                                                'print(json.dumps(gnomecast.STARTUP.report()))'])
+        imports.append(json.loads(output.decode().strip().split('\n')[-1])['total'])
+        if os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'):
+            output = subprocess.check_output([sys.executable, gnomecast.__file__, '--startup-report'], timeout=60)
+            for line in output.decode().split('\n'):
+                if line.startswith('startup report:'):
+                    draws.append(json.loads(line.split(':', 1)[1])['total'])
+    return {'import_seconds': percentile(imports, 50), 'first_draw_seconds': percentile(draws, 50)}
+
+
+def over_budget(startup):
+    """ Prints and returns the startup times over STARTUP_BUDGET """
+    over = {name: seconds for name, seconds in startup.items()
+            if seconds is not None and seconds > STARTUP_BUDGET.get(name, float('inf'))}
+    for name, seconds in sorted(over.items()):
+        print('STARTUP REGRESSION: %s took %.3fs, the budget is %.3fs' % (name, seconds, STARTUP_BUDGET[name]))
+    return over
+
+
+def bench_probe(media, repeat=5):
+    results = {}
+    for name, fn in media.items():
+        cold, warm = [], []
+        for i in range(repeat):
+            with fresh_cache():
+                for times in (cold, warm):  # the second parse is served from the metadata cache
+                    start = time.time()
+                    fmd = gnomecast.FileMetadata(fn)
+                    while not fmd.ready:
+                        time.sleep(0.001)
+                    times.append(time.time() - start)
+        results[name] = {'cold_seconds': percentile(cold, 50), 'warm_seconds': percentile(warm, 50)}
+    return results
+
+
+def transcode(fn, cast=None, **kwargs):
+    fmd = gnomecast.FileMetadata(fn)
+    fmd.wait()
+    done = threading.Event()
+    transcoder = gnomecast.Transcoder(cast or fakecast.FakeChromecast(), fmd, fmd.video_streams[0],
+                                      fmd.audio_streams[0] if fmd.audio_streams else None,
+                                      lambda did_transcode=None: done.set(), lambda msg: done.set(), **kwargs)
+    return fmd, transcoder, done
+
+
+def bench_transcode(media):
+    results = {}
+    for name, fn in media.items():
+        with fresh_cache():
+            start = time.time()
+            fmd, transcoder, done = transcode(fn)
+            done.wait()
+            elapsed = time.time() - start
+            result = {'plan': transcoder.plan.action, 'error': bool(transcoder.error)}
+            if transcoder.transcode and not transcoder.error:
+                result.update({
+                    'startup_seconds': transcoder.first_fragment_at - transcoder.started_at
+                    if transcoder.first_fragment_at else None,
+                    'seconds': elapsed,
+                    'speed': fmd.duration / elapsed,
+                    'bytes_per_second': transcoder.progress_bytes / elapsed,
+                })
+            transcoder.destroy()
+        results[name] = result
+    return results
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server on %s:%i never came up' % (host, port))
+
+
+def bench_serve(fn, server, concurrency=(1, 8), requests=200, range_size=64 * 1024):
+    """ Full-file throughput and random range latency against a finished transcode, through Gnomecast's own server """
+    caster = gnomecast.Gnomecast()
+    caster.ip = '127.0.0.1'
+    caster.server = server
+    fmd, transcoder, done = transcode(fn)
+    done.wait()
+    caster.transcoder = transcoder
+    t = threading.Thread(target=caster.start_server)
+    t.daemon = True
+    t.start()
+    wait_for_port(caster.ip, caster.port)
+    size = os.path.getsize(transcoder.fn)
+    path = '/media/%s.mp4' % hash(fn)
+
+    def get(conn, headers):
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status not in (200, 206):
+            raise RuntimeError('%s returned %i' % (server, response.status))
+        return len(body)
+
+    result = {'file_bytes': size}
+    conn = http.client.HTTPConnection(caster.ip, caster.port, timeout=30)
+    start = time.time()
+    get(conn, {})
+    result['full_get_bytes_per_second'] = size / (time.time() - start)
+    conn.close()
+
+    for clients in concurrency:
+        latencies = []
+        lock = threading.Lock()
+
+        def client():
+            conn = http.client.HTTPConnection(caster.ip, caster.port, timeout=30)
+            for i in range(requests // clients):
+                offset = random.randrange(0, max(1, size - range_size))
+                start = time.time()
+                get(conn, {'Range': 'bytes=%i-%i' % (offset, offset + range_size - 1)})
+                with lock:
+                    latencies.append(time.time() - start)
+            conn.close()
+
+        start = time.time()
+        threads = [threading.Thread(target=client) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        result['ranges_%i_clients' % clients] = {
+            'requests_per_second': len(latencies) / elapsed,
+            'bytes_per_second': len(latencies) * range_size / elapsed,
+            'p50_seconds': percentile(latencies, 50),
+            'p95_seconds': percentile(latencies, 95),
+        }
+    transcoder.destroy()
+    return result
+
+
+def bench_playback(fn, server='asyncio', seek_to=None):
+    """
+    Casts fn to a FakeChromecast while it's still transcoding, as the GUI would, measuring time to first frame,
+    stalls and the latency of one seek
+    """
+    cast = fakecast.FakeChromecast()
+    caster = gnomecast.Gnomecast()
+    caster.ip = '127.0.0.1'
+    caster.server = server
+    fmd, transcoder, done = transcode(fn, cast=cast)
+    caster.cast, caster.fn, caster.transcoder = cast, fn, transcoder
+    t = threading.Thread(target=caster.start_server)
+    t.daemon = True
+    t.start()
+    wait_for_port(caster.ip, caster.port)
+    mc = cast.media_controller
+    caster.play_media(0)
+    seek_to = fmd.duration / 2 if seek_to is None else seek_to
+    deadline = time.time() + fmd.duration * 2 + 30
+    while mc.status.player_state != 'PLAYING' and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(2)
+    caster.seek_to(seek_to)
+    while mc.status.player_state != 'IDLE' and time.time() < deadline:
+        time.sleep(0.1)
+    transcoder.destroy()
+    metrics = cast.metrics
+    return {
+        'time_to_first_frame_seconds': metrics['time_to_first_frame'][0] if metrics['time_to_first_frame'] else None,
+        'seek_latency_seconds': metrics['seek_latency'][0] if metrics['seek_latency'] else None,
+        'stalls': metrics['stalls'],
+        'stalled_seconds': metrics['stalled_seconds'],
+        'range_requests': len(metrics['requests']),
+        'finished': mc.status.idle_reason == 'FINISHED',
+    }
+
+
+def bench_subtitles(dir, cues=5000, repeat=5):
+    srt_fn = os.path.join(dir, 'subtitles.srt')
+    make_srt(srt_fn, cues)
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        gnomecast.convert_subtitles(srt_fn)
+        times.append(time.time() - start)
+    return {'cues': cues, 'seconds': percentile(times, 50), 'cues_per_second': cues / percentile(times, 50)}
+
+
+def compare(old, new, prefix=''):
+    """ Prints every number that moved more than 10% between two result files """
+    for key in sorted(new):
+        if key not in old: continue
+        if isinstance(new[key], dict) and isinstance(old[key], dict):
+            compare(old[key], new[key], prefix + key + '.')
+        elif isinstance(new[key], (int, float)) and isinstance(old[key], (int, float)) and old[key] and \
+                not isinstance(new[key], bool):
+            change = (new[key] - old[key]) / old[key]
+            if abs(change) > 0.1:
+                print('%-60s %12.4g -> %12.4g (%+.0f%%)' % (prefix + key, old[key], new[key], change * 100))
+
+
+def main(output=None, compare_with=None, duration=30):
+    results = {
+        'version': gnomecast.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+                 'ffmpeg': subprocess.check_output(['ffmpeg', '-version']).decode().split('\n')[0]},
+    }
+    print('starting up...')
+    results['startup'] = bench_startup()
+    with tempfile.TemporaryDirectory() as dir:
+        print('generating test media...')
+        media = make_media(dir, duration=int(duration))
+        print('probing...')
+        results['probe'] = bench_probe(media)
+        print('transcoding...')
+        results['transcode'] = bench_transcode(media)
+        print('serving...')
+        fn = media.get('mkv_h264_ac3_51') or sorted(media.values())[0]
+        with fresh_cache():
+            results['serve'] = {server: bench_serve(fn, server) for server in ('asyncio', 'paste')}
+        print('playing on a fake chromecast...')
+        with fresh_cache():
+            results['playback'] = {name: bench_playback(fn) for name, fn in media.items()}
+        print('converting subtitles...')
+        results['subtitles'] = bench_subtitles(dir)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if compare_with:
+        with open(compare_with) as f:
+            compare(json.load(f), results)
+    if over_budget(results['startup']):
+        sys.exit(1)
+    return results
+
+
+if __name__ == '__main__':
+    gnomecast.arg_parse(sys.argv[1:], {'o': 'output', 'compare': 'compare_with'}, main, __doc__.strip())
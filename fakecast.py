@@ -0,0 +1,267 @@
+"""
+A local stand-in for a Chromecast, for exercising gnomecast end to end without hardware.
+
+FakeChromecast has the parts of pychromecast.Chromecast that gnomecast uses (device, status, wait, set_volume and
+media_controller: play_media, play, pause, stop, seek, status and status listeners).  play_media() really fetches the
+URL the way a receiver does - Range requests from the current offset, reading ahead to a buffer limit, then
+reconnecting further on as playback drains it - and plays it back at realtime against an assumed bitrate.  It records
+time to first frame, stalls and seek latency in .metrics.
+"""
+
+import http.client, threading, time, urllib.parse, uuid
+
+
+class DeviceInfo(object):
+    def __init__(self, friendly_name, model_name, manufacturer, cast_type):
+        self.friendly_name = friendly_name
+        self.model_name = model_name
+        self.manufacturer = manufacturer
+        self.cast_type = cast_type
+        self.uuid = uuid.uuid4()
+
+
+class CastStatus(object):
+    def __init__(self):
+        self.volume_level = 1.0
+        self.volume_muted = False
+        self.app_id = None
+        self.display_name = None
+        self.status_text = ''
+
+    def __repr__(self):
+        return '<CastStatus volume_level=%.2f app_id=%s>' % (self.volume_level, self.app_id)
+
+
+class MediaStatus(object):
+    def __init__(self):
+        self.player_state = 'UNKNOWN'
+        self.idle_reason = None
+        self.current_time = 0.0
+        self.duration = None
+        self.content_id = None
+        self.content_type = None
+        self.volume_level = 1.0
+        self.volume_muted = False
+        self.playback_rate = 1
+        self.supports_seek = True
+
+    def __repr__(self):
+        return '<MediaStatus %s current_time=%.1f content_id=%s>' % (
+            self.player_state, self.current_time, self.content_id)
+
+
+class FakeMediaController(object):
+    chunk_size = 64 * 1024
+    tick = 0.05  # seconds between playback clock updates
+    start_seconds = 2  # buffered before playback (re)starts
+    max_buffer_seconds = 30  # read ahead this far, then drop the connection
+    refill_seconds = 10  # and reconnect once the buffer is down to this
+
+    def __init__(self, cast):
+        self.cast = cast
+        self.status = MediaStatus()
+        self.app_id = 'CC1AD845'
+        self.listeners = []
+        self.cond = threading.Condition()
+        self.session = 0  # bumped by play_media() and stop(), so old threads know to quit
+        self.reader = 0  # bumped by seek(), so the old connection is dropped
+        self.paused = False
+        self.size = None
+
+    def register_status_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self):
+        for listener in self.listeners:
+            listener.new_media_status(self.status)
+
+    def set_state(self, player_state, idle_reason=None):
+        if self.status.player_state == player_state: return
+        self.status.player_state = player_state
+        self.status.idle_reason = idle_reason
+        self.notify()
+
+    def update_status(self, callback_function_param=False):
+        self.notify()
+
+    def block_until_active(self, timeout=None):
+        pass
+
+    def play_media(self, url, content_type, current_time=0, autoplay=True, subtitles=None, **kwargs):
+        with self.cond:
+            self.session += 1
+            self.reader += 1
+            session = self.session
+            self.status.content_id = url
+            self.status.content_type = content_type
+            self.status.current_time = float(current_time or 0)
+            self.status.duration = None
+            self.paused = not autoplay
+            self.size = None
+            self.eof = False
+            self.offset = self.play_offset = self.byte_offset(self.status.current_time)
+            self.requested_at = time.time()
+            self.seek_requested_at = None
+            self.set_state('BUFFERING')
+            self.cond.notify_all()
+        for target in (self.read, self.clock):
+            t = threading.Thread(target=target, args=(session,))
+            t.daemon = True
+            t.start()
+
+    def play(self):
+        with self.cond:
+            self.paused = False
+            if self.status.player_state == 'PAUSED':
+                self.set_state('PLAYING')
+
+    def pause(self):
+        with self.cond:
+            self.paused = True
+            if self.status.player_state == 'PLAYING':
+                self.set_state('PAUSED')
+
+    def stop(self):
+        with self.cond:
+            self.session += 1
+            self.set_state('IDLE', 'CANCELLED')
+            self.cond.notify_all()
+
+    def seek(self, position):
+        with self.cond:
+            self.reader += 1
+            self.status.current_time = float(position)
+            self.offset = self.play_offset = self.byte_offset(position)
+            self.eof = False
+            self.seek_requested_at = time.time()
+            if self.status.player_state in ('PLAYING', 'PAUSED', 'BUFFERING'):
+                self.set_state('BUFFERING')
+            self.cond.notify_all()
+
+    def byte_offset(self, seconds):
+        return int(seconds * self.cast.byte_rate)
+
+    def buffered_seconds(self):
+        return (self.offset - self.play_offset) / self.cast.byte_rate
+
+    def read(self, session):
+        """ Fetches the media from self.offset on, in Range requests, keeping up to max_buffer_seconds ahead """
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: session != self.session or not self.eof and (
+                    self.buffered_seconds() < self.refill_seconds or self.status.player_state == 'BUFFERING'))
+                if session != self.session: return
+                reader, offset = self.reader, self.offset
+            url = urllib.parse.urlsplit(self.status.content_id)
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+            try:
+                range_header = 'bytes=%i-' % offset
+                conn.request('GET', url.path + ('?' + url.query if url.query else ''), headers={'Range': range_header})
+                response = conn.getresponse()
+                self.cast.metrics['requests'].append((range_header, response.status))
+                if response.status not in (200, 206):
+                    with self.cond:
+                        if session == self.session:
+                            self.set_state('IDLE', 'ERROR')
+                            self.session += 1
+                    return
+                total = response.getheader('Content-Range', '').rpartition('/')[2]
+                if total.isdigit():
+                    self.size = int(total)
+                elif response.status == 200 and response.getheader('Content-Length'):
+                    self.size = int(response.getheader('Content-Length'))
+                if self.size:
+                    self.status.duration = self.size / self.cast.byte_rate
+                skip = offset if response.status == 200 else 0  # the server ignored our range
+                # a 206 of a file still being written ends where the writing is, not at the end of the media
+                growing = response.status == 206 and not total.isdigit()
+                while True:
+                    data = response.read(self.chunk_size)
+                    with self.cond:
+                        if session != self.session or reader != self.reader: break
+                        if not data:
+                            if growing:
+                                if self.offset == offset:
+                                    self.cond.wait(0.2)  # nothing new yet, don't hammer the server
+                                break
+                            self.eof = True
+                            self.cond.notify_all()
+                            break
+                        if skip >= len(data):
+                            skip -= len(data)
+                            continue
+                        data, skip = data[skip:], 0
+                        self.offset += len(data)
+                        self.cast.metrics['bytes_fetched'] += len(data)
+                        self.cond.notify_all()
+                        if self.buffered_seconds() >= self.max_buffer_seconds:
+                            break  # drop the connection like a receiver does, and come back for more later
+            except (OSError, http.client.HTTPException) as e:
+                print('fake chromecast: fetching %s failed: %s' % (self.status.content_id, e))
+                time.sleep(0.5)
+            finally:
+                conn.close()
+
+    def clock(self, session):
+        """ Plays back at realtime, stalling when the buffer runs dry """
+        last = time.time()
+        stalled_at = None
+        while True:
+            time.sleep(self.tick)
+            now = time.time()
+            with self.cond:
+                if session != self.session: return
+                state = self.status.player_state
+                if state == 'PLAYING':
+                    seconds = min((now - last) * self.status.playback_rate, self.buffered_seconds())
+                    self.status.current_time += seconds
+                    self.play_offset += seconds * self.cast.byte_rate
+                    if self.buffered_seconds() <= 0:
+                        if self.eof:
+                            self.set_state('IDLE', 'FINISHED')
+                            self.session += 1
+                            return
+                        self.cast.metrics['stalls'] += 1
+                        stalled_at = now
+                        self.set_state('BUFFERING')
+                        self.cond.notify_all()
+                elif state == 'BUFFERING' and (self.buffered_seconds() >= self.start_seconds or self.eof):
+                    if self.requested_at:
+                        self.cast.metrics['time_to_first_frame'].append(now - self.requested_at)
+                        self.requested_at = None
+                    if self.seek_requested_at:
+                        self.cast.metrics['seek_latency'].append(now - self.seek_requested_at)
+                        self.seek_requested_at = None
+                    if stalled_at:
+                        self.cast.metrics['stalled_seconds'] += now - stalled_at
+                        stalled_at = None
+                    self.set_state('PAUSED' if self.paused else 'PLAYING')
+                last = now
+
+
+class FakeChromecast(object):
+    def __init__(self, name='Fake Chromecast', model_name='Chromecast', manufacturer='Unknown manufacturer',
+                 cast_type='video', bitrate=8000000):
+        self.name = name
+        self.device = DeviceInfo(name, model_name, manufacturer, cast_type)
+        self.model_name = model_name
+        self.cast_type = cast_type
+        self.uuid = self.device.uuid
+        self.byte_rate = bitrate / 8  # bytes per second of media we pretend to be playing
+        self.status = CastStatus()
+        self.metrics = {'time_to_first_frame': [], 'seek_latency': [], 'stalls': 0, 'stalled_seconds': 0.0,
+                        'requests': [], 'bytes_fetched': 0}
+        self.media_controller = FakeMediaController(self)
+
+    def wait(self, timeout=None):
+        pass
+
+    def set_volume(self, volume):
+        self.status.volume_level = self.media_controller.status.volume_level = volume
+        return volume
+
+    def disconnect(self, timeout=None, blocking=True):
+        self.media_controller.stop()
+
+    def __repr__(self):
+        return '<FakeChromecast %s>' % self.name
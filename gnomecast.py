@@ -1,37 +1,70 @@
-import contextlib, os, re, signal, socket, subprocess, sys, tempfile, threading, time, traceback, urllib
-
-DEPS_MET = True
-try:
-    import pychromecast
-    import bottle
-    import html5lib.treebuilders
-
-    # hack fixing pycaption needing an old version of html5lib
-    if not hasattr(html5lib.treebuilders, '_base'):
-        html5lib.treebuilders._base = html5lib.treebuilders.base
-
-    import pycaption
-except Exception as e:
-    traceback.print_exc()
-    print(e)
-    DEPS_MET = False
-
-DBUS_AVAILABLE = False
-try:
-    import dbus
-
-    DBUS_AVAILABLE = True
-except Exception as e:
-    print(e)
-
-try:
-    import gi
-
-    gi.require_version('Gtk', '3.0')
-    from gi.repository import Gtk, Gdk, GLib, GdkPixbuf, Gio
-except ImportError:
-    line = "-" * 70
-    ERROR_MESSAGE = """
+import asyncio, collections, concurrent.futures, contextlib, hashlib, heapq, importlib.util, io, itertools, json, logging, mimetypes, multiprocessing, os, re, shutil, signal, socket, subprocess, sys, tempfile, threading, time, traceback, urllib, uuid
+
+_import_started_at = time.time()
+
+# the heavy dependencies are only imported the first time they're needed (see import_pychromecast() etc.), so just
+# check they're there
+MISSING_DEPS = [name for name in ('pychromecast', 'bottle', 'html5lib', 'pycaption')
+                if not importlib.util.find_spec(name)]
+DEPS_MET = not MISSING_DEPS
+if MISSING_DEPS:
+    print('missing python packages:', ', '.join(MISSING_DEPS))
+
+DBUS_AVAILABLE = bool(importlib.util.find_spec('dbus'))
+
+pychromecast = bottle = pycaption = dbus = None
+
+
+def import_pychromecast():
+    global pychromecast
+    if pychromecast is None:
+        import pychromecast
+    return pychromecast
+
+
+def import_bottle():
+    global bottle
+    if bottle is None:
+        import bottle
+    return bottle
+
+
+def import_pycaption():
+    """ Only needed for subtitle formats other than SRT and WebVTT """
+    global pycaption
+    if pycaption is None:
+        import html5lib.treebuilders
+
+        # hack fixing pycaption needing an old version of html5lib
+        if not hasattr(html5lib.treebuilders, '_base'):
+            html5lib.treebuilders._base = html5lib.treebuilders.base
+
+        import pycaption
+        pycaption.WebVTTWriter._encode = lambda self, s: s
+    return pycaption
+
+
+def import_dbus():
+    global dbus
+    if dbus is None:
+        import dbus
+    return dbus
+
+
+Gtk = Gdk = GLib = GdkPixbuf = Gio = None
+
+
+def import_gtk():
+    """ GTK is only loaded for the GUI, so --headless runs on machines without a display (or python3-gi) """
+    global Gtk, Gdk, GLib, GdkPixbuf, Gio
+    try:
+        import gi
+
+        gi.require_version('Gtk', '3.0')
+        from gi.repository import Gtk, Gdk, GLib, GdkPixbuf, Gio
+    except ImportError:
+        line = "-" * 70
+        ERROR_MESSAGE = """
 {}
 Python package "gi" (for building the GU not found.\n
 If on Debian or Ubuntu, please run:
@@ -42,28 +75,173 @@ https://github.com/keredson/gnomecast\n
 Thanks! - Gnomecast
 {}
 """
-    print(ERROR_MESSAGE.format(line, line))
-    sys.exit(1)
+        print(ERROR_MESSAGE.format(line, line))
+        sys.exit(1)
+
 
 __version__ = '1.9.11'
 
-if DEPS_MET:
-    pycaption.WebVTTWriter._encode = lambda self, s: s
+
+HDR_TRANSFERS = ('smpte2084', 'arib-std-b67')  # ffprobe color_transfer values for HDR10 and HLG
+# maps HDR down to SDR for devices that can't play it (needs an ffmpeg built with libzimg), rather than leaving the
+# picture washed out by just dropping to 8 bits
+HDR_TONEMAP_FILTERS = ['zscale=t=linear:npl=100', 'format=gbrpf32le', 'zscale=p=bt709', 'tonemap=hable:desat=0',
+                       'zscale=t=bt709:m=bt709:r=tv', 'format=yuv420p']
 
 
-class Device:
-    def __init__(self, h265=None, ac3=None):
-        self.h265 = h265
-        self.ac3 = ac3
+def device_database_fns():
+    """ The device database shipped with gnomecast, then the user's own additions to it """
+    here = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'devices.json')
+    installed = os.path.join(sys.prefix, 'share', 'gnomecast', 'devices.json')
+    config = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return [here if os.path.exists(here) else installed, os.path.join(config, 'gnomecast', 'devices.json')]
 
 
-HARDWARE = {
-    ('Unknown manufacturer', 'Chromecast'): Device(h265=False, ac3=False),
-    ('Unknown manufacturer', 'Chromecast Ultra'): Device(h265=True, ac3=True),
-    ('Unknown manufacturer', 'Google Home Mini'): Device(h265=False, ac3=False),
-    ('Unknown manufacturer', 'Google Home'): Device(h265=False, ac3=False),
-    ('VIZIO', 'P75-F1'): Device(h265=True, ac3=True),
-}
+class DeviceCapabilities(object):
+    """
+    What one kind of cast device can play, from its (resolved) device database entry.  Each check returns why a
+    stream won't play, or None if it will.
+    """
+
+    def __init__(self, name, entry):
+        self.name = name
+        self.video = entry.get('video', {})  # codec -> {profiles, max_level (as ffprobe reports it), pix_fmts}
+        self.audio = entry.get('audio', {})  # codec -> {profiles, max_channels}
+        self.max_width = entry.get('max_width')
+        self.max_height = entry.get('max_height')
+        self.max_frame_rate = entry.get('max_frame_rate')
+        self.hdr = entry.get('hdr', [])  # color_transfer values it plays as HDR
+        self.containers = entry.get('containers', [])  # played as is, without remuxing to mp4
+
+    def __repr__(self):
+        return 'DeviceCapabilities(%s)' % self.name
+
+    def video_problem(self, stream):
+        caps = self.video.get(stream.codec)
+        if caps is None:
+            return '%s not supported' % stream.codec
+        if stream.profile and 'profiles' in caps and stream.profile not in caps['profiles']:
+            return '%s profile %s not supported' % (stream.codec, stream.profile)
+        if stream.level and caps.get('max_level') and stream.level > caps['max_level']:
+            return '%s level %s not supported' % (stream.codec, stream.level)
+        if stream.pix_fmt and 'pix_fmts' in caps and stream.pix_fmt not in caps['pix_fmts']:
+            return '%s not supported' % stream.pix_fmt
+        if self.scaled_size(stream):
+            return '%ix%i not supported' % (stream.width, stream.height)
+        if self.frame_rate_limit(stream):
+            return '%.3g fps not supported' % stream.frame_rate
+        if stream.color_transfer in HDR_TRANSFERS and stream.color_transfer not in self.hdr:
+            return 'HDR (%s) not supported' % stream.color_transfer
+        return None
+
+    def audio_problem(self, stream):
+        caps = self.audio.get(stream.codec)
+        if caps is None:
+            return '%s not supported' % stream.codec
+        if stream.profile and 'profiles' in caps and stream.profile not in caps['profiles']:
+            return '%s profile %s not supported' % (stream.codec, stream.profile)
+        if stream.channels > caps.get('max_channels', 2):
+            return '%i channel %s not supported' % (stream.channels, stream.codec)
+        return None
+
+    def audio_transcode_codec(self, stream):
+        """ Surround sound stays surround if the device takes ac3 """
+        return 'ac3' if stream.channels > 2 and 'ac3' in self.audio else 'mp3'
+
+    def scaled_size(self, stream):
+        """ The (even) size to scale stream down to so it fits the device, or None if it already does """
+        if not stream.width or not stream.height: return None
+        scale = min(self.max_width / stream.width if self.max_width else 1,
+                    self.max_height / stream.height if self.max_height else 1)
+        if scale >= 1: return None
+        return int(stream.width * scale) // 2 * 2, int(stream.height * scale) // 2 * 2
+
+    def frame_rate_limit(self, stream):
+        """ The frame rate to transcode stream at, or None if the device takes its own """
+        if stream.frame_rate and self.max_frame_rate and stream.frame_rate > self.max_frame_rate + 0.01:
+            return self.max_frame_rate
+        return None
+
+
+class DeviceDatabase(object):
+    """
+    Cast device capabilities by manufacturer, model and cast type, from JSON files (devices.json, see README.md).
+    Entries in later files replace same named ones in earlier files.  An entry can extend another, replacing any of
+    its fields, and per codec in video and audio (null removes a codec).  The most specific match wins; devices
+    matching no entry get 'default', or 'audio' for speakers and speaker groups.
+    """
+
+    def __init__(self, fns=None):
+        self.fns = fns  # None for device_database_fns(), which are read on the first lookup
+        self.entries = None
+        self.lock = threading.Lock()
+        self.found = {}  # (manufacturer, model_name, cast_type) -> DeviceCapabilities
+
+    def load(self):
+        entries = {}
+        for fn in self.fns or device_database_fns():
+            if not os.path.exists(fn): continue
+            try:
+                with open(fn) as f:
+                    entries.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print('ignoring bad device database', fn, e)
+        return entries
+
+    def resolve(self, name, seen=()):
+        entry = self.entries.get(name, {})
+        base = {}
+        if entry.get('extends') and entry['extends'] not in seen:
+            base = self.resolve(entry['extends'], seen + (name,))
+        resolved = dict(base)
+        for key, value in entry.items():
+            if key in ('video', 'audio'):
+                codecs = dict(base.get(key, {}), **value)
+                resolved[key] = {codec: caps for codec, caps in codecs.items() if caps is not None}
+            elif key not in ('extends', 'match'):
+                resolved[key] = value
+        return resolved
+
+    def lookup(self, manufacturer, model_name, cast_type):
+        key = (manufacturer, model_name, cast_type)
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load()
+            if key not in self.found:
+                device = dict(zip(('manufacturer', 'model_name', 'cast_type'), key))
+                best, best_score = 'audio' if cast_type in ('audio', 'group') else 'default', 0
+                for name, entry in self.entries.items():
+                    for match in entry.get('match', []):
+                        score = sum(1 if k == 'cast_type' else 2 for k in match)  # a model beats a cast type
+                        if score > best_score and all(device.get(k) == v for k, v in match.items()):
+                            best, best_score = name, score
+                self.found[key] = DeviceCapabilities(best, self.resolve(best))
+            return self.found[key]
+
+
+DEVICES = DeviceDatabase()
+
+
+class EncoderProfile:
+    def __init__(self, name, preset, crf):
+        self.name = name
+        self.preset = preset  # x264 -preset
+        self.crf = crf
+
+
+# fastest to best looking
+ENCODER_PROFILES = [
+    EncoderProfile('fastest', 'ultrafast', 28),
+    EncoderProfile('fast', 'superfast', 25),
+    EncoderProfile('balanced', 'veryfast', 23),
+    EncoderProfile('quality', 'faster', 22),
+    EncoderProfile('best', 'medium', 20),
+]
+ENCODER_PROFILE_NAMES = [profile.name for profile in ENCODER_PROFILES]
+DEFAULT_ENCODER_PROFILE = 'balanced'
+SPEED_SAFETY_MARGIN = 1.3  # encoding slower than this many times realtime risks the device catching up
+SPEED_HEADROOM = 2.5  # encoding faster than this leaves room for a better looking preset
+SPEED_WARMUP_SECONDS = 10  # of output before ffmpeg's speed= means anything
 
 
 def throttle(seconds=2):
@@ -92,6 +270,7 @@ def throttle(seconds=2):
 def find_screensaver_dbus_iface(bus):
     """ Searches the DBus names for Screensaver and returns correct Interface"""
     if not DBUS_AVAILABLE: return None
+    import_dbus()
     for path, name in [('org.freedesktop.ScreenSaver', '/ScreenSaver'), ('org.mate.ScreenSaver', '/ScreenSaver')]:
         try:
             saver = bus.get_object(path, name)
@@ -103,6 +282,237 @@ def find_screensaver_dbus_iface(bus):
 
 
 AUDIO_EXTS = ('aac', 'mp3', 'wav')
+# how far ahead of a requested byte the transcode must be before we serve it
+MIN_LEAD_BYTES = 1024 * 1024
+DEFAULT_LEAD_BYTES = 32 * 1024 * 1024  # when we have no idea of the bitrate
+
+# seeks further than this past what's been transcoded start a new transcode at the seek target
+SEEK_RESTART_SECONDS = 60
+MAX_SEEK_REGIONS = 2
+LOOKAHEAD_NICE = 10  # queued transcodes only get the cpu the playing one leaves idle
+HEADLESS_REPORT_SECONDS = 5  # --headless prints a progress line at least this often
+
+
+def cache_dir(*parts):
+    """ Returns (creating if needed) gnomecast's directory under $XDG_CACHE_HOME """
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(root, 'gnomecast', *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_identity(fn):
+    """
+    Builds a cache key for a media file from its path, size, mtime and inode
+    :param fn:
+    :return: hex digest, or None if the file can't be stat'd
+    """
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    ident = '%s:%i:%i:%i' % (os.path.abspath(fn), st.st_size, st.st_mtime_ns, st.st_ino)
+    return hashlib.sha1(ident.encode()).hexdigest()
+
+
+class DiskCache(object):
+    """ A directory of files keyed by name, evicting the least recently used ones past max_bytes """
+
+    stale_tmp_seconds = 24 * 60 * 60  # tmp_path() files this old were left by a gnomecast that didn't finish them
+
+    def __init__(self, name, max_bytes, root=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.root = root  # overrides the default directory under $XDG_CACHE_HOME
+        self.lock = threading.Lock()
+
+    def directory(self):
+        if self.root:
+            os.makedirs(self.root, exist_ok=True)
+            return self.root
+        return cache_dir(self.name)
+
+    def path(self, key, ext=''):
+        return os.path.join(self.directory(), key + ext)
+
+    def tmp_path(self, ext=''):
+        """ A fresh file in the cache directory to build an entry in before add()ing it """
+        fd, tmp_fn = tempfile.mkstemp(suffix=ext, prefix='.tmp', dir=self.directory())
+        os.close(fd)
+        return tmp_fn
+
+    def get(self, key, ext=''):
+        fn = self.path(key, ext)
+        try:
+            os.utime(fn)  # mtime is our LRU clock
+        except OSError:
+            return None
+        return fn
+
+    def get_json(self, key):
+        fn = self.get(key, '.json')
+        if not fn: return None
+        try:
+            with open(fn) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print('ignoring bad cache entry', fn, e)
+            return None
+
+    def put_json(self, key, data):
+        return self.put_text(key, '.json', json.dumps(data))
+
+    def put_text(self, key, ext, text):
+        tmp_fn = self.tmp_path('.tmp')
+        with open(tmp_fn, 'w') as f:
+            f.write(text)
+        return self.add(key, ext, tmp_fn)
+
+    def add(self, key, ext, src_fn):
+        """ Moves src_fn into the cache and returns its new path """
+        fn = self.path(key, ext)
+        try:
+            os.replace(src_fn, fn)
+        except OSError:  # different filesystem
+            tmp_fn = self.tmp_path(ext)
+            shutil.copyfile(src_fn, tmp_fn)
+            os.replace(tmp_fn, fn)
+            os.remove(src_fn)
+        self.evict()
+        return fn
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until they fit in max_bytes.  Files still being built (see
+        tmp_path()) don't count and aren't touched, unless they're stale.
+        """
+        with self.lock:
+            dir = self.directory()
+            entries = []
+            for name in os.listdir(dir):
+                try:
+                    st = os.stat(os.path.join(dir, name))
+                except OSError:
+                    continue
+                if name.startswith('.tmp'):
+                    if time.time() - st.st_mtime > self.stale_tmp_seconds:
+                        with contextlib.suppress(OSError):
+                            os.remove(os.path.join(dir, name))
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, name in sorted(entries):
+                if total <= self.max_bytes: break
+                try:
+                    os.remove(os.path.join(dir, name))
+                    total -= size
+                except OSError:
+                    pass
+
+
+METADATA_CACHE = DiskCache('metadata', 16 * 1024 * 1024)
+METADATA_CACHE_VERSION = 3
+THUMBNAIL_PRIORITY = 1  # after any pending probes, unless the file is prioritized
+THUMBNAIL_CACHE = DiskCache('thumbnails', 256 * 1024 * 1024)
+SUBTITLE_CACHE = DiskCache('subtitles', 64 * 1024 * 1024)
+TRANSCODE_CACHE = DiskCache('transcodes', 20 * 1024 * 1024 * 1024)  # see Gnomecast.run() to move or resize it
+DEVICE_CACHE = DiskCache('devices', 1024 * 1024)  # the cast devices last seen, see CastDiscovery
+
+
+class Metrics(object):
+    """
+    Timing spans and counters.  Kept in memory for the /metrics endpoint, and every span is also handed to the
+    sinks (callables taking an event dict) as it ends.
+    """
+
+    def __init__(self, history=100):
+        self.lock = threading.Lock()
+        self.spans = collections.defaultdict(lambda: collections.deque(maxlen=history))  # name -> seconds
+        self.counters = collections.defaultdict(int)  # (name, label) -> count
+        self.sinks = [log_sink]
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start, **labels)
+
+    def record(self, name, seconds, **labels):
+        with self.lock:
+            self.spans[name].append(seconds)
+        event = dict(labels, span=name, seconds=round(seconds, 4), at=time.time())
+        for sink in self.sinks:
+            sink(event)
+
+    def count(self, name, label=None, n=1):
+        with self.lock:
+            self.counters[(name, label)] += n
+
+    def snapshot(self):
+        with self.lock:
+            spans = {name: {'count': len(times), 'last': times[-1], 'mean': sum(times) / len(times),
+                            'min': min(times), 'max': max(times)} for name, times in self.spans.items() if times}
+            counters = collections.defaultdict(dict)
+            for (name, label), n in self.counters.items():
+                counters[name][label or 'total'] = n
+        return {'spans': spans, 'counters': dict(counters)}
+
+
+def log_sink(event):
+    logging.getLogger('gnomecast.metrics').info(json.dumps(event, sort_keys=True))
+
+
+def file_sink(fn):
+    """ A sink appending events to fn as json lines """
+    lock = threading.Lock()
+
+    def sink(event):
+        with lock, open(fn, 'a') as f:
+            f.write(json.dumps(event, sort_keys=True) + '\n')
+
+    return sink
+
+
+METRICS = Metrics()
+logger = logging.getLogger('gnomecast')  # main() sends it to stderr
+
+
+def process_age():
+    """ Seconds since this process started, from /proc so the interpreter's own startup is included """
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.time() - _import_started_at
+
+
+class StartupTimer(object):
+    """ How long after the process started gnomecast reached each step on the way to drawing its window """
+
+    def __init__(self):
+        self.started_at = time.time() - process_age()
+        # (step, seconds since process start), 'python' being the interpreter's startup and the stdlib imports
+        self.steps = [('python', _import_started_at - self.started_at)]
+
+    def mark(self, step):
+        self.steps.append((step, time.time() - self.started_at))
+
+    def report(self):
+        """ Seconds spent in each step (not cumulative), plus the total """
+        report, last = {}, 0
+        for step, seconds in self.steps:
+            report[step] = round(seconds - last, 4)
+            last = seconds
+        report['total'] = round(last, 4)
+        return report
+
+
+STARTUP = StartupTimer()
 
 
 def parse_ffmpeg_time(time_s):
@@ -115,17 +525,148 @@ def parse_ffmpeg_time(time_s):
     return hours * 60 * 60 + minutes * 60 + seconds
 
 
+def parse_ffprobe_rate(rate_s):
+    """
+    Converts ffprobe's rational rate string (ex: "24000/1001") to a float
+    :param rate_s:
+    :return: rate, or None if unknown
+    """
+    if not rate_s: return None
+    num, _, den = rate_s.partition('/')
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+SRT_TIMESTAMP = re.compile(r'^\s*(\d+:)?\d+:\d+[,.]\d+\s*-->\s*(\d+:)?\d+:\d+[,.]\d+')
+SRT_STYLE_TAG = re.compile(r'{\\[^}]*}|</?font[^>]*>', re.IGNORECASE)
+
+
+def srt_to_webvtt(lines):
+    """
+    Streams SRT lines out as WebVTT lines
+    :param lines: iterable of SRT lines
+    :return: generator of WebVTT lines
+    """
+    yield 'WEBVTT\n\n'
+    for line in lines:
+        line = line.rstrip('\r\n').lstrip('\ufeff')
+        if SRT_TIMESTAMP.match(line):
+            line = line.replace(',', '.')
+        else:
+            line = SRT_STYLE_TAG.sub('', line)
+        yield line + '\n'
+
+
+def convert_subtitles(fn):
+    """
+    Converts a subtitles file to WebVTT, natively for SRT and WebVTT and via pycaption for anything else
+    :param fn:
+    :return: WebVTT as a string
+    """
+    for encoding in ('utf-8-sig', 'latin-1'):
+        try:
+            with open(fn, encoding=encoding, newline='') as f:
+                first = ''
+                for first in f:
+                    if first.strip(): break
+                if first.startswith('WEBVTT'):
+                    f.seek(0)
+                    return f.read()
+                if first.strip().isdigit() or SRT_TIMESTAMP.match(first):
+                    f.seek(0)
+                    return ''.join(srt_to_webvtt(f))
+                f.seek(0)
+                caps = f.read()
+            break
+        except UnicodeDecodeError:
+            continue
+    import_pycaption()
+    converter = pycaption.CaptionConverter()
+    converter.read(caps, pycaption.detect_format(caps)())
+    return converter.write(pycaption.WebVTTWriter())
+
+
+_subtitle_executor = None
+
+
+def convert_subtitles_async(fn):
+    """ Runs convert_subtitles in a worker process, returning a concurrent.futures.Future """
+    global _subtitle_executor
+    if _subtitle_executor is None:
+        # forking a process with GTK, server and transcode threads running can deadlock the child on a held lock
+        _subtitle_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context('forkserver'))
+    return _subtitle_executor.submit(convert_subtitles, fn)
+
+
+class ProbeScheduler(object):
+    """ Runs probe jobs on a bounded pool of worker threads, most urgent first """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.cond = threading.Condition()
+        self.queue = []  # heap of [priority, seq, key, f]
+        self.urgency = {}  # key -> priority, for keys passed to prioritize()
+        self.seq = itertools.count()
+        self.threads = []
+
+    def submit(self, key, f, priority=0):
+        with self.cond:
+            priority = min(priority, self.urgency.get(key, priority))
+            heapq.heappush(self.queue, [priority, next(self.seq), key, f])
+            if len(self.threads) < self.workers:
+                t = threading.Thread(target=self.work)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+            self.cond.notify()
+
+    def prioritize(self, keys):
+        """ Moves queued jobs for keys ahead of everything else, in the order given """
+        with self.cond:
+            self.urgency = {key: i - len(keys) for i, key in enumerate(keys)}
+            for job in self.queue:
+                if job[2] in self.urgency:
+                    job[0] = min(job[0], self.urgency[job[2]])
+            heapq.heapify(self.queue)
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                priority, seq, key, f = heapq.heappop(self.queue)
+            try:
+                f()
+            except Exception:
+                print('ERROR probing', key)
+                traceback.print_exc()
+
+
 class StreamMetadata:
 
     def __init__(self, index, codec, title=None):
         self.index = index
         self.codec = codec
         self.title = title
+        self._subtitles = None  # WebVTT, once loaded
 
     def __repr__(self):
         fields = ['%s:%s' % (k, v) for k, v in self.__dict__.items() if v is not None and not k.startswith('_')]
         return '%s(%s)' % (self.__class__.__name__, ', '.join(fields))
 
+    def to_dict(self):
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        stream = cls(d.pop('index'), d.pop('codec'), title=d.pop('title', None))
+        stream.__dict__.update(d)
+        return stream
+
 
 class AudioMetadata(StreamMetadata):
     def __init__(self, *args, **kwargs):
@@ -148,105 +689,213 @@ class AudioMetadata(StreamMetadata):
 
 class FileMetadata(object):
 
-    def __init__(self, fn, callback=None, _ffmpeg_output=None):
+    def __init__(self, fn, callback=None, scheduler=None, _ffprobe_output=None):
         self.fn = fn
         self.ready = False
+        self.duration = None
+        self.bit_rate = None
+        self.thumbnail_fn = None
+        self.error = None  # set if ffprobe couldn't read the file
+        self._cache_key = None if _ffprobe_output else file_identity(fn)
+        self._subtitles_lock = threading.Lock()
+        self._subtitles_loading = {}  # stream index -> Future, while a load_subtitles() call is extracting it
 
         def parse():
-            self.thumbnail_fn = None
-            thumbnail_fn = tempfile.mkstemp(suffix='.jpg', prefix='gnomecast_pid%i_thumbnail_' % os.getpid())[1]
-            os.remove(thumbnail_fn)
-            self._ffmpeg_output = _ffmpeg_output if _ffmpeg_output else subprocess.check_output(
-                ['ffmpeg', '-i', fn, '-f', 'ffmetadata', '-', '-f', 'mjpeg', '-vframes', '1', '-ss', '27', '-vf',
-                 'scale=600:-1', thumbnail_fn],
-                stderr=subprocess.STDOUT
-            ).decode()
-            _important_ffmpeg = []
-            if os.path.isfile(thumbnail_fn):
-                self.thumbnail_fn = thumbnail_fn
-            output = self._ffmpeg_output.split('\n')
-            self.container = fn.lower().split(".")[-1]
-            self.video_streams = []
-            self.audio_streams = []
-            self.subtitles = []
-            stream = None
-            for line in output:
-                line = line.strip()
-                if line.startswith('ffmpeg version'):
-                    _important_ffmpeg.append(line)
-                if line.startswith('Stream') and 'Video' in line:
-                    _important_ffmpeg.append(line)
-                    id = line.split()[1].strip('#').strip(':')
-                    title = 'Video #%i' % (len(self.video_streams) + 1)
-                    if '(' in id:
-                        title = id[id.index('(') + 1:id.index(')')]
-                        id = id[:id.index('(')]
-                    video_codec = line.split()[3]
-                    stream = StreamMetadata(id, video_codec, title=title)
-                    self.video_streams.append(stream)
-                elif line.startswith('Stream') and 'Audio' in line:
-                    _important_ffmpeg.append(line)
-                    title = 'Audio #%i' % (len(self.audio_streams) + 1)
-                    id = line.split()[1].strip('#').strip(':')
-                    if '(' in id:
-                        title = id[id.index('(') + 1:id.index(')')]
-                        id = id[:id.index('(')]
-                    audio_codec = line.split()[3].strip(',')
-                    stream = AudioMetadata(id, audio_codec, title=title)
-                    if ', stereo, ' in line: stream.channels = 1
-                    if ', stereo, ' in line: stream.channels = 2
-                    if ', 5.1' in line: stream.channels = 6
-                    if ', 7.1' in line: stream.channels = 8
-                    self.audio_streams.append(stream)
-                elif line.startswith('Stream') and 'Subtitle' in line:
-                    _important_ffmpeg.append(line)
-                    id = line.split()[1].strip('#').strip(':')
-                    print(line, id)
-                    if '(' in id:
-                        title = id[id.index('(') + 1:id.index(')')]
-                        id = id[:id.index('(')]
-                    stream = StreamMetadata(id, None, title=title)
-                    self.subtitles.append(stream)
-                elif stream and line.startswith('title'):
-                    _important_ffmpeg.append(line)
-                    stream.title = line.split()[2]
-                elif line.startswith('Output'):
-                    break
-            self._important_ffmpeg = '\n'.join(_important_ffmpeg)
-            if not _ffmpeg_output:
-                self.load_subtitles()
+            try:
+                with METRICS.span('probe', fn=fn):
+                    self._ffprobe_output = _ffprobe_output if _ffprobe_output else subprocess.check_output(
+                        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', fn]
+                    ).decode()
+                self.parse_ffprobe(self._ffprobe_output)
+            except Exception as e:  # not a media file, or ffprobe is missing - wait()ers and the GUI report it
+                print('ERROR probing', fn, e)
+                self.error = e
+                return
+            if not _ffprobe_output:
+                if self._cache_key:
+                    self.save_cached()
+                    self.thumbnail_fn = THUMBNAIL_CACHE.get(self._cache_key, '.jpg')
             self.ready = True
             if callback: callback(self)
+            queue_thumbnail()
+
+        def make_thumbnail():
+            if self.make_thumbnail() and callback:
+                callback(self)
+
+        def queue_thumbnail():
+            # thumbnails are their own (lower priority) job so they never hold up metadata
+            if not self._cache_key or self.thumbnail_fn or not self.video_streams: return
+            if scheduler:
+                scheduler.submit(fn, make_thumbnail, priority=THUMBNAIL_PRIORITY)
+            else:
+                threading.Thread(target=make_thumbnail).start()
 
-        threading.Thread(target=parse).start()
+        if self._cache_key and self.load_cached():
+            self.ready = True
+            if callback: callback(self)
+            queue_thumbnail()
+        elif scheduler:
+            scheduler.submit(fn, parse)
+        else:
+            threading.Thread(target=parse).start()
+
+    def parse_ffprobe(self, output):
+        probe = json.loads(output)
+        fmt = probe.get('format', {})
+        self.container = self.fn.lower().split(".")[-1]
+        self.duration = float(fmt['duration']) if fmt.get('duration') else None
+        self.bit_rate = int(fmt['bit_rate']) if fmt.get('bit_rate') else None
+        self.video_streams = []
+        self.audio_streams = []
+        self.subtitles = []
+        _important_ffmpeg = ['Duration: %s, bitrate: %s' % (fmt.get('duration'), fmt.get('bit_rate'))]
+        for s in probe.get('streams', []):
+            tags = {k.lower(): v for k, v in s.get('tags', {}).items()}
+            codec_type = s.get('codec_type')
+            index = '0:%i' % s['index']
+            language = tags.get('language')
+            if codec_type == 'video':
+                title = tags.get('title') or language or 'Video #%i' % (len(self.video_streams) + 1)
+                stream = StreamMetadata(index, s.get('codec_name'), title=title)
+                stream.profile = s.get('profile')
+                stream.level = s.get('level')
+                stream.pix_fmt = s.get('pix_fmt')
+                stream.width = s.get('width')
+                stream.height = s.get('height')
+                stream.frame_rate = parse_ffprobe_rate(s.get('avg_frame_rate') or s.get('r_frame_rate'))
+                stream.color_transfer = s.get('color_transfer')
+                self.video_streams.append(stream)
+            elif codec_type == 'audio':
+                title = tags.get('title') or language or 'Audio #%i' % (len(self.audio_streams) + 1)
+                stream = AudioMetadata(index, s.get('codec_name'), title=title)
+                stream.profile = s.get('profile')
+                stream.channels = s.get('channels') or stream.channels
+                stream.channel_layout = s.get('channel_layout')
+                stream.sample_rate = int(s['sample_rate']) if s.get('sample_rate') else None
+                self.audio_streams.append(stream)
+            elif codec_type == 'subtitle':
+                title = tags.get('title') or language or 'Subtitle #%i' % (len(self.subtitles) + 1)
+                stream = StreamMetadata(index, s.get('codec_name'), title=title)
+                self.subtitles.append(stream)
+            else:
+                continue
+            stream.language = language
+            _important_ffmpeg.append('Stream #%s: %s' % (index, ', '.join(
+                str(s[k]) for k in ('codec_type', 'codec_name', 'profile', 'pix_fmt', 'channel_layout') if s.get(k))))
+        self._important_ffmpeg = '\n'.join(_important_ffmpeg)
+
+    def make_thumbnail(self, width=600):
+        """
+        Grabs a keyframe near the start of the video into the thumbnail cache
+        :return: True if a thumbnail was made
+        """
+        if not self.video_streams or not self._cache_key: return False
+        # seek on the input side and only decode keyframes, so this costs a single frame decode
+        seek = min(27, self.duration / 10) if self.duration else 0
+        thumbnail_fn = THUMBNAIL_CACHE.tmp_path('.jpg')
+        try:
+            with METRICS.span('thumbnail', fn=self.fn):
+                subprocess.check_output(
+                    ['ffmpeg', '-y', '-v', 'error', '-ss', str(seek), '-noaccurate_seek', '-skip_frame', 'nokey',
+                     '-i', self.fn, '-map', self.video_streams[0].index, '-frames:v', '1',
+                     '-vf', 'scale=%i:-1' % width, '-f', 'mjpeg', thumbnail_fn], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            print('ERROR making thumbnail:', e)
+        if not os.path.getsize(thumbnail_fn):
+            os.remove(thumbnail_fn)
+            return False
+        self.thumbnail_fn = THUMBNAIL_CACHE.add(self._cache_key, '.jpg', thumbnail_fn)
+        return True
 
     def wait(self):
-        while not self.ready:
+        """ Blocks until the file is probed, or the probe failed and self.error is set """
+        while not self.ready and not self.error:
             time.sleep(1)
 
-    def load_subtitles(self):
-        if not self.subtitles: return
+    def load_cached(self):
+        d = METADATA_CACHE.get_json(self._cache_key)
+        if not d or d.get('version') != METADATA_CACHE_VERSION: return False
+        self.container = d['container']
+        self.duration = d['duration']
+        self.bit_rate = d['bit_rate']
+        self.video_streams = [StreamMetadata.from_dict(s) for s in d['video_streams']]
+        self.audio_streams = [AudioMetadata.from_dict(s) for s in d['audio_streams']]
+        self.subtitles = [StreamMetadata.from_dict(s) for s in d['subtitles']]
+        self.thumbnail_fn = THUMBNAIL_CACHE.get(self._cache_key, '.jpg')
+        self._important_ffmpeg = d['important_ffmpeg']
+        self._ffprobe_output = d['ffprobe_output']
+        return True
+
+    def save_cached(self):
+        METADATA_CACHE.put_json(self._cache_key, {
+            'version': METADATA_CACHE_VERSION,
+            'container': self.container,
+            'duration': self.duration,
+            'bit_rate': self.bit_rate,
+            'video_streams': [s.to_dict() for s in self.video_streams],
+            'audio_streams': [s.to_dict() for s in self.audio_streams],
+            'subtitles': [s.to_dict() for s in self.subtitles],
+            'important_ffmpeg': self._important_ffmpeg,
+            'ffprobe_output': self._ffprobe_output,
+        })
+
+    def load_subtitles(self, streams=None):
+        """
+        Loads embedded subtitles (all, or just the given streams) as WebVTT, from the subtitle cache if possible.
+        Anything not cached is extracted in one pass over the file.  Streams another call is already extracting are
+        waited for rather than extracted twice.  A stream that can't be converted is left as None.
+        """
+        missing, loading = [], []
+        with self._subtitles_lock:
+            for stream in streams or self.subtitles:
+                if stream._subtitles is not None: continue
+                if stream.index in self._subtitles_loading:
+                    loading.append(self._subtitles_loading[stream.index])
+                    continue
+                vtt_fn = SUBTITLE_CACHE.get(self.subtitle_cache_key(stream), '.vtt') if self._cache_key else None
+                if vtt_fn:
+                    with open(vtt_fn) as f:
+                        stream._subtitles = f.read()
+                else:
+                    missing.append(stream)
+                    self._subtitles_loading[stream.index] = concurrent.futures.Future()
+        if missing:
+            self.extract_subtitles(missing)
+        concurrent.futures.wait(loading)
+
+    def extract_subtitles(self, streams):
         cmd = ['ffmpeg', '-y', '-i', self.fn, '-vn', '-an', ]
         files = []
-        for stream in self.subtitles:
+        for stream in streams:
             srt_fn = tempfile.mkstemp(suffix='.srt', prefix='gnomecast_pid%i_subtitles_' % os.getpid())[1]
             files.append(srt_fn)
             cmd += ['-map', stream.index, '-codec', 'srt', srt_fn]
 
-        print(cmd)
         try:
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-            for stream, srt_fn in zip(self.subtitles, files):
-                with open(srt_fn) as f:
-                    caps = f.read()
-                # print('caps', caps)
-                converter = pycaption.CaptionConverter()
-                converter.read(caps, pycaption.detect_format(caps)())
-                stream._subtitles = converter.write(pycaption.WebVTTWriter())
-                os.remove(srt_fn)
+            with METRICS.span('subtitle_extraction', fn=self.fn, streams=len(streams)):
+                subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+                futures = [convert_subtitles_async(srt_fn) for srt_fn in files]
+                for stream, future in zip(streams, futures):
+                    try:
+                        stream._subtitles = future.result()
+                    except Exception as e:
+                        print('ERROR converting subtitles', stream.index, 'of', self.fn, e)
+                        continue
+                    if self._cache_key:
+                        SUBTITLE_CACHE.put_text(self.subtitle_cache_key(stream), '.vtt', stream._subtitles)
         except subprocess.CalledProcessError as e:
             print('ERROR processing subtitles:', e)
-            self.subtitles = []
+        finally:
+            for srt_fn in files:
+                if os.path.isfile(srt_fn):
+                    os.remove(srt_fn)
+            with self._subtitles_lock:
+                for stream in streams:
+                    self._subtitles_loading.pop(stream.index).set_result(stream._subtitles)
+
+    def subtitle_cache_key(self, stream):
+        return '%s_%s' % (self._cache_key, stream.index.replace(':', '_'))
 
     def __repr__(self):
         fields = ['%s:%s' % (k, v) for k, v in self.__dict__.items() if not k.startswith('_')]
@@ -262,13 +911,125 @@ class FileMetadata(object):
         return '\n'.join(fields)
 
 
+class ProgressCondition(threading.Condition):
+    """ A Condition whose notify_all() also wakes coroutines waiting in wait_for_async() on any event loop """
+
+    def __init__(self):
+        super().__init__()
+        self.futures = set()
+
+    def notify_all(self):
+        super().notify_all()
+        for loop, future in list(self.futures):
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+    async def wait_for_async(self, predicate):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self:
+                if predicate(): return
+                waiter = (loop, loop.create_future())
+                self.futures.add(waiter)
+            try:
+                await waiter[1]
+            finally:
+                with self:
+                    self.futures.discard(waiter)
+
+
+class TranscodeProgress(object):
+    """ One block of ffmpeg's machine readable -progress output """
+
+    def __init__(self, frame=0, fps=0.0, out_time=0.0, total_size=0, speed=None, done=False):
+        self.frame = frame
+        self.fps = fps
+        self.out_time = out_time  # seconds
+        self.total_size = total_size  # bytes
+        self.speed = speed  # multiple of realtime
+        self.done = done
+
+    @classmethod
+    def from_ffmpeg(cls, d):
+        def number(key, type=float):
+            try:
+                return type(d[key].strip().rstrip('x'))
+            except (KeyError, ValueError):
+                return None
+
+        out_time_us = number('out_time_us', int)
+        if out_time_us is None:
+            out_time_us = number('out_time_ms', int)  # also microseconds, despite the name
+        return cls(frame=number('frame', int) or 0, fps=number('fps') or 0.0,
+                   out_time=max(out_time_us or 0, 0) / 1000000, total_size=number('total_size', int) or 0,
+                   speed=number('speed'), done=d.get('progress') == 'end')
+
+    def __repr__(self):
+        fields = ['%s:%s' % (k, v) for k, v in self.__dict__.items()]
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(fields))
+
+
+class StreamPlan(object):
+    """ What to do with one stream: copy it as is (codec=None) or transcode it to codec """
+
+    def __init__(self, stream, codec=None, reason=None):
+        self.stream = stream
+        self.codec = codec
+        self.reason = reason
+
+    @property
+    def action(self):
+        return 'transcode' if self.codec else 'copy'
+
+    def __repr__(self):
+        desc = '%s %s' % (self.action, self.stream.codec)
+        if self.codec:
+            desc += ' to %s' % self.codec
+        if self.reason:
+            desc += ' (%s)' % self.reason
+        return desc
+
+
+class TranscodePlan(object):
+    """
+    The per stream decisions for casting a file.  action is 'direct' (serve the source as is), 'remux' (copy every
+    stream into an mp4, which runs at disk speed) or 'transcode'.
+    """
+
+    def __init__(self, container, video, audio, direct_containers=()):
+        self.container = container
+        self.video = video
+        self.audio = audio
+        self.direct_containers = direct_containers  # the device plays these as is
+
+    @property
+    def action(self):
+        if any(plan and plan.codec for plan in (self.video, self.audio)):
+            return 'transcode'
+        return 'direct' if self.container in self.direct_containers else 'remux'
+
+    def __repr__(self):
+        return 'TranscodePlan(%s: video %s, audio %s)' % (self.action, self.video, self.audio)
+
+
 class Transcoder(object):
+    hls = False
 
     def __init__(self, cast, fmd, video_stream, audio_stream, done_callback, error_callback, prev_transcoder=None,
-                 force_audio=False, force_video=False, fake=False):
+                 force_audio=False, force_video=False, fake=False, start_at=0, threads=None, nice=0,
+                 encoder_profile=None):
         self.fmd = fmd
         self.video_stream = video_stream
         self.audio_stream = audio_stream
+        self.force_audio = force_audio
+        self.force_video = force_video
+        self.start_at = start_at  # seconds into the source this transcode starts at
+        self.threads = threads  # encoder threads, None lets ffmpeg pick
+        self.encoder_profile = encoder_profile or DEFAULT_ENCODER_PROFILE  # used by the next ffmpeg we start
+        self.running_profile = None  # the one the linear transcode is using
+        self.nice = nice
+        self.paused = False
+        self.regions = []  # transcodes started further along the source to answer seeks, see region_for()
+        self.regions_lock = threading.Lock()
         fn = fmd.fn
         self.cast = cast
         self.source_fn = fn
@@ -277,142 +1038,1004 @@ class Transcoder(object):
         if prev_transcoder:
             prev_transcoder.destroy()
 
-        print('Transcoder', fn)
-        transcode_container = fmd.container not in ('mp4', 'aac', 'mp3', 'wav')
-        self.transcode_video = force_video or not self.can_play_video_codec(video_stream.codec)
-        self.transcode_audio = force_audio or fmd.container not in AUDIO_EXTS or not self.can_play_audio_stream(
-            self.audio_stream)
-        self.transcode = transcode_container or self.transcode_video or self.transcode_audio
+        self.capabilities = DEVICES.lookup(cast.device.manufacturer, cast.device.model_name, cast.device.cast_type)
+        self.plan = TranscodePlan(fmd.container, self.plan_video(), self.plan_audio(), self.capabilities.containers)
+        logger.info('%s: %s', os.path.basename(fn), self.plan)
+        self.transcode_video = bool(self.plan.video and self.plan.video.codec)
+        self.transcode_audio = bool(self.plan.audio and self.plan.audio.codec)
+        self.transcode_audio_to = self.plan.audio.codec if self.transcode_audio else None
+        self.transcode = self.plan.action != 'direct'
         self.trans_fn = None
 
-        self.progress_bytes = 0
-        self.progress_seconds = 0
+        self.progress = TranscodeProgress()
+        self.progress_cond = ProgressCondition()  # notified on every progress update
+        self.error = None
+        self.destroyed = False
+        self.started_at = None
+        self.first_fragment_at = None
+        self.first_byte_served_at = None
+        self.log = collections.deque(maxlen=200)  # tail of ffmpeg's stderr
         self.done_callback = done_callback
         self.error_callback = error_callback
-        print('transcode, transcode_video, transcode_audio', self.transcode, self.transcode_video, self.transcode_audio)
-        if self.transcode:
+        # only whole file transcodes are worth keeping, seek regions and hls segments are thrown away
+        self.cache_key = self.transcode_cache_key() if self.transcode and not self.hls and not start_at else None
+        cached_fn = TRANSCODE_CACHE.get(self.cache_key, '.mp4') if self.cache_key else None
+        self.cached = bool(cached_fn)
+        if cached_fn:
+            print('using cached transcode', cached_fn)
+            self.trans_fn = cached_fn
+            self.progress = TranscodeProgress(out_time=fmd.duration or 0.0, total_size=os.path.getsize(cached_fn),
+                                              done=True)
+            self.done = True
+            if self.done_callback:
+                self.done_callback(did_transcode=True)
+        elif self.transcode:
             self.done = False
-            dir = '/var/tmp' if os.path.isdir('/var/tmp') else None
-            self.trans_fn = tempfile.mkstemp(suffix='.mp4', prefix='gnomecast_pid%i_transcode_' % os.getpid(), dir=dir)[
-                1]
-            os.remove(self.trans_fn)
-
-            device_info = HARDWARE.get((self.cast.device.manufacturer, self.cast.device.model_name))
-            ac3 = device_info.ac3 if device_info else None
-            transcode_audio_to = 'ac3' if (ac3 or ac3 is None) and audio_stream and audio_stream.channels > 2 else 'mp3'
-
-            self.transcode_cmd = ['ffmpeg', '-i', self.source_fn, '-map', self.video_stream.index]
-            if self.audio_stream:
-                self.transcode_cmd += ['-map', self.audio_stream.index, '-c:a',
-                                       transcode_audio_to if self.transcode_audio else 'copy'] + (
-                                          ['-b:a', '256k'] if self.transcode_audio else [])
-            self.transcode_cmd += ['-c:v', 'h264' if self.transcode_video else 'copy']  # '-movflags', 'faststart'
-            self.transcode_cmd += [self.trans_fn]
-            print(' '.join(["'%s'" % s if ' ' in s else s for s in self.transcode_cmd]))
-            if fake:
-                self.p = None
-                self.monitor()
-            else:
-                print('---------------------')
-                print(' starting ffmpeg at:')
-                print('---------------------')
-                traceback.print_stack()
-                self.p = subprocess.Popen(self.transcode_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                t = threading.Thread(target=self.monitor)
-                t.daemon = True
-                t.start()
+            self.start(fake)
         else:
             self.done = True
             self.done_callback()
 
+    def codec_args(self):
+        args = ['-c:v', 'h264' if self.transcode_video else 'copy']
+        filters = []
+        if self.transcode_video and self.capabilities.scaled_size(self.video_stream):
+            filters.append('scale=%i:%i' % self.capabilities.scaled_size(self.video_stream))
+        tonemap = self.transcode_video and self.video_stream.color_transfer in HDR_TRANSFERS and \
+            self.video_stream.color_transfer not in self.capabilities.hdr
+        if tonemap:
+            filters += HDR_TONEMAP_FILTERS
+        if filters:
+            args += ['-vf', ','.join(filters)]
+        if self.transcode_video and self.capabilities.frame_rate_limit(self.video_stream):
+            args += ['-r', str(self.capabilities.frame_rate_limit(self.video_stream))]
+        if tonemap:
+            args += ['-color_primaries', 'bt709', '-color_trc', 'bt709', '-colorspace', 'bt709']
+        elif self.transcode_video and self.video_stream.pix_fmt not in (None, 'yuv420p', 'yuvj420p'):
+            args += ['-pix_fmt', 'yuv420p']  # 10 bit, 4:2:2, etc. h264 won't play
+        if self.audio_stream:
+            args += ['-c:a', self.transcode_audio_to if self.transcode_audio else 'copy'] + (
+                ['-b:a', '256k'] if self.transcode_audio else [])
+        return args
+
+    def encoder_args(self):
+        """ How hard the encoder works, as opposed to codec_args(), which decide what comes out """
+        args = []
+        if self.transcode_video:
+            profile = ENCODER_PROFILES[ENCODER_PROFILE_NAMES.index(self.encoder_profile)]
+            args += ['-preset', profile.preset, '-crf', str(profile.crf)]
+        if self.transcode_video and self.threads:
+            args += ['-threads', str(self.threads)]
+        return args
+
+    def observe_speed(self, speed, profile):
+        """
+        Picks the encoder profile for the next ffmpeg we start from how fast one using profile ran: a faster one if
+        it's barely keeping ahead of playback, a better looking one if there's headroom.  The running ffmpeg is
+        left alone.
+        """
+        if not self.transcode_video or not speed: return
+        i = ENCODER_PROFILE_NAMES.index(profile)
+        if speed < SPEED_SAFETY_MARGIN:
+            i = max(0, i - 1)
+        elif speed > SPEED_HEADROOM:
+            i = min(len(ENCODER_PROFILES) - 1, i + 1)
+        if ENCODER_PROFILE_NAMES[i] != self.encoder_profile:
+            print('encoding %s at %.2fx realtime with %s, using %s next' % (
+                self.source_fn, speed, profile, ENCODER_PROFILE_NAMES[i]))
+            self.encoder_profile = ENCODER_PROFILE_NAMES[i]
+
+    def map_args(self):
+        args = ['-map', self.video_stream.index] if self.video_stream else []
+        if self.audio_stream:
+            args += ['-map', self.audio_stream.index]
+        return args
+
+    def transcode_cache_key(self):
+        """
+        Identifies the output of this transcode: the source file, the streams selected from it, the codecs the
+        device's capabilities called for and the encoder profile's quality settings (but not its thread count, which
+        doesn't change the output).  Devices needing the same conversion share a cache entry.
+        """
+        identity = file_identity(self.source_fn)
+        if not identity: return None
+        parts = [identity, self.map_args(), self.codec_args()]
+        if self.transcode_video:
+            profile = ENCODER_PROFILES[ENCODER_PROFILE_NAMES.index(self.encoder_profile)]
+            parts += [profile.preset, profile.crf]
+        key = json.dumps(parts)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def save_to_cache(self):
+        """ Rewrites the finished transcode with the moov atom up front, so it seeks well, and keeps it for next time """
+        tmp_fn = TRANSCODE_CACHE.tmp_path('.mp4')
+        cmd = ['ffmpeg', '-y', '-v', 'error', '-i', self.trans_fn, '-map', '0', '-c', 'copy', '-movflags', '+faststart',
+               '-f', 'mp4', tmp_fn]
+        try:
+            subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('not caching transcode of', self.source_fn, getattr(e, 'stderr', None) or e)
+            os.remove(tmp_fn)
+            return
+        print('cached transcode of', self.source_fn, 'as', TRANSCODE_CACHE.add(self.cache_key, '.mp4', tmp_fn))
+
+    def start(self, fake=False):
+        dir = '/var/tmp' if os.path.isdir('/var/tmp') else None
+        self.trans_fn = tempfile.mkstemp(suffix='.mp4', prefix='gnomecast_pid%i_transcode_' % os.getpid(), dir=dir)[1]
+        os.remove(self.trans_fn)
+
+        self.transcode_cmd = ['ffmpeg'] + (['-ss', '%.3f' % self.start_at] if self.start_at else [])
+        self.running_profile = self.encoder_profile
+        self.transcode_cmd += ['-i', self.source_fn] + self.map_args() + self.codec_args() + self.encoder_args()
+        # fragmented mp4 (moov up front, a fragment per keyframe) can be played while it's being written
+        self.transcode_cmd += ['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4']
+        self.transcode_cmd += [self.trans_fn]
+        logger.info(' '.join(["'%s'" % s if ' ' in s else s for s in self.transcode_cmd]))
+        if fake:
+            self.p = None
+            self.monitor()
+        else:
+            self.started_at = time.time()
+            self.p = subprocess.Popen(['ffmpeg', '-nostats', '-progress', 'pipe:1'] + self.transcode_cmd[1:],
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if self.nice:
+                self.renice(self.nice)  # not in a preexec_fn, which isn't safe to run with our other threads going
+            t = threading.Thread(target=self.monitor)
+            t.daemon = True
+            t.start()
+
     @property
     def fn(self):
         return self.trans_fn if self.transcode else self.source_fn
 
-    def can_play_video_codec(self, video_codec):
-        h265 = True
-        if self.cast.device.cast_type == 'audio': h265 = False
-        device_info = HARDWARE.get((self.cast.device.manufacturer, self.cast.device.model_name))
-        if device_info and device_info.h265 is not None:
-            h265 = device_info.h265
-        if h265:
-            return video_codec in ('h264', 'h265', 'hevc')
-        else:
-            return video_codec in ('h264',)
-
-    def can_play_audio_stream(self, stream):
-        if not stream: return True
-        device_info = HARDWARE.get((self.cast.device.manufacturer, self.cast.device.model_name))
-        ac3 = device_info.ac3 if device_info else None
-        if ac3:
-            return stream.codec in ('aac', 'mp3', 'ac3')
+    def plan_video(self):
+        stream = self.video_stream
+        if not stream: return None
+        if self.force_video: return StreamPlan(stream, 'h264', 'forced')
+        problem = self.capabilities.video_problem(stream)
+        return StreamPlan(stream, 'h264', problem) if problem else StreamPlan(stream)
+
+    def plan_audio(self):
+        stream = self.audio_stream
+        if not stream: return None
+        to = self.capabilities.audio_transcode_codec(stream)
+        if self.force_audio: return StreamPlan(stream, to, 'forced')
+        problem = self.capabilities.audio_problem(stream)
+        return StreamPlan(stream, to, problem) if problem else StreamPlan(stream)
+
+    def lead_bytes(self, lead_seconds):
+        """ How many bytes the transcode should be ahead by to cover lead_seconds of playback """
+        if self.progress_seconds > 1 and self.progress_bytes:
+            byte_rate = self.progress_bytes / self.progress_seconds  # measured on the output
+        elif self.fmd.bit_rate:
+            byte_rate = self.fmd.bit_rate / 8
         else:
-            return stream.codec in ('aac', 'mp3')
-
-    def wait_for_byte(self, offset, buffer=128 * 1024 * 1024):
-        if self.done: return
-        if self.source_fn.lower().split(".")[-1] == 'mp4':
-            while offset > self.progress_bytes + buffer:
-                print('waiting for', offset, 'at', self.progress_bytes + buffer)
-                time.sleep(2)
-        else:
-            while not self.done:
-                print('waiting for transcode to finish')
-                time.sleep(2)
-        print('done waiting')
+            return DEFAULT_LEAD_BYTES
+        return max(MIN_LEAD_BYTES, int(byte_rate * lead_seconds))
+
+    def byte_ready(self, offset, lead_seconds=30):
+        return self.done or self.error or self.progress_bytes >= offset + self.lead_bytes(lead_seconds)
+
+    def wait_for_byte(self, offset, lead_seconds=30):
+        with self.progress_cond:
+            if not self.byte_ready(offset, lead_seconds):
+                with METRICS.span('wait_for_byte', fn=self.source_fn, offset=offset):
+                    self.progress_cond.wait_for(lambda: self.byte_ready(offset, lead_seconds))
+
+    async def wait_for_byte_async(self, offset, lead_seconds=30):
+        await self.progress_cond.wait_for_async(lambda: self.byte_ready(offset, lead_seconds))
+
+    def follow(self, offset, chunk_size=256 * 1024):
+        """ Yields the transcoded file from offset on, following it as it grows until the transcode ends """
+        with open(self.fn, 'rb') as f:
+            f.seek(offset)
+            while True:
+                finished = self.done or self.error
+                data = f.read(chunk_size)
+                if data:
+                    self.served_byte()
+                    yield data
+                elif finished:
+                    return
+                else:
+                    with self.progress_cond:
+                        self.progress_cond.wait(1)
+
+    def region_for(self, seconds):
+        """
+        Returns the transcode to play from to reach seconds into the source: this one if it's (nearly) there,
+        an earlier region started by a previous seek, or a new transcode starting at seconds.
+        """
+        if not self.transcode or self.hls or self.done or self.error: return self
+        with self.regions_lock:
+            for region in [self] + self.regions:
+                if region.error or seconds < region.start_at: continue
+                if region.done or seconds <= region.start_at + region.progress_seconds + SEEK_RESTART_SECONDS:
+                    return region
+            print('seek to %.1fs is past transcode progress, starting another transcode there' % seconds)
+            region = Transcoder(self.cast, self.fmd, self.video_stream, self.audio_stream, None, self.error_callback,
+                                force_audio=self.force_audio, force_video=self.force_video, start_at=seconds,
+                                encoder_profile=self.encoder_profile)
+            self.regions.append(region)
+            if len(self.regions) > MAX_SEEK_REGIONS:
+                self.regions.pop(0).destroy()
+            return region
+
+    def region(self, start_at):
+        """ Returns the region starting at start_at, if we still have it """
+        if not start_at: return self
+        with self.regions_lock:
+            for region in self.regions:
+                if abs(region.start_at - start_at) < 0.001:
+                    return region
+
+    def served_byte(self):
+        if self.first_byte_served_at or not self.started_at: return
+        self.first_byte_served_at = time.time()
+        METRICS.record('first_byte_served', self.first_byte_served_at - self.started_at, fn=self.source_fn,
+                       start_at=self.start_at)
+
+    @property
+    def progress_bytes(self):
+        return self.progress.total_size
+
+    @property
+    def progress_seconds(self):
+        return self.progress.out_time
+
+    def read_log(self):
+        for line in self.p.stderr:
+            self.log.append(line.decode(errors='replace').rstrip())
 
     def monitor(self):
-        line = b''
-        r = re.compile(r'=\s+')
-        total_output = b''
-        while self.p:
-            byte = self.p.stdout.read(1)
-            total_output += byte
-            if byte == b'' and self.p.poll() != None:
-                break
-            if byte != b'':
-                line += byte
-                if byte == b'\r':
-                    # frame=92578 fps=3937 q=-1.0 size= 1142542kB time=01:04:21.14 bitrate=2424.1kbits/s speed= 164x
-                    line = line.decode()
-                    line = r.sub('=', line)
-                    items = [s.split('=') for s in line.split()]
-                    d = dict([x for x in items if len(x) == 2])
-                    print(d)
-                    self.progress_bytes = int(d.get('size', '0kb')[:-2]) * 1024
-                    self.progress_seconds = parse_ffmpeg_time(d.get('time', '00:00:00'))
-                    line = b''
         if self.p:
+            log_reader = threading.Thread(target=self.read_log)
+            log_reader.daemon = True
+            log_reader.start()
+            d = {}
+            for line in self.p.stdout:
+                key, _, value = line.decode(errors='replace').strip().partition('=')
+                d[key] = value
+                if key == 'progress':
+                    with self.progress_cond:
+                        self.progress = TranscodeProgress.from_ffmpeg(d)
+                        self.progress_cond.notify_all()
+                    if self.running_profile and self.progress.out_time > SPEED_WARMUP_SECONDS:
+                        self.observe_speed(self.progress.speed, self.running_profile)
+                    if self.progress.total_size and self.started_at and not self.first_fragment_at:
+                        self.first_fragment_at = time.time()
+                        METRICS.record('transcode_start', self.first_fragment_at - self.started_at,
+                                       fn=self.source_fn, start_at=self.start_at)
+                    d = {}
+            self.p.wait()
+            log_reader.join()
             self.p.stdout.close()
+            self.p.stderr.close()
             if self.p.returncode:
+                msg = '\n'.join(self.log)
+                with self.progress_cond:
+                    self.error = msg
+                    self.progress_cond.notify_all()
+                if self.destroyed: return
                 print('--== transcode error ==--')
-                print(total_output)
-                self.error_callback(total_output.decode())
+                print(msg)
+                self.error_callback(msg)
                 return
-        self.done = True
+        with self.progress_cond:
+            self.done = True
+            self.progress_cond.notify_all()
+        if self.p and self.cache_key:
+            t = threading.Thread(target=self.save_to_cache)
+            t.daemon = True
+            t.start()
         if self.done_callback:
             self.done_callback(did_transcode=True)
 
+    def pause(self):
+        """ Stops the ffmpeg process in its tracks, to give the cpu to a more urgent transcode """
+        if self.p and not self.paused and self.p.poll() is None:
+            self.p.send_signal(signal.SIGSTOP)
+            self.paused = True
+
+    def resume(self):
+        if self.p and self.paused:
+            self.paused = False
+            if self.p.poll() is None:
+                self.p.send_signal(signal.SIGCONT)
+
+    def renice(self, nice):
+        """
+        Changes the priority of the running ffmpegs.  Raising it again (a queued transcode becoming the playing one)
+        needs CAP_SYS_NICE, so returns False if the old priority had to stay - callers pause the others instead.
+        """
+        try:
+            for p in self.processes():
+                if p.poll() is None:
+                    os.setpriority(os.PRIO_PROCESS, p.pid, nice)
+        except OSError as e:
+            print('could not renice', self.source_fn, 'to', nice, e)
+            return False
+        self.nice = nice
+        return True
+
+    def processes(self):
+        return [self.p] if self.p else []
+
     def destroy(self):
+        with self.regions_lock:
+            for region in self.regions:
+                region.destroy()
+            self.regions = []
         if self.p and self.p.poll() is None:
+            self.destroyed = True
+            self.resume()
             self.p.terminate()
-        if self.trans_fn and os.path.isfile(self.trans_fn):
+        if self.trans_fn and not self.cached and os.path.isfile(self.trans_fn):
             os.remove(self.trans_fn)
 
     def __del__(self):
         self.destroy()
 
 
+class HLSTranscoder(Transcoder):
+    """
+    Transcodes into short HLS segments on demand instead of one linear file, so a seek only costs the segments
+    around the new position.  Segments are kept for the life of the transcoder and reused across seeks.
+    """
+
+    hls = True
+    segment_seconds = 6
+    prefetch = 3  # segments transcoded ahead of the last one requested
+
+    def start(self, fake=False):
+        dir = '/var/tmp' if os.path.isdir('/var/tmp') else None
+        self.trans_fn = tempfile.mkdtemp(prefix='gnomecast_pid%i_hls_' % os.getpid(), dir=dir)
+        self.segments = None  # [(start, duration)], once we know where the keyframes are
+        self.segment_locks = collections.defaultdict(threading.Lock)
+        self.segment_ps = {}
+        self.prefetch_from = 0
+        self.prefetch_cond = threading.Condition()
+        self.started_at = time.time()
+        if fake:
+            self.find_segments(keyframes=[])
+            return
+        t = threading.Thread(target=self.find_segments)
+        t.daemon = True
+        t.start()
+        t = threading.Thread(target=self.prefetch_segments)
+        t.daemon = True
+        t.start()
+
+    def find_segments(self, keyframes=None):
+        """ Splits the source into ~segment_seconds segments, starting each on a keyframe if we're copying video """
+        duration = self.fmd.duration
+        try:
+            if keyframes is None:
+                keyframes = self.source_keyframes()
+            if keyframes:
+                starts = [0.0]
+                for t in sorted(keyframes):
+                    if t - starts[-1] >= self.segment_seconds and t < duration:
+                        starts.append(t)
+            else:
+                starts = [float(t) for t in range(0, int(duration) + 1, self.segment_seconds) if t < duration] or [0.0]
+        except Exception as e:
+            msg = 'could not find the segments of %s: %s' % (self.source_fn, getattr(e, 'stderr', None) or e)
+            with self.progress_cond:
+                self.error = msg
+                self.progress_cond.notify_all()
+            if self.destroyed: return
+            print(msg)
+            self.error_callback(msg)
+            return
+        with self.progress_cond:
+            self.segments = [(start, end - start) for start, end in zip(starts, starts[1:] + [duration])]
+            self.progress_cond.notify_all()
+
+    def source_keyframes(self):
+        if self.transcode_video or not self.video_stream:
+            return []  # we encode a keyframe at the start of every segment anyway
+        return self.scan_keyframes()
+
+    def scan_keyframes(self):
+        """ The pts (in seconds) of every keyframe in the source's video stream """
+        output = subprocess.check_output(
+            ['ffprobe', '-v', 'error', '-select_streams', self.video_stream.index.split(':')[1],
+             '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', self.source_fn]).decode()
+        keyframes = []
+        for line in output.split('\n'):
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags and pts_time not in ('', 'N/A'):
+                keyframes.append(float(pts_time))
+        return keyframes
+
+    def wait_for_segments(self):
+        with self.progress_cond:
+            self.progress_cond.wait_for(lambda: self.segments is not None or self.error)
+        return self.segments or []
+
+    def playlist(self):
+        segments = self.wait_for_segments()
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-PLAYLIST-TYPE:VOD', '#EXT-X-MEDIA-SEQUENCE:0',
+                 '#EXT-X-TARGETDURATION:%i' % max([int(d + 0.999) for _, d in segments] or [self.segment_seconds])]
+        for i, (start, duration) in enumerate(segments):
+            lines += ['#EXTINF:%.3f,' % duration, '%i.ts' % i]
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def segment_fn(self, n):
+        return os.path.join(self.trans_fn, '%i.ts' % n)
+
+    def segment_cmd(self, n, out_fn):
+        start, duration = self.segments[n]
+        return ['ffmpeg', '-y', '-v', 'error', '-ss', '%.3f' % start, '-i', self.source_fn, '-t', '%.3f' % duration] + \
+               self.map_args() + self.codec_args() + self.encoder_args() + \
+               ['-output_ts_offset', '%.3f' % start, '-f', 'mpegts', out_fn]
+
+    def segment(self, n, requested=True):
+        """ Returns the filename of segment n, transcoding it first if needed """
+        segments = self.wait_for_segments()
+        if not 0 <= n < len(segments): return None
+        if requested:
+            with self.prefetch_cond:
+                self.prefetch_from = n + 1
+                self.prefetch_cond.notify_all()
+        fn = self.segment_fn(n)
+        with self.segment_locks[n]:
+            if not os.path.isfile(fn) and not self.destroyed:
+                tmp_fn = fn + '.tmp'
+                profile, started_at = self.encoder_profile, time.time()
+                self.segment_ps[n] = p = subprocess.Popen(self.segment_cmd(n, tmp_fn), stderr=subprocess.PIPE)
+                if self.nice:
+                    with contextlib.suppress(OSError):  # it may have finished already
+                        os.setpriority(os.PRIO_PROCESS, p.pid, self.nice)
+                _, err = p.communicate()
+                del self.segment_ps[n]
+                if p.returncode:
+                    if not self.destroyed:
+                        print('--== segment %i transcode error ==--' % n)
+                        print(err.decode(errors='replace'))
+                    return None
+                os.replace(tmp_fn, fn)
+                self.observe_speed(self.segment_speed(segments[n][1], time.time() - started_at), profile)
+                self.segment_done()
+        if requested:
+            self.served_byte()
+        return fn
+
+    def segment_speed(self, duration, elapsed):
+        """ How many times realtime we're transcoding at, going by how long one segment took """
+        return duration / max(elapsed, 0.001)
+
+    def segment_done(self):
+        segments = self.segments
+        finished = [os.path.isfile(self.segment_fn(i)) for i in range(len(segments))]
+        with self.progress_cond:
+            self.progress = TranscodeProgress(
+                out_time=sum(d for (_, d), f in zip(segments, finished) if f),
+                total_size=sum(os.path.getsize(self.segment_fn(i)) for i, f in enumerate(finished) if f))
+            self.done = all(finished)
+            self.progress_cond.notify_all()
+        if self.done and self.done_callback:
+            self.done_callback(did_transcode=True)
+
+    def prefetch_segments(self):
+        segments = self.wait_for_segments()
+        while not self.destroyed and not self.done:
+            with self.prefetch_cond:
+                todo = [i for i in range(self.prefetch_from, min(self.prefetch_from + self.prefetch, len(segments)))
+                        if not os.path.isfile(self.segment_fn(i))]
+                if not todo:
+                    self.prefetch_cond.wait()
+                    continue
+            self.segment(todo[0], requested=False)
+
+    def processes(self):
+        if not self.transcode: return []
+        return Transcoder.processes(self) + list(self.segment_ps.values())
+
+    def destroy(self):
+        if not self.transcode: return
+        self.destroyed = True
+        for p in list(self.segment_ps.values()):
+            if p.poll() is None:
+                p.terminate()
+        with self.prefetch_cond:
+            self.prefetch_cond.notify_all()
+        if self.trans_fn and os.path.isdir(self.trans_fn):
+            shutil.rmtree(self.trans_fn, ignore_errors=True)
+
+
+class ChunkedTranscoder(HLSTranscoder):
+    """
+    Splits the source at keyframes into ~segment_seconds chunks and transcodes several of them at once, for sources
+    one ffmpeg can't transcode in realtime.  Finished chunks are piped in order into an ffmpeg that copies them into
+    the same growing fragmented mp4 Transcoder serves, so playback can start as soon as the first chunk is done.
+    """
+
+    hls = False
+    segment_seconds = 30
+    workers = max(1, (os.cpu_count() or 2) // 2)  # ffmpeg processes encoding chunks at once
+
+    def start(self, fake=False):
+        dir = '/var/tmp' if os.path.isdir('/var/tmp') else None
+        self.chunk_dir = tempfile.mkdtemp(prefix='gnomecast_pid%i_chunks_' % os.getpid(), dir=dir)
+        self.trans_fn = tempfile.mkstemp(suffix='.mp4', prefix='gnomecast_pid%i_transcode_' % os.getpid(), dir=dir)[1]
+        os.remove(self.trans_fn)
+        if not self.threads:
+            self.threads = max(1, (os.cpu_count() or 2) // self.workers)
+        self.segments = None  # [(start, duration)] of each chunk
+        self.segment_locks = collections.defaultdict(threading.Lock)
+        self.segment_ps = {}
+        self.prefetch_cond = threading.Condition()
+        self.started_at = time.time()
+        self.transcode_cmd = ['ffmpeg', '-f', 'mpegts', '-i', 'pipe:0', '-map', '0', '-c', 'copy',
+                              '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', self.trans_fn]
+        if fake:
+            self.p = None
+            self.find_segments(keyframes=[])
+            return
+        self.p = subprocess.Popen(['ffmpeg', '-nostats', '-progress', 'pipe:1'] + self.transcode_cmd[1:],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for target in (self.monitor, self.find_segments, self.stitch):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def source_keyframes(self):
+        return self.scan_keyframes() if self.video_stream else []
+
+    def segment_fn(self, n):
+        return os.path.join(self.chunk_dir, '%i.ts' % n)
+
+    def segment_speed(self, duration, elapsed):
+        return self.workers * duration / max(elapsed, 0.001)  # the chunks are transcoded side by side
+
+    def segment_done(self):
+        pass  # progress comes from the stitching ffmpeg, via monitor()
+
+    def stitch(self):
+        """ Transcodes the chunks, earliest first, feeding each to the stitching ffmpeg once all before it are in """
+        segments = self.wait_for_segments()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)  # each thread drives one ffmpeg
+        futures = [pool.submit(self.segment, n, False) for n in range(len(segments))]  # runs in submission order
+        try:
+            for n, future in enumerate(futures):
+                fn = future.result()
+                if self.destroyed: return
+                if not fn:
+                    self.log.append('transcoding chunk %i of %s failed' % (n, self.source_fn))
+                    self.p.kill()
+                    return
+                with open(fn, 'rb') as f:
+                    shutil.copyfileobj(f, self.p.stdin)
+                os.remove(fn)
+        except OSError as e:  # the stitcher died, monitor() reports it
+            print('stitching', self.source_fn, 'stopped:', e)
+        finally:
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+            try:
+                self.p.stdin.close()
+            except OSError:
+                pass
+
+    def destroy(self):
+        if not self.transcode or self.cached:
+            return Transcoder.destroy(self)
+        HLSTranscoder.destroy(self)  # stops the chunk transcodes
+        shutil.rmtree(self.chunk_dir, ignore_errors=True)
+        Transcoder.destroy(self)  # and the stitcher
+
+
+def parse_start(value):
+    """ The seconds into the source a ?start= query asks for, or None if it isn't a usable number """
+    try:
+        start = float(value or 0)
+    except ValueError:
+        return None
+    return start if 0 <= start < float('inf') else None
+
+
+def parse_byte_ranges(header, size=None):
+    """
+    Parses a Range header into [(start, end)] (end exclusive), clipped to size if it's known.  Returns None if
+    there's no usable header, so the whole thing should be sent, and [] if none of the ranges can be satisfied.
+    """
+    if not header or not header.strip().startswith('bytes='): return None
+    ranges = []
+    for spec in header.strip()[len('bytes='):].split(','):
+        start, sep, end = spec.strip().partition('-')
+        try:
+            if not sep: return None
+            if not start:  # the last n bytes
+                if size is None or not end: return None
+                ranges.append((max(0, size - int(end)), size))
+                continue
+            start = int(start)
+            end = int(end) + 1 if end else size
+        except ValueError:
+            return None
+        if size is not None:
+            end = min(end, size) if end is not None else size
+            if start >= size: continue
+        if end is not None and end <= start: continue
+        ranges.append((start, end))
+    return ranges
+
+
+class MediaServer(object):
+    """
+    Serves /media/ from an asyncio loop on its own thread: single and multiple byte ranges, HEAD, keep-alive and
+    zero-copy os.sendfile() transfers.  Waiting for a transcode to get far enough doesn't tie up a thread.  Every
+    other path is handed to a WSGI app (the bottle app) on a thread pool.
+    """
+
+    def __init__(self, host, port, get_transcoder, app=None, max_connections=64):
+        self.host = host
+        self.port = port
+        self.get_transcoder = get_transcoder  # start seconds -> Transcoder (or None)
+        self.app = app
+        self.max_connections = max_connections
+        self.loop = None
+        self.server = None
+        self.started = threading.Event()
+
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start())
+        try:
+            self.loop.run_forever()
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    def start_in_thread(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        self.started.wait()
+        return t
+
+    async def start(self):
+        self.connections = asyncio.Semaphore(self.max_connections)
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started.set()
+
+    def stop(self):
+        def f():
+            self.server.close()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(f)
+
+    async def handle(self, reader, writer):
+        async with self.connections:
+            try:
+                while True:
+                    try:
+                        head = await reader.readuntil(b'\r\n\r\n')
+                    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                        return
+                    lines = head.decode('latin-1').split('\r\n')
+                    method, target, version = (lines[0].split(' ') + ['', ''])[:3]
+                    headers = {}
+                    for line in lines[1:]:
+                        name, sep, value = line.partition(':')
+                        if sep:
+                            headers[name.strip().lower()] = value.strip()
+                    if int(headers.get('content-length') or 0):
+                        await reader.readexactly(int(headers['content-length']))
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                    path, _, query = target.partition('?')
+                    if path.startswith('/media/'):
+                        keep_alive = await self.media(writer, method, path, query, headers, keep_alive)
+                    else:
+                        await self.wsgi(writer, method, path, query, version, headers, keep_alive)
+                    if not keep_alive: return
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            finally:
+                writer.close()
+
+    async def write_head(self, writer, status, headers, keep_alive):
+        headers = [('Access-Control-Allow-Origin', '*'), ('Access-Control-Allow-Methods', 'GET, HEAD'),
+                   ('Access-Control-Allow-Headers', 'Content-Type'),
+                   ('Connection', 'keep-alive' if keep_alive else 'close')] + headers
+        lines = ['HTTP/1.1 %s' % status] + ['%s: %s' % header for header in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def error(self, writer, status, keep_alive):
+        body = status.encode()
+        await self.write_head(writer, status, [('Content-Type', 'text/plain'), ('Content-Length', len(body))],
+                              keep_alive)
+        writer.write(body)
+        await writer.drain()
+
+    async def sendfile(self, writer, f, offset, count, media_id):
+        if count <= 0: return
+        sent = await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+        METRICS.count('bytes_served', media_id, sent)
+
+    async def media(self, writer, method, path, query, headers, keep_alive):
+        """ Answers a request for the transcode, returning whether the connection can be kept open """
+        media_id = os.path.basename(path).split('.')[0]
+        METRICS.count('requests', media_id)
+        start = parse_start(urllib.parse.parse_qs(query).get('start', ['0'])[0])
+        if start is None:
+            await self.error(writer, '400 Bad Request', keep_alive)
+            return keep_alive
+        transcoder = self.get_transcoder(start)
+        if not transcoder:
+            await self.error(writer, '404 Not Found', keep_alive)
+            return keep_alive
+        ranges = parse_byte_ranges(headers.get('range'))
+        await transcoder.wait_for_byte_async(ranges[0][0] if ranges else 0)
+        if transcoder.error:
+            await self.error(writer, '500 Internal Server Error', keep_alive)
+            return keep_alive
+        content_type = 'video/mp4' if transcoder.transcode else \
+            mimetypes.guess_type(transcoder.fn)[0] or 'application/octet-stream'
+        with open(transcoder.fn, 'rb') as f:
+            if transcoder.done:
+                size = os.fstat(f.fileno()).st_size
+                ranges = parse_byte_ranges(headers.get('range'), size)
+                await self.send_ranges(writer, method, f, size, ranges, content_type, keep_alive, media_id)
+                transcoder.served_byte()
+                return keep_alive
+            if ranges and (ranges[0][0] or ranges[0][1] is not None):
+                # still growing, so we don't know the total length yet
+                offset, end = ranges[0]
+                available = os.fstat(f.fileno()).st_size
+                end = min(end or available, available)
+                await self.write_head(writer, '206 Partial Content', [
+                    ('Content-Type', content_type), ('Content-Length', max(0, end - offset)),
+                    ('Content-Range', 'bytes %i-%i/*' % (offset, end - 1))], keep_alive)
+                if method != 'HEAD' and end > offset:
+                    await self.sendfile(writer, f, offset, end - offset, media_id)
+                transcoder.served_byte()
+                return keep_alive
+            await self.write_head(writer, '200 OK', [('Content-Type', content_type)], False)
+            if method != 'HEAD':
+                await self.follow(writer, transcoder, f, media_id)
+            return False  # the end of the body is the end of the connection
+
+    async def send_ranges(self, writer, method, f, size, ranges, content_type, keep_alive, media_id):
+        if ranges is None:
+            await self.write_head(writer, '200 OK', [('Content-Type', content_type), ('Content-Length', size),
+                                                     ('Accept-Ranges', 'bytes')], keep_alive)
+            parts = [(None, 0, size)]
+        elif not ranges:
+            await self.write_head(writer, '416 Range Not Satisfiable', [('Content-Range', 'bytes */%i' % size),
+                                                                        ('Content-Length', 0)], keep_alive)
+            return
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            await self.write_head(writer, '206 Partial Content', [
+                ('Content-Type', content_type), ('Content-Length', end - start), ('Accept-Ranges', 'bytes'),
+                ('Content-Range', 'bytes %i-%i/%i' % (start, end - 1, size))], keep_alive)
+            parts = [(None, start, end)]
+        else:
+            boundary = 'gnomecast%s' % hashlib.sha1(os.urandom(8)).hexdigest()[:16]
+            parts = [(('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %i-%i/%i\r\n\r\n' % (
+                boundary, content_type, start, end - 1, size)).encode(), start, end) for start, end in ranges]
+            tail = ('\r\n--%s--\r\n' % boundary).encode()
+            length = sum(len(head) + end - start for head, start, end in parts) + 2 * (len(parts) - 1) + len(tail)
+            await self.write_head(writer, '206 Partial Content', [
+                ('Content-Type', 'multipart/byteranges; boundary=%s' % boundary), ('Content-Length', length),
+                ('Accept-Ranges', 'bytes')], keep_alive)
+        if method == 'HEAD': return
+        for i, (head, start, end) in enumerate(parts):
+            if head:
+                writer.write((b'\r\n' if i else b'') + head)
+            await self.sendfile(writer, f, start, end - start, media_id)
+        if len(parts) > 1:
+            writer.write(tail)
+        await writer.drain()
+
+    async def follow(self, writer, transcoder, f, media_id):
+        """ Sends the transcode from the start, following it as it grows until the transcode ends """
+        offset = 0
+        while True:
+            finished = transcoder.done or transcoder.error
+            available = os.fstat(f.fileno()).st_size
+            if available > offset:
+                await self.sendfile(writer, f, offset, available - offset, media_id)
+                offset = available
+                transcoder.served_byte()
+            elif finished:
+                return
+            else:
+                await transcoder.progress_cond.wait_for_async(
+                    lambda: transcoder.done or transcoder.error or transcoder.progress_bytes > offset)
+
+    async def wsgi(self, writer, method, path, query, version, headers, keep_alive):
+        environ = {
+            'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': urllib.parse.unquote(path),
+            'QUERY_STRING': query, 'SERVER_NAME': self.host or '', 'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version, 'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.multithread': True,
+            'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            environ[key if key in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + key] = value
+
+        def call_app():
+            response = []
+
+            def start_response(status, response_headers, exc_info=None):
+                response[:] = [status, response_headers]
+
+            body = self.app(environ, start_response) if self.app else None
+            if body is None:
+                return '404 Not Found', [], b''
+            try:
+                return response[0], response[1], b''.join(body)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+
+        status, response_headers, body = await asyncio.get_running_loop().run_in_executor(None, call_app)
+        ours = ('content-length', 'connection', 'access-control-allow-origin', 'access-control-allow-methods',
+                'access-control-allow-headers')
+        response_headers = [(k, v) for k, v in response_headers if k.lower() not in ours]
+        await self.write_head(writer, status, response_headers + [('Content-Length', len(body))], keep_alive)
+        if method != 'HEAD':
+            writer.write(body)
+            await writer.drain()
+
+
+CAST_DISCOVERY_TIMEOUT = 10  # seconds to wait for a device asked for by name to turn up
+
+
+class CastDiscovery(object):
+    """
+    A zeroconf browser running for the life of the process, telling listeners about each cast device as it appears
+    and disappears.  The devices last seen are kept in DEVICE_CACHE, so they're offered straight away on the next start
+    (and connected to by host) without waiting for the network.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.devices = {}  # uuid -> {uuid, friendly_name, host, port, model_name, manufacturer, cast_type}
+        self.casts = {}  # uuid -> pychromecast.Chromecast, so a device is only connected to once
+        self.listeners = []  # (on_add(device), on_remove(device))
+        self.browser = None
+        self.zconf = None
+        for device in DEVICE_CACHE.get_json('known') or []:
+            self.devices[device['uuid']] = device
+
+    def known(self):
+        with self.cond:
+            return sorted(self.devices.values(), key=lambda device: device['friendly_name'] or '')
+
+    def listen(self, on_add, on_remove):
+        self.listeners.append((on_add, on_remove))
+
+    def start(self):
+        with self.cond:
+            if self.browser: return
+            import_pychromecast()
+            import zeroconf
+            self.zconf = zeroconf.Zeroconf()
+            self.browser = pychromecast.discovery.CastBrowser(
+                pychromecast.discovery.SimpleCastListener(self.add, self.remove, self.add), self.zconf)
+        self.browser.start_discovery()
+
+    def stop(self):
+        with self.cond:
+            browser, zconf = self.browser, self.zconf
+            self.browser = self.zconf = None
+        if browser:
+            browser.stop_discovery()
+            zconf.close()
+
+    def restart(self):
+        """ A fresh sweep of the network, for the refresh button """
+        self.stop()
+        self.start()
+
+    def add(self, id, service):
+        """ CastBrowser callback, for both new and updated devices """
+        browser = self.browser
+        info = browser.devices.get(id) if browser else None
+        if not info: return
+        device = {'uuid': str(id), 'friendly_name': info.friendly_name, 'host': info.host, 'port': info.port,
+                  'model_name': info.model_name, 'manufacturer': info.manufacturer, 'cast_type': info.cast_type}
+        with self.cond:
+            if self.devices.get(device['uuid']) == device: return
+            self.devices[device['uuid']] = device
+            self.cond.notify_all()
+        self.save()
+        for on_add, on_remove in self.listeners:
+            on_add(device)
+
+    def remove(self, id, service, info):
+        with self.cond:
+            device = self.devices.pop(str(id), None)
+            self.casts.pop(str(id), None)
+        if not device: return
+        self.save()
+        for on_add, on_remove in self.listeners:
+            on_remove(device)
+
+    def save(self):
+        DEVICE_CACHE.put_json('known', self.known())
+
+    def find(self, name, timeout=CAST_DISCOVERY_TIMEOUT):
+        """ The device called name: straight from the cache if it's there, otherwise once discovery finds it """
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                for device in self.devices.values():
+                    if device['friendly_name'] == name:
+                        return device
+                if self.browser is None or time.time() >= deadline: break
+                self.cond.wait(deadline - time.time())
+        if self.browser is None:
+            self.start()
+            return self.find(name, max(0, deadline - time.time()))
+        return None
+
+    def connect(self, device):
+        """ Returns a Chromecast for a device from known() - by its zeroconf service if discovery has seen it """
+        with self.cond:
+            cast = self.casts.get(device['uuid'])
+            if cast: return cast
+            import_pychromecast()
+            info = self.browser.devices.get(uuid.UUID(device['uuid'])) if self.browser else None
+            if info:
+                cast = pychromecast.get_chromecast_from_cast_info(info, self.zconf)
+            else:
+                cast = pychromecast.get_chromecast_from_host((device['host'], device['port'], uuid.UUID(device['uuid']),
+                                                              device['model_name'], device['friendly_name']))
+            self.casts[device['uuid']] = cast
+            return cast
+
+
+SCRUBBER_INTERVAL_MS = 250  # how often the scrubber moves while playing
+
+
+class CastStatusListener(object):
+    """ Passes a cast's media status updates (arriving on pychromecast's socket thread) to the GTK main loop """
+
+    def __init__(self, caster, cast):
+        self.caster = caster
+        self.cast = cast
+
+    def new_media_status(self, status):
+        GLib.idle_add(self.caster.on_media_status, self.cast, status)
+
+    def load_media_failed(self, queue_item_id, error_code):
+        logger.warning('the device failed to load media (queue item %s, error code %s)', queue_item_id, error_code)
+
+
 class Gnomecast(object):
 
     def __init__(self):
-        self.ip = (([ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if not ip.startswith("127.")] or [
-            [(s.connect(("8.8.8.8", 53)), s.getsockname()[0], s.close()) for s in
-             [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]]) + [None])[0]
+        self._ip = None  # looked up on first use, see ip
         with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
             s.bind(('0.0.0.0', 0))
             self.port = s.getsockname()[1]
-        self.app = bottle.Bottle()
+        self.app = None
+        self.probe_scheduler = ProbeScheduler()
+        self.discovery = CastDiscovery()
+        self.wanted_device = None  # from -d, selected as soon as it's found
+        self.hls = False
+        self.parallel_chunks = False
+        self.server = 'asyncio'  # or 'paste', the old thread per request server
+        self.encoder_profile = DEFAULT_ENCODER_PROFILE
+        self.lookahead = 2  # queued files to transcode ahead of the one playing
+        self.transcode_threads = os.cpu_count() or 2  # shared by the lookahead transcodes
         self.cast = None
         self.last_known_player_state = None
         self.last_known_current_time = None
@@ -425,36 +2048,228 @@ class Gnomecast(object):
         self.duration = None
         self.subtitles = None
         self.seeking = False
+        self.time_offset = 0  # where in the file the transcode region being played starts
+        self.play_requested_at = None  # for timing how long until the device is PLAYING
         self.last_known_volume_level = None
-        bus = dbus.SessionBus() if DBUS_AVAILABLE else None
-        self.saver_interface = find_screensaver_dbus_iface(bus)
+        self.watched_casts = set()  # casts we've registered a CastStatusListener with
+        self.scrubber_timer = None  # GLib source moving the scrubber, while PLAYING
+        self.transcode_timer = None  # GLib source updating transcode progress, while anything's transcoding
+        self.saver_interface = None  # found on the first inhibit_screensaver()
         self.inhibit_screensaver_cookie = None
         self.autoplay = False
+        self.startup_report = False
 
-    def run(self, fn=None, device=None, subtitles=None):
+    @property
+    def ip(self):
+        """ The address the Chromecast fetches media from - resolving it can block, so not until it's needed """
+        if self._ip is None:
+            self._ip = (([ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if not ip.startswith("127.")]
+                         or [[(s.connect(("8.8.8.8", 53)), s.getsockname()[0], s.close()) for s in
+                              [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]]) + [None])[0]
+        return self._ip
+
+    @ip.setter
+    def ip(self, ip):
+        self._ip = ip
+
+    def configure(self, probe_workers=None, hls=False, transcode_cache=None, transcode_cache_size=None, lookahead=None,
+                  transcode_threads=None, parallel_chunks=False, chunk_workers=None, encoder_profile=None, server=None,
+                  metrics_log=None):
+        """ Applies the command line options shared by the GUI and --headless """
+        if metrics_log:
+            METRICS.sinks.append(file_sink(metrics_log))
+        if server:
+            if server not in ('asyncio', 'paste'):
+                print('ERROR: --server must be asyncio or paste')
+                sys.exit(1)
+            self.server = server
+        if probe_workers:
+            self.probe_scheduler.workers = int(probe_workers)
+        if encoder_profile:
+            if encoder_profile not in ENCODER_PROFILE_NAMES:
+                print('ERROR: --encoder-profile must be one of', ', '.join(ENCODER_PROFILE_NAMES))
+                sys.exit(1)
+            self.encoder_profile = encoder_profile
+        if chunk_workers:
+            try:
+                ChunkedTranscoder.workers = max(1, int(chunk_workers))
+            except ValueError:
+                print('ignoring bad --chunk-workers', repr(chunk_workers), 'using', ChunkedTranscoder.workers)
+        self.parallel_chunks = bool(parallel_chunks or chunk_workers)
+        if lookahead is not None:
+            self.lookahead = int(lookahead)
+        if transcode_threads:
+            self.transcode_threads = int(transcode_threads)
+        if transcode_cache:
+            TRANSCODE_CACHE.root = os.path.expanduser(transcode_cache)
+        if transcode_cache_size:
+            TRANSCODE_CACHE.max_bytes = int(float(transcode_cache_size) * 1024 * 1024 * 1024)
+            TRANSCODE_CACHE.evict()
+        self.hls = bool(hls)
+
+    def run(self, *fns, device=None, subtitles=None, startup_report=False, **options):
+        """ Starts the GUI with fns queued, the first selected, and the subtitles (if any) for it """
+        self.configure(**options)
+        self.startup_report = startup_report
         self.build_gui()
+        STARTUP.mark('build_gui')
+        self.first_draw_handler = self.win.connect('draw', self.on_first_draw)
         self.init_casts(device=device)
         threading.Thread(target=self.check_ffmpeg).start()
         t = threading.Thread(target=self.start_server)
         t.daemon = True
         t.start()
-        t = threading.Thread(target=self.monitor_cast)
-        t.daemon = True
-        t.start()
-        if fn:
-            self.queue_files([fn])
+        if fns:
+            self.queue_files(list(fns))
         if subtitles:
             self.select_subtitles_file(subtitles)
-        if fn and subtitles:
+        if fns and subtitles:
             self.autoplay = True
         Gtk.main()
 
+    def on_first_draw(self, widget, cr):
+        self.win.disconnect(self.first_draw_handler)
+        STARTUP.mark('first_draw')
+        report = STARTUP.report()
+        METRICS.record('startup', report['total'], **{k: v for k, v in report.items() if k != 'total'})
+        if self.startup_report:
+            # for bench_gnomecast.py: report the time to the first draw and quit
+            print('startup report:', json.dumps(report, sort_keys=True))
+            GLib.idle_add(self.quit)
+        return False
+
+    def cast_headless(self, *fns, device=None, subtitles=None, **options):
+        """
+        Casts fns, one after the other, to the Chromecast named device without the GUI (GTK is never imported),
+        reporting progress on stdout.  Returns the exit status: 0 if everything played to the end, 1 if a file
+        couldn't be probed, transcoded or played, 2 for bad arguments or a missing device and 130 if interrupted.
+        """
+        self.configure(**options)
+        if not fns or not device:
+            print('ERROR: --headless needs a media file (or several) and -d <chromecast_name>')
+            return 2
+        for fn in fns:
+            if not os.path.isfile(fn):
+                print('ERROR: file not found:', fn)
+                return 2
+        vtt = None
+        if subtitles:
+            try:
+                vtt = convert_subtitles(subtitles)
+            except Exception as e:
+                print('ERROR: could not read subtitles file %s: %s' % (subtitles, e))
+                return 2
+        fmds = [FileMetadata(os.path.abspath(fn), scheduler=self.probe_scheduler) for fn in fns]
+        print('looking for', device)
+        cast_device = self.discovery.find(device)
+        self.cast = self.discovery.connect(cast_device) if cast_device else None
+        if not self.cast:
+            print("ERROR: the Chromecast '%s' wasn't found" % device)
+            return 2
+        self.cast.wait()
+        t = threading.Thread(target=self.start_server)
+        t.daemon = True
+        t.start()
+        for i in range(100):  # the device fetches the media as soon as it's told to play it
+            with contextlib.suppress(OSError):
+                socket.create_connection((self.ip, self.port), 0.1).close()
+                break
+            time.sleep(0.1)
+        transcoders = {}
+        status = 0
+        try:
+            for i, fmd in enumerate(fmds):
+                label = '[%i/%i] %s' % (i + 1, len(fmds), os.path.basename(fmd.fn))
+                while not fmd.ready and not fmd.error:
+                    time.sleep(0.1)
+                if fmd.error:
+                    print('%s: ERROR: could not probe: %s' % (label, fmd.error))
+                    status = 1
+                    continue
+                transcoder = transcoders.get(i)
+                if not transcoder or transcoder.error:
+                    transcoder = self.transcoder_class(fmd)(
+                        self.cast, fmd, fmd.video_streams[0] if fmd.video_streams else None,
+                        fmd.audio_streams[0] if fmd.audio_streams else None, lambda did_transcode=None: None,
+                        lambda msg: None, transcoder, encoder_profile=self.learned_encoder_profile())
+                else:
+                    transcoder.renice(0)  # transcoded ahead, it's the one playing now
+                    transcoder.resume()
+                transcoders[i] = transcoder
+                self.subtitles = vtt if i == 0 else None
+                idle_reason = self.play_headless(fmd, transcoder, label, fmds[i + 1:i + 1 + self.lookahead],
+                                                 transcoders, i + 1)
+                transcoders.pop(i).destroy()
+                if idle_reason != 'FINISHED':
+                    status = 1
+                if idle_reason in ('CANCELLED', 'INTERRUPTED'):
+                    print('%s: playback was taken over on the device, giving up' % label)
+                    break
+        except KeyboardInterrupt:
+            print('interrupted')
+            self.cast.media_controller.stop()
+            status = 130
+        finally:
+            for transcoder in transcoders.values():
+                transcoder.destroy()
+            self.cast.disconnect()
+            self.discovery.stop()
+        return status
+
+    def play_headless(self, fmd, transcoder, label, next_fmds, transcoders, next_index):
+        """
+        Plays one file for cast_headless(), transcoding next_fmds ahead (niced, into transcoders from next_index on)
+        once this file's own transcode is done.  Returns how the device went idle: FINISHED, ERROR, CANCELLED or
+        INTERRUPTED, or TRANSCODE_ERROR if the transcode failed.
+        """
+        self.fn, self.transcoder, self.duration = fmd.fn, transcoder, fmd.duration
+        self.video_stream, self.audio_stream = transcoder.video_stream, transcoder.audio_stream
+        mc = self.cast.media_controller
+        self.play_media(0)
+        print('%s: %s' % (label, transcoder.plan.action))
+        started = False
+        last_state = last_report = None
+        while True:
+            time.sleep(0.25)
+            if transcoder.error:
+                print('%s: ERROR transcoding (see the ffmpeg output above)' % label)
+                mc.stop()
+                return 'TRANSCODE_ERROR'
+            state = mc.status.player_state
+            if str(hash(fmd.fn)) not in (mc.status.content_id or ''):
+                continue  # still the status of whatever the device was doing before
+            if state in ('BUFFERING', 'PLAYING', 'PAUSED'):
+                started = True
+            if state == 'PLAYING' and self.play_requested_at:
+                METRICS.record('time_to_playing', time.time() - self.play_requested_at, fn=self.fn)
+                self.play_requested_at = None
+            if state == 'IDLE' and started:
+                print('%s: %s' % (label, mc.status.idle_reason))
+                return mc.status.idle_reason
+            if transcoder.done:
+                threads = max(1, self.transcode_threads // max(1, len(next_fmds)))
+                for i, next_fmd in enumerate(next_fmds, next_index):
+                    if i in transcoders or not next_fmd.ready or next_fmd.error: continue
+                    transcoders[i] = self.transcoder_class(next_fmd)(
+                        self.cast, next_fmd, next_fmd.video_streams[0] if next_fmd.video_streams else None,
+                        next_fmd.audio_streams[0] if next_fmd.audio_streams else None,
+                        lambda did_transcode=None: None, lambda msg: None,
+                        threads=threads, nice=LOOKAHEAD_NICE, encoder_profile=self.learned_encoder_profile())
+            self.share_cpu(transcoder, [transcoders.get(i) for i in range(next_index, next_index + len(next_fmds))])
+            if state != last_state or time.time() - last_report >= HEADLESS_REPORT_SECONDS:
+                progress = '%s %s' % (state, self.humanize_seconds(self.time_offset + (mc.status.current_time or 0)))
+                if fmd.duration:
+                    progress += ' / %s' % self.humanize_seconds(fmd.duration)
+                if transcoder.transcode and not transcoder.done and fmd.duration:
+                    progress += ', transcoded %i%%' % (transcoder.progress_seconds * 100 // fmd.duration)
+                print('%s: %s' % (label, progress))
+                last_state, last_report = state, time.time()
+
     def check_ffmpeg(self):
         time.sleep(1)
         ffmpeg_available = True
-        print('check_ffmpeg')
         try:
-            print(subprocess.check_output(['which', 'ffmpeg']))
+            subprocess.check_output(['which', 'ffmpeg'])
         except Exception as e:
             print(e, e.output)
             ffmpeg_available = False
@@ -471,7 +2286,8 @@ class Gnomecast(object):
             GLib.idle_add(f)
 
     def start_server(self):
-        app = self.app
+        import_bottle()
+        self.app = app = bottle.Bottle()
 
         @app.route('/subtitles.vtt')
         def subtitles():
@@ -485,19 +2301,85 @@ class Gnomecast(object):
 
         @app.get('/media/<id>.<ext>')
         def video(id, ext):
-            print(list(bottle.request.headers.items()))
-            ranges = list(bottle.parse_range_header(bottle.request.environ['HTTP_RANGE'], 1000000000000))
-            print('ranges', ranges)
-            offset, end = ranges[0]
-            self.transcoder.wait_for_byte(offset)
-            response = bottle.static_file(self.transcoder.fn, root='/')
-            if 'Last-Modified' in response.headers:
-                del response.headers['Last-Modified']
+            METRICS.count('requests', id)
+            ranges = list(bottle.parse_range_header(bottle.request.environ.get('HTTP_RANGE', ''), 1000000000000))
+            offset, end = ranges[0] if ranges else (0, 1000000000000)
+            start = parse_start(bottle.request.query.get('start'))
+            if start is None:
+                return bottle.HTTPError(400, 'bad start')
+            transcoder = self.transcoder and self.transcoder.region(start)
+            if not transcoder:
+                return bottle.HTTPError(404, 'no transcode, or its region is gone')
+            transcoder.wait_for_byte(offset)
+            if transcoder.error:
+                return bottle.HTTPError(500, 'transcode failed')
+            if transcoder.done:
+                response = bottle.static_file(transcoder.fn, root='/')
+                if 'Last-Modified' in response.headers:
+                    del response.headers['Last-Modified']
+                METRICS.count('bytes_served', id, int(response.headers.get('Content-Length') or 0))
+            elif offset or end < 1000000000000:
+                # still growing, so we don't know the total length yet
+                available = os.path.getsize(transcoder.fn)
+                end = min(end, available)
+                with open(transcoder.fn, 'rb') as f:
+                    f.seek(offset)
+                    body = f.read(end - offset)
+                transcoder.served_byte()
+                METRICS.count('bytes_served', id, len(body))
+                response = bottle.HTTPResponse(body, status=206)
+                response.headers['Content-Range'] = 'bytes %i-%i/*' % (offset, end - 1)
+                response.headers['Content-Type'] = 'video/mp4'
+            else:
+                def follow():
+                    for data in transcoder.follow(offset):
+                        METRICS.count('bytes_served', id, len(data))
+                        yield data
+
+                response = bottle.HTTPResponse(follow())
+                response.headers['Content-Type'] = 'video/mp4'
             response.headers['Access-Control-Allow-Origin'] = '*'
             response.headers['Access-Control-Allow-Methods'] = 'GET, HEAD'
             response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
             return response
 
+        @app.get('/metrics')
+        def metrics():
+            bottle.response.headers['Content-Type'] = 'application/json'
+            return json.dumps(METRICS.snapshot(), indent=2, sort_keys=True)
+
+        @app.get('/hls/<id>/playlist.m3u8')
+        def hls_playlist(id):
+            if not self.transcoder or not self.transcoder.hls:
+                return bottle.HTTPError(404, 'no hls transcode')
+            response = bottle.response
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            response.headers['Access-Control-Allow-Methods'] = 'GET, HEAD'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+            response.headers['Content-Type'] = 'application/vnd.apple.mpegurl'
+            return self.transcoder.playlist()
+
+        @app.get('/hls/<id>/<n:int>.ts')
+        def hls_segment(id, n):
+            METRICS.count('requests', id)
+            if not self.transcoder or not self.transcoder.hls:
+                return bottle.HTTPError(404, 'no hls transcode')
+            fn = self.transcoder.segment(n)
+            if not fn:
+                return bottle.HTTPError(404, 'no such segment')
+            response = bottle.static_file(fn, root='/', mimetype='video/mp2t')
+            METRICS.count('bytes_served', id, int(response.headers.get('Content-Length') or 0))
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            response.headers['Access-Control-Allow-Methods'] = 'GET, HEAD'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+            return response
+
+        if self.server == 'asyncio':
+            self.media_server = MediaServer(self.ip, self.port,
+                                            lambda start: self.transcoder and self.transcoder.region(start), app=app)
+            self.media_server.serve_forever()
+            return
+
         # app.run(host=self.ip, port=self.port, server='paste', daemon=True)
         from paste import httpserver
         from paste.translogger import TransLogger
@@ -524,50 +2406,129 @@ class Gnomecast(object):
 
         GLib.idle_add(f)
 
-    def monitor_cast(self):
-        while True:
-            time.sleep(1)
-            if not self.cast: continue
-            seeking = self.seeking
-            cast = self.cast
-            mc = cast.media_controller
-            if mc.status.player_state != self.last_known_player_state:
-                if mc.status.player_state == 'PLAYING' and self.last_known_player_state == 'BUFFERING' and seeking:
-                    self.seeking = False
-                if mc.status.player_state == 'IDLE' and self.last_known_player_state == 'PLAYING':
-                    self.check_for_next_in_queue()
-                if mc.status.player_state == 'PLAYING':
-                    self.inhibit_screensaver()
-                else:
-                    self.restore_screensaver()
-                self.last_known_player_state = mc.status.player_state
+    def watch_cast(self, cast):
+        """ Has cast push its media status to on_media_status() - once, as pychromecast can't unregister listeners """
+        if cast in self.watched_casts: return
+        self.watched_casts.add(cast)
+        cast.media_controller.register_status_listener(CastStatusListener(self, cast))
+
+    def on_media_status(self, cast, status):
+        """ A media status update, on the GTK main loop.  Only the selected cast's count. """
+        if cast is not self.cast: return False
+        seeking = self.seeking
+        self.last_known_current_time = status.current_time
+        self.last_time_current_time = time.time()
+        if status.player_state != self.last_known_player_state:
+            if status.player_state == 'PLAYING' and self.play_requested_at:
+                METRICS.record('seek_to_playing' if seeking else 'time_to_playing',
+                               time.time() - self.play_requested_at, fn=self.fn)
+                self.play_requested_at = None
+            if status.player_state == 'PLAYING' and self.last_known_player_state == 'BUFFERING' and seeking:
+                self.seeking = False
+            if status.player_state == 'IDLE' and self.last_known_player_state == 'PLAYING':
+                self.check_for_next_in_queue()
+            if status.player_state == 'PLAYING':
+                self.inhibit_screensaver()
+                if not self.scrubber_timer:
+                    self.scrubber_timer = GLib.timeout_add(SCRUBBER_INTERVAL_MS, self.move_scrubber)
+            else:
+                self.restore_screensaver()
+            self.last_known_player_state = status.player_state
+            self.update_media_button_states()
+            self.update_status()
+        return False
 
-                def f():
-                    self.update_media_button_states()
-                    self.update_status()
+    def move_scrubber(self):
+        """ Timer moving the scrubber along between status updates, running only while the cast is PLAYING """
+        if not self.cast or self.last_known_player_state != 'PLAYING':
+            self.scrubber_timer = None
+            return False
+        if not self.seeking:
+            self.scrubber_adj.set_value(
+                self.time_offset + self.last_known_current_time + time.time() - self.last_time_current_time)
+        return True
 
-                GLib.idle_add(f)
-            elif self.transcoder and not self.transcoder.done:
-                def f():
-                    self.update_status()
+    def watch_transcodes(self):
+        """ Shows the queue's transcode progress every second, for as long as something is transcoding """
+        if not self.transcode_timer:
+            self.transcode_timer = GLib.timeout_add_seconds(1, self.update_transcode_progress)
 
-                GLib.idle_add(f)
-            if self.last_known_current_time != mc.status.current_time:
-                self.last_known_current_time = mc.status.current_time
-                self.last_time_current_time = time.time()
-            if not seeking and mc.status.player_state == 'PLAYING':
-                GLib.idle_add(
-                    lambda: self.scrubber_adj.set_value(
-                        mc.status.current_time + time.time() - self.last_time_current_time))
+    def update_transcode_progress(self):
+        self.update_status()
+        if any(row[7] and not row[7].done and not row[7].error for row in self.files_store):
+            return True
+        self.transcode_timer = None
+        return False
 
     def init_casts(self, widget=None, device=None):
+        """
+        Fills the combo with the devices seen last time, then keeps it up to date as discovery finds (or loses) them.
+        The refresh button (widget) starts a fresh sweep.
+        """
         self.cast_store.clear()
-        self.cast_store.append([None, "Searching local network - please wait..."])
-        self.cast_combo.set_active(0)
-        threading.Thread(target=self.load_casts, kwargs={'device': device}).start()
+        self.cast_store.append([None, "Select a cast device..."])
+        self.cast_store.append([-1, 'Add a non-local Chromecast...'])
+        known = self.discovery.known()
+        for cast_device in known:
+            self.add_cast_row(cast_device)
+        if widget is None:
+            self.discovery.listen(lambda cast_device: GLib.idle_add(self.add_cast_row, cast_device),
+                                  lambda cast_device: GLib.idle_add(self.remove_cast_row, cast_device))
+        threading.Thread(target=self.discovery.restart if widget else self.discovery.start).start()
+        if device:
+            self.wanted_device = device
+            if not self.select_wanted_device():
+                GLib.timeout_add_seconds(CAST_DISCOVERY_TIMEOUT, self.check_wanted_device)
+        else:
+            self.cast_combo.set_active(2 if len(known) == 1 else 0)
+
+    def cast_label(self, cast_device):
+        if cast_device['cast_type'] and cast_device['cast_type'] != 'cast':
+            return '%s (%s)' % (cast_device['friendly_name'], cast_device['cast_type'])
+        return cast_device['friendly_name']
+
+    def add_cast_row(self, cast_device):
+        for row in self.cast_store:
+            if isinstance(row[0], dict) and row[0]['uuid'] == cast_device['uuid']:
+                row[0], row[1] = cast_device, self.cast_label(cast_device)
+                break
+        else:
+            self.cast_store.append([cast_device, self.cast_label(cast_device)])
+        self.select_wanted_device()
+
+    def remove_cast_row(self, cast_device):
+        active = self.cast_combo.get_active_iter()
+        for row in self.cast_store:
+            if isinstance(row[0], dict) and row[0]['uuid'] == cast_device['uuid']:
+                if active is None or self.cast_store.get_path(active) != row.path:
+                    self.cast_store.remove(row.iter)  # the one in use stays until something else is picked
+                break
+
+    def select_wanted_device(self):
+        if not self.wanted_device: return False
+        for i, row in enumerate(self.cast_store):
+            if isinstance(row[0], dict) and row[0]['friendly_name'] == self.wanted_device:
+                self.wanted_device = None
+                self.cast_combo.set_active(i)
+                return True
+        return False
+
+    def check_wanted_device(self):
+        if self.wanted_device:
+            dialog = Gtk.MessageDialog(self.win, 0, Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE,
+                                       "Chromecast Not Found")
+            dialog.format_secondary_text("The Chromecast '%s' wasn't found." % self.wanted_device)
+            self.wanted_device = None
+            dialog.run()
+            dialog.destroy()
+        return False
 
     def inhibit_screensaver(self):
-        if not self.saver_interface or self.inhibit_screensaver_cookie: return
+        if self.inhibit_screensaver_cookie: return
+        if self.saver_interface is None:
+            bus = import_dbus().SessionBus() if DBUS_AVAILABLE else None
+            self.saver_interface = find_screensaver_dbus_iface(bus) or False
+        if not self.saver_interface: return
         self.inhibit_screensaver_cookie = self.saver_interface.Inhibit("Gnomecast", "Player is playing...")
         print('disabled screensaver')
 
@@ -577,39 +2538,6 @@ class Gnomecast(object):
             self.inhibit_screensaver_cookie = None
             print('restored screensaver')
 
-    def load_casts(self, device=None):
-        chromecasts = pychromecast.get_chromecasts()
-        # workaround for https://github.com/home-assistant-libs/pychromecast/issues/398
-        if isinstance(chromecasts, tuple) and len(chromecasts) == 2:
-            chromecasts = chromecasts[0]
-
-        def f():
-            self.cast_store.clear()
-            self.cast_store.append([None, "Select a cast device..."])
-            self.cast_store.append([-1, 'Add a non-local Chromecast...'])
-            for cc in chromecasts:
-                friendly_name = cc.device.friendly_name
-                if cc.cast_type != 'cast':
-                    friendly_name = '%s (%s)' % (friendly_name, cc.cast_type)
-                self.cast_store.append([cc, friendly_name])
-            if device:
-                found = False
-                for i, cc in enumerate(chromecasts):
-                    if device == cc.device.friendly_name:
-                        self.cast_combo.set_active(i + 1)
-                        found = True
-                if not found:
-                    self.cast_combo.set_active(0)
-                    dialog = Gtk.MessageDialog(self.win, 0, Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE,
-                                               "Chromecast Not Found")
-                    dialog.format_secondary_text("The Chromecast '%s' wasn't found." % device)
-                    dialog.run()
-                    dialog.destroy()
-            else:
-                self.cast_combo.set_active(2 if len(chromecasts) == 1 else 0)
-
-        GLib.idle_add(f)
-
     def update_media_button_states(self):
         mc = self.cast.media_controller if self.cast else None
         self.play_button.set_sensitive(bool(self.transcoder and self.cast and mc.status.player_state in (
@@ -730,6 +2658,7 @@ class Gnomecast(object):
         self.subtitle_store = Gtk.ListStore(str, object, object)  # title, stream, callback
         self.subtitle_combo = Gtk.ComboBox.new_with_model(self.subtitle_store)
         self.subtitle_combo.connect("changed", self.on_subtitle_combo_changed)
+        self.subtitle_combo.connect("notify::popup-shown", self.on_subtitle_combo_popup)
         self.subtitle_combo.set_entry_text_column(0)
         renderer_text = Gtk.CellRendererText()
         self.subtitle_combo.pack_start(renderer_text, True)
@@ -808,7 +2737,6 @@ class Gnomecast(object):
             self.queue_files([fn])
 
     def update_button_visible(self, x=None, y=None, z=None):
-        print('update_button_visible')
         count = len(self.files_store)
         self.scrolled_window.set_visible(count)
         self.remove_button.set_visible(count)
@@ -818,7 +2746,6 @@ class Gnomecast(object):
         self.file_detail_row.set_visible(bool(self.fn))
 
     def scrubber_move_started(self, scale, scroll_type, seconds):
-        print('scrubber_move_started', seconds)
         self.seeking = True
 
     def on_files_view_selection_changed(self, selection):
@@ -828,7 +2755,6 @@ class Gnomecast(object):
     def remove_files(self, w):
         store, paths = self.files_view.get_selection().get_selected_rows()
         for path in reversed(paths):
-            print('remove', path)
             iterx = store.get_iter(path)
             transcoder = store.get_value(iterx, 7)
             if transcoder:
@@ -840,7 +2766,6 @@ class Gnomecast(object):
 
     def on_files_view_row_activated(self, widget, row, col):
         model = widget.get_model()
-        print('double-clicked', model[row][:])
         fn = model[row][1]
         self.unselect_file()
         self.fn = fn
@@ -877,44 +2802,62 @@ class Gnomecast(object):
                 display = display[:MAX_LEN - 10] + '...' + display[-10:]
 
             def callback(fmd):
-                print(fmd)
-                if os.path.isfile(fmd.thumbnail_fn):
+                def f():
                     for row in self.files_store:
                         if row[1] == fmd.fn:
-                            row[4] = fmd.thumbnail_fn
-
-                def f():
-                    if self.fn == fmd.fn and fmd.thumbnail_fn:
-                        self.thumbnail_image.set_from_file(fmd.thumbnail_fn)
-                        self.win.resize(1, 1)
+                            if fmd.thumbnail_fn:
+                                row[4] = fmd.thumbnail_fn
+                            if fmd.duration:
+                                row[2] = fmd.duration
+                                row[3] = self.humanize_seconds(fmd.duration)
+                    if self.fn == fmd.fn:
+                        if fmd.duration:
+                            self.duration = fmd.duration
+                        if fmd.thumbnail_fn:
+                            self.thumbnail_image.set_from_file(fmd.thumbnail_fn)
+                            self.win.resize(1, 1)
                     self.update_status()
 
                 GLib.idle_add(f)
 
-            fmd = FileMetadata(fn, callback)
-            self.files_store.append([display, fn, None, '...', None, None, None, None, fmd])
-            threading.Thread(target=self.get_info, args=[fn]).start()
+            treeiter = self.files_store.append([display, fn, None, '...', None, None, None, None, None])
+            self.files_store.set_value(treeiter, 8, FileMetadata(fn, callback, scheduler=self.probe_scheduler))
         self.scrolled_window.set_visible(True)
         if len(files) and self.fn is None:
             self.select_file(files[0])
+        self.prioritize_probes()
         path = Gtk.TreePath().new_first()
         _1, _2, width, height = self.files_view_progress_column.cell_get_size()
         height += self.file_view_column_renderer.get_padding().ypad * 2
         height += 2  # measured - row lines?
         self.scrolled_window.set_min_content_height(height * min(len(self.files_store), 6))
 
+    def prioritize_probes(self, next_up=3):
+        """ Probes the selected file first, then the next few files in the queue """
+        fns = [row[1] for row in self.files_store]
+        if self.fn in fns:
+            start = fns.index(self.fn)
+            self.probe_scheduler.prioritize(fns[start:start + 1 + next_up])
+
     @throttle(seconds=1)
     def volume_moved(self, button, volume):
         if self.last_known_volume_level != volume:
             self.last_known_volume_level = volume
             self.cast.set_volume(volume)
-            print('setting volume', volume)
 
     @throttle()
     def scrubber_moved(self, scale, scroll_type, seconds):
-        print('scrubber_moved', seconds)
+        self.seek_to(seconds)
+
+    def seek_to(self, seconds):
         self.seeking = True
-        self.cast.media_controller.seek(seconds)
+        self.play_requested_at = time.time()
+        region = self.transcoder.region_for(seconds) if self.transcoder else None
+        if region and region.start_at != self.time_offset:
+            # the seek target lives in a different transcode, so point the device at that one
+            self.play_media(seconds)
+        else:
+            self.cast.media_controller.seek(seconds - self.time_offset)
 
     def humanize_seconds(self, s):
         s = int(s)
@@ -946,10 +2889,8 @@ class Gnomecast(object):
             transcoder = row[7]
             if transcoder:
                 transcoder.destroy()
-            thumbnail_fn = row[4]
-            if thumbnail_fn and os.path.isfile(thumbnail_fn):
-                os.remove(thumbnail_fn)
         self.restore_screensaver()
+        self.discovery.stop()
         Gtk.main_quit()
 
     def forward_clicked(self, widget):
@@ -959,12 +2900,12 @@ class Gnomecast(object):
         self.seek_delta(-10)
 
     def seek_delta(self, delta):
-        seconds = self.cast.media_controller.status.current_time + time.time() - self.last_time_current_time + delta
+        seconds = self.time_offset + self.cast.media_controller.status.current_time + time.time() - \
+                  self.last_time_current_time + delta
         self.last_time_current_time = time.time()
-        self.cast.media_controller.status.current_time = seconds
+        self.last_known_current_time = self.cast.media_controller.status.current_time = seconds - self.time_offset
         self.scrubber_adj.set_value(seconds)
-        self.seeking = True
-        self.cast.media_controller.seek(seconds)
+        self.seek_to(seconds)
 
     def play_clicked(self, widget):
         if not self.cast:
@@ -973,29 +2914,39 @@ class Gnomecast(object):
         cast = self.cast
         mc = cast.media_controller
 
-        print('mc.status.player_state', mc.status.player_state, self.fn, hash(self.fn))
         if mc.status.player_state in ('IDLE', 'UNKNOWN') or self.last_fn_played != self.fn:
             self.last_fn_played = self.fn
-            cast.wait()
-            mc = cast.media_controller
-            kwargs = {}
-            if self.subtitles:
-                kwargs['subtitles'] = 'http://%s:%s/subtitles.vtt' % (self.ip, self.port)
-            current_time = self.scrubber_adj.get_value()
-            if current_time:
-                kwargs['current_time'] = current_time
-            ext = self.fn.split('.')[-1]
-            ext = ''.join(ch for ch in ext if ch.isalnum()).lower()
-            mc.play_media('http://%s:%s/media/%s.%s' % (self.ip, self.port, hash(self.fn), ext),
-                          'audio/%s' % ext if ext in AUDIO_EXTS else 'video/mp4', **kwargs)
-            print(cast.status)
-            print(mc.status)
+            self.play_media(self.scrubber_adj.get_value())
             self.prep_next_transcode()
         elif mc.status.player_state == 'PLAYING':
             mc.pause()
         elif mc.status.player_state == 'PAUSED':
             mc.play()
 
+    def play_media(self, current_time):
+        if not self.seeking:
+            self.play_requested_at = time.time()
+        cast = self.cast
+        cast.wait()
+        mc = cast.media_controller
+        kwargs = {}
+        if self.subtitles:
+            kwargs['subtitles'] = 'http://%s:%s/subtitles.vtt' % (self.ip, self.port)
+        region = self.transcoder.region_for(current_time)
+        self.time_offset = region.start_at
+        if current_time - region.start_at:
+            kwargs['current_time'] = current_time - region.start_at
+        ext = self.fn.split('.')[-1]
+        ext = ''.join(ch for ch in ext if ch.isalnum()).lower()
+        if self.transcoder.hls and self.transcoder.transcode:
+            mc.play_media('http://%s:%s/hls/%s/playlist.m3u8' % (self.ip, self.port, hash(self.fn)),
+                          'application/x-mpegURL', **kwargs)
+        else:
+            url = 'http://%s:%s/media/%s.%s' % (self.ip, self.port, hash(self.fn), ext)
+            if region.start_at:
+                url += '?start=%.3f' % region.start_at
+            mc.play_media(url, 'audio/%s' % ext if ext in AUDIO_EXTS else 'video/mp4', **kwargs)
+
     def on_file_clicked(self, widget):
         dialog = Gtk.FileChooserDialog("Please choose an audio or video file...", self.win,
                                        Gtk.FileChooserAction.OPEN,
@@ -1015,12 +2966,8 @@ class Gnomecast(object):
 
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            print("Open clicked")
-            print("File selected:", dialog.get_filenames())
             self.queue_files(dialog.get_filenames())
             # self.select_file(dialog.get_filename())
-        elif response == Gtk.ResponseType.CANCEL:
-            print("Cancel clicked")
 
         dialog.destroy()
 
@@ -1041,11 +2988,8 @@ class Gnomecast(object):
 
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            print("Open clicked")
-            print("File selected: " + dialog.get_filename())
             self.select_subtitles_file(dialog.get_filename())
         elif response == Gtk.ResponseType.CANCEL:
-            print("Cancel clicked")
             self.subtitle_combo.set_active(0)
 
         dialog.destroy()
@@ -1067,11 +3011,8 @@ class Gnomecast(object):
 
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            print("Open clicked")
-            print("File selected: " + dialog.get_filename())
             self.select_subtitles_file(dialog.get_filename())
         elif response == Gtk.ResponseType.CANCEL:
-            print("Cancel clicked")
             self.subtitle_combo.set_active(0)
 
         dialog.destroy()
@@ -1087,26 +3028,25 @@ class Gnomecast(object):
             GLib.idle_add(f)
             return
         fn = os.path.abspath(fn)
-        ext = fn.split('.')[-1]
+        future = convert_subtitles_async(fn)
+        future.add_done_callback(lambda future: GLib.idle_add(self.add_subtitles_file, fn, future))
+        return future
+
+    def add_subtitles_file(self, fn, future):
         display_name = os.path.basename(fn)
-        if ext == 'vtt':
-            with open(fn) as f:
-                self.subtitles = f.read()
-        else:
-            with open(fn, 'rb') as f:
-                caps = f.read()
-                try:
-                    caps = caps.decode()
-                except UnicodeDecodeError:
-                    caps = caps.decode('latin-1')
-            if caps.startswith('\ufeff'):  # BOM
-                caps = caps[1:]
-            converter = pycaption.CaptionConverter()
-            converter.read(caps, pycaption.detect_format(caps)())
-            self.subtitles = converter.write(pycaption.WebVTTWriter())
+        try:
+            subtitles = future.result()
+        except Exception as e:
+            traceback.print_exc()
+            dialog = Gtk.MessageDialog(self.win, 0, Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE,
+                                       "Unreadable Subtitles")
+            dialog.format_secondary_text("Could not read subtitles file %s: %s" % (fn, e))
+            dialog.run()
+            dialog.destroy()
+            return
         pos = len(self.subtitle_store)
         stream = StreamMetadata(None, None, title=display_name)
-        stream._subtitles = self.subtitles
+        stream._subtitles = subtitles
         self.subtitle_store.append([display_name, stream, None])
         self.subtitle_combo.set_active(pos)
 
@@ -1144,6 +3084,7 @@ class Gnomecast(object):
         fn = os.path.abspath(fn)
         self.thumbnail_image.set_from_pixbuf(self.get_logo_pixbuf())
         self.fn = fn
+        self.prioritize_probes()
         self.stream_store.clear()
         self.subtitle_store.clear()
         if self.cast:
@@ -1180,14 +3121,27 @@ class Gnomecast(object):
                     transcoder = row[7]
                     fmd = row[8]
                     fmd.wait()
+                    if fmd.error:
+                        self.transcoder = None
+                        self.autoplay = False
+                        self.error_callback('Could not read %s:\n%s' % (self.fn, fmd.error))
+                        break
                     if not self.video_stream: self.video_stream = fmd.video_streams[0]
                     if not self.audio_stream and fmd.audio_streams: self.audio_stream = fmd.audio_streams[0]
-                    if not transcoder or self.cast != transcoder.cast or self.fn != transcoder.source_fn or self.audio_stream != transcoder.audio_stream:
-                        self.transcoder = Transcoder(self.cast, fmd, self.video_stream, self.audio_stream,
-                                                     lambda did_transcode=None: GLib.idle_add(self.update_status,
-                                                                                              did_transcode),
-                                                     self.error_callback, transcoder)
+                    if not transcoder or self.cast != transcoder.cast or self.fn != transcoder.source_fn or \
+                            self.audio_stream != transcoder.audio_stream or transcoder.error:
+                        transcoder_class = self.transcoder_class(fmd)
+                        self.transcoder = transcoder_class(self.cast, fmd, self.video_stream, self.audio_stream,
+                                                           lambda did_transcode=None: GLib.idle_add(self.update_status,
+                                                                                                    did_transcode),
+                                                           self.error_callback, transcoder,
+                                                           encoder_profile=self.learned_encoder_profile())
                         row[7] = self.transcoder
+                    else:
+                        self.transcoder = transcoder  # transcoded ahead while the previous file played
+                        transcoder.renice(0)
+                        transcoder.resume()
+                GLib.idle_add(self.prep_next_transcode)
                 if self.autoplay:
                     self.autoplay = False
                     self.play_clicked(None)
@@ -1199,47 +3153,77 @@ class Gnomecast(object):
                         row[7] = None
             GLib.idle_add(self.update_media_button_states)
 
+    def transcoder_class(self, fmd):
+        if self.hls and fmd.duration:
+            return HLSTranscoder
+        if self.parallel_chunks and fmd.duration:
+            return ChunkedTranscoder
+        return Transcoder
+
     def check_for_next_in_queue(self):
         next = False
         for row in self.files_store:
             fn = row[1]
             if next:
-                print('check_for_next_in_queue', fn)
                 self.autoplay = True
                 self.select_file(fn)
                 next = False
             if self.cast and self.fn and self.fn == fn:
                 next = True
 
+    def learned_encoder_profile(self):
+        """ Starts new transcodes where the last one's speed said to, rather than from the beginning again """
+        if self.transcoder and self.transcoder.transcode_video:
+            return self.transcoder.encoder_profile
+        return self.encoder_profile
+
     def prep_next_transcode(self):
-        transcode_next = False
-        for row in self.files_store:
+        """
+        Keeps the next self.lookahead files in the queue transcoding, niced and splitting self.transcode_threads
+        between them, so playback doesn't stall between files.  The playing file always comes first: if its own
+        transcode started out as one of these, the others are paused until it's done.
+        """
+        if not self.cast or not self.fn: return
+        self.watch_transcodes()
+        rows = list(self.files_store)
+        current = [i for i, row in enumerate(rows) if row[1] == self.fn]
+        if not current: return
+        current = current[0]
+        threads = max(1, self.transcode_threads // max(1, self.lookahead))
+        for i, row in enumerate(rows):
             fn = row[1]
             transcoder = row[7]
             fmd = row[8]
-            if transcode_next and not transcoder:
-                print('prep_next_transcode', fn)
-                transcoder = Transcoder(self.cast, fmd, fmd.audio_streams[0] if fmd.audio_streams else None,
-                                        lambda did_transcode=None: GLib.idle_add(self.update_status, did_transcode),
-                                        self.error_callback, transcoder)
-                row[7] = transcoder
-                transcode_next = False
-            if self.cast and self.fn and self.fn == fn and transcoder and transcoder.done:
-                transcode_next = True
-
-    def get_info(self, fn):
-        cmd = ['ffprobe', '-i', fn]
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        for line in output.decode().split('\n'):
-            line = line.strip()
-            if line.startswith('Duration:'):
-                duration = parse_ffmpeg_time(line.split()[1].strip(','))
-                if fn == self.fn:
-                    self.duration = duration
-                for row in self.files_store:
-                    if row[1] == fn:
-                        row[2] = duration
-                        row[3] = self.humanize_seconds(duration)
+            if i == current: continue
+            if not current < i <= current + self.lookahead:
+                if transcoder and not transcoder.done:
+                    transcoder.destroy()  # fell out of the window, give the cores back
+                    row[7] = None
+                continue
+            if transcoder and transcoder.cast == self.cast and not transcoder.error: continue
+            if not fmd or not fmd.ready: continue  # picked up again once probed
+            logger.info('transcoding %s ahead', os.path.basename(fn))
+            row[7] = self.transcoder_class(fmd)(
+                self.cast, fmd, fmd.video_streams[0] if fmd.video_streams else None,
+                fmd.audio_streams[0] if fmd.audio_streams else None,
+                lambda did_transcode=None: GLib.idle_add(self.update_status, did_transcode),
+                lambda msg, fn=fn: print('transcoding', fn, 'ahead failed:', msg), transcoder,
+                threads=threads, nice=LOOKAHEAD_NICE, encoder_profile=self.learned_encoder_profile())
+        self.share_cpu(rows[current][7], [row[7] for row in rows[current + 1:current + 1 + self.lookahead]])
+
+    @staticmethod
+    def share_cpu(playing, ahead):
+        """
+        Transcodes ahead run niced, so the playing one gets the cpu first.  If the playing one was itself transcoded
+        ahead and couldn't be reniced back (see Transcoder.renice()), the others are paused until it's done instead.
+        """
+        yield_cpu = playing and playing.nice and not playing.done
+        for transcoder in ahead:
+            if not transcoder: continue
+            if yield_cpu:
+                transcoder.pause()
+            else:
+                transcoder.resume()
 
     def get_fmd(self):
         for row in self.files_store:
@@ -1251,6 +3235,7 @@ class Gnomecast(object):
     def update_subtitles(self):
         fmd = self.get_fmd()
         fmd.wait()
+        if fmd.error: return  # reported by update_transcoders()
 
         def f():
             self.subtitle_store.clear()
@@ -1267,10 +3252,12 @@ class Gnomecast(object):
             if os.path.isfile(self.fn[:-len(ext)] + sext):
                 self.select_subtitles_file(self.fn[:-len(ext)] + sext)
                 break
+        fmd.load_subtitles()
 
     def update_audio_tracks(self):
         fmd = self.get_fmd()
         fmd.wait()
+        if fmd.error: return  # reported by update_transcoders()
 
         def f():
             self.stream_store.clear()
@@ -1296,8 +3283,11 @@ class Gnomecast(object):
             #      cast.media_controller.app_id = 'FF0F6B72'
             self.last_known_volume_level = cast.media_controller.status.volume_level
             self.volume_button.set_value(cast.media_controller.status.volume_level)
+            self.watch_cast(cast)
         self.last_known_player_state = None
         self.update_media_button_states()
+        if cast:
+            self.on_media_status(cast, cast.media_controller.status)  # whatever it's doing already
         threading.Thread(target=self.update_transcoders).start()
 
     def error_callback(self, msg):
@@ -1328,11 +3318,12 @@ class Gnomecast(object):
         GLib.idle_add(f)
 
     def show_file_info(self, b=None):
-        print('show_file_info')
         fmd = self.get_fmd()
         msg = '\n' + fmd.details()
         if self.cast:
             msg += '\nDevice: %s (%s)' % (self.cast.device.model_name, self.cast.device.manufacturer)
+        if self.transcoder and self.transcoder.source_fn == self.fn:
+            msg += '\nCasting: %s' % self.transcoder.plan
         msg += '\nChromecast: v%s' % (__version__)
         dialogWindow = Gtk.MessageDialog(self.win,
                                          Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT,
@@ -1366,7 +3357,7 @@ class Gnomecast(object):
 
         dialogBox = dialogWindow.get_content_area()
         buffer1 = Gtk.TextBuffer()
-        buffer1.set_text(fmd._ffmpeg_output)
+        buffer1.set_text(fmd._ffprobe_output)
         text_view = Gtk.TextView(buffer=buffer1)
         text_view.set_editable(False)
         scrolled_window = Gtk.ScrolledWindow()
@@ -1399,7 +3390,7 @@ class Gnomecast(object):
         text = userEntry.get_text()
         dialogWindow.destroy()
         if (response == Gtk.ResponseType.OK) and (text != ''):
-            print(text)
+            import_pychromecast()
             try:
                 cast = pychromecast.Chromecast(text)
                 self.cast_store.append([cast, text])
@@ -1419,7 +3410,8 @@ class Gnomecast(object):
             if cast == -1:
                 self.get_nonlocal_cast()
             else:
-                print(cast)
+                if isinstance(cast, dict):
+                    cast = self.discovery.connect(cast)
                 self.select_cast(cast)
         else:
             entry = combo.get_child()
@@ -1429,28 +3421,43 @@ class Gnomecast(object):
         if tree_iter is not None:
             model = combo.get_model()
             text, stream, callback = model[tree_iter]
-            print('chose subtitle', text, stream, callback)
             if callback:
                 callback()
-            else:
-                self.subtitles = stream._subtitles if stream else None
-                mc = self.cast.media_controller if self.cast else None
-                if mc and mc.status.player_state in ('BUFFERING', 'PLAYING', 'PAUSED'):
-                    self.stop_clicked(None)
-                    self.cast.wait()
+            elif stream and stream._subtitles is None:
+                # embedded subtitles are only extracted once someone actually picks them
+                fmd = self.get_fmd()
 
-                    def f(): self.play_clicked(None)
+                def f():
+                    fmd.load_subtitles([stream])
+                    GLib.idle_add(self.use_subtitles, stream)
 
-                    threading.Timer(1, lambda: GLib.idle_add(f)).start()
+                threading.Thread(target=f).start()
+            else:
+                self.use_subtitles(stream)
         else:
             entry = combo.get_child()
 
+    def on_subtitle_combo_popup(self, combo, param):
+        fmd = self.get_fmd()
+        if combo.props.popup_shown and fmd and fmd.ready and fmd.subtitles:
+            threading.Thread(target=fmd.load_subtitles).start()
+
+    def use_subtitles(self, stream):
+        self.subtitles = stream._subtitles if stream else None
+        mc = self.cast.media_controller if self.cast else None
+        if mc and mc.status.player_state in ('BUFFERING', 'PLAYING', 'PAUSED'):
+            self.stop_clicked(None)
+            self.cast.wait()
+
+            def f(): self.play_clicked(None)
+
+            threading.Timer(1, lambda: GLib.idle_add(f)).start()
+
     def on_audio_combo_changed(self, combo):
         tree_iter = combo.get_active_iter()
         if tree_iter is not None:
             model = combo.get_model()
             text, video_stream, audio_stream = model[tree_iter]
-            print(text, video_stream, audio_stream)
             self.video_stream = video_stream
             self.audio_stream = audio_stream
             threading.Thread(target=self.update_transcoders).start()
@@ -1566,7 +3573,8 @@ LOGO_SVG = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
 </svg>'''
 
 
-def arg_parse(args, kw_synonyms, f, usage):
+def arg_parse(args, kw_synonyms, f, usage, flags=()):
+    """ flags are the options that never take a value, so the argument after one is always positional """
     kw = None
     f_args = []
     f_kwargs = {}
@@ -1576,6 +3584,9 @@ def arg_parse(args, kw_synonyms, f, usage):
                 f_kwargs[kw] = True
             arg = arg.lstrip('-')
             kw = kw_synonyms.get(arg, arg)
+            if kw in flags:
+                f_kwargs[kw] = True
+                kw = None
         else:
             if kw:
                 f_kwargs[kw] = arg
@@ -1594,7 +3605,14 @@ def arg_parse(args, kw_synonyms, f, usage):
 
 
 USAGE = '''
-python gnomecast.py [<media_filename>] [-d|--device <chromecast_name>] [-s|--subtitles <subtitles_filename>]
+python gnomecast.py [<media_filename>...] [-d|--device <chromecast_name>] [-s|--subtitles <subtitles_filename>]
+                   [--probe-workers <count>] [--hls]
+                   [--transcode-cache <directory>] [--transcode-cache-size <GB>]
+                   [--lookahead <count>] [--transcode-threads <count>] [--parallel-chunks]
+                   [--chunk-workers <count>] [--encoder-profile fastest|fast|balanced|quality|best] [--server asyncio|paste]
+                   [--metrics-log <filename>] [--startup-report]
+python gnomecast.py --headless <media_filename>... -d|--device <chromecast_name> [-s|--subtitles <subtitles_filename>]
+                   [any of the options above]
 '''.strip()
 
 
@@ -1607,6 +3625,13 @@ def pid_running(pid):
         return True
 
 
+def remove_path(fn):
+    if os.path.isdir(fn):
+        shutil.rmtree(fn, ignore_errors=True)
+    else:
+        os.remove(fn)
+
+
 def delete_old_transcodes():
     # if process is killed old transcoded files can be left around
     # delete if found
@@ -1619,17 +3644,41 @@ def delete_old_transcodes():
                 pid = int(match.group(1))
                 if not pid_running(pid):
                     print('\tpid', pid, 'is dead, so deleting', fn)
-                    os.remove(fn)
+                    remove_path(fn)
             else:
                 print('old style gnomecast file', fn, 'found, so deleting...')
-                os.remove(fn)
+                remove_path(fn)
 
 
 def main():
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
     delete_old_transcodes()
     caster = Gnomecast()
-    arg_parse(sys.argv[1:], {'s': 'subtitles', 'd': 'device'}, caster.run, USAGE)
 
+    def start(*fns, headless=False, **kwargs):
+        if headless:
+            sys.exit(caster.cast_headless(*fns, **kwargs))
+        import_gtk()
+        STARTUP.mark('gtk')
+        caster.run(*fns, **kwargs)
+
+    arg_parse(sys.argv[1:], {'s': 'subtitles', 'd': 'device', 'probe-workers': 'probe_workers',
+                              'transcode-cache': 'transcode_cache',
+                              'transcode-cache-size': 'transcode_cache_size',
+                              'transcode-threads': 'transcode_threads',
+                              'parallel-chunks': 'parallel_chunks',
+                              'chunk-workers': 'chunk_workers',
+                              'encoder-profile': 'encoder_profile',
+                              'metrics-log': 'metrics_log',
+                              'startup-report': 'startup_report'}, start, USAGE,
+              flags=('headless', 'hls', 'parallel_chunks', 'startup_report'))
+
+
+STARTUP.mark('import')
 
 if DEPS_MET and __name__ == '__main__':
     main()
@@ -35,7 +35,8 @@ setup(
         ('share/icons/hicolor/16x16/apps', ['icons/gnomecast_16.png']),
         ('share/icons/hicolor/48x48/apps', ['icons/gnomecast_48.png']),
         ('share/icons/hicolor/scalable/apps', ['icons/gnomecast.svg']),
-        ('share/applications', ['gnomecast.desktop'])
+        ('share/applications', ['gnomecast.desktop']),
+        ('share/gnomecast', ['devices.json'])
     ],
     entry_points={
         'gui_scripts': [
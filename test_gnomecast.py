@@ -1,4 +1,18 @@
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import uuid
+from unittest import mock
+
+import fakecast
 import gnomecast
 
 
@@ -12,39 +26,50 @@ class FakeDevice:
         self.__dict__.update(kwargs)
 
 
+def make_fmd(video='hevc', audio=None, fn='movie.mkv', duration='60.0', **format):
+    """A probed FileMetadata for fn. Streams are a codec name or a dict of ffprobe fields; audio is stereo."""
+    streams = []
+    for codec_type, stream in (('video', video), ('audio', audio)):
+        if stream is None:
+            continue
+        if isinstance(stream, str):
+            stream = {'codec_name': stream, 'channels': 2} if codec_type == 'audio' else {'codec_name': stream}
+        streams.append(dict(stream, index=len(streams), codec_type=codec_type))
+    fmd = gnomecast.FileMetadata(fn, _ffprobe_output=json.dumps({
+        'streams': streams,
+        'format': dict(format, duration=duration),
+    }))
+    fmd.wait()
+    return fmd
+
+
+def make_transcoder(fmd, model_name='Chromecast', cls=gnomecast.Transcoder, done_callback=None, error_callback=None,
+                    **kwargs):
+    """A fake transcode of fmd's first video and audio streams for a FakeCast of the given model."""
+    cast = FakeCast(cast_type='video', manufacturer='Unknown manufacturer', model_name=model_name)
+    audio = fmd.audio_streams[0] if fmd.audio_streams else None
+    return cls(cast, fmd, fmd.video_streams[0], audio, done_callback, error_callback, fake=True, **kwargs)
+
+
 class TestGnomecast(unittest.TestCase):
 
     def test_1(self):
-        fmd = gnomecast.FileMetadata(
-            'pCU2GE07KW4.mkv',
-            _ffmpeg_output='''
-ffprobe version 4.1.4 Copyright (c) 2007-2019 the FFmpeg developers
-  built with gcc 9 (GCC)
-  configuration: --prefix=/usr --bindir=/usr/bin --datadir=/usr/share/ffmpeg --docdir=/usr/share/doc/ffmpeg --incdir=/usr/include/ffmpeg --libdir=/usr/lib64 --mandir=/usr/share/man --arch=x86_64 --optflags='-O2 -g -pipe -Wall -Werror=format-security -Wp,-D_FORTIFY_SOURCE=2 -Wp,-D_GLIBCXX_ASSERTIONS -fexceptions -fstack-protector-strong -grecord-gcc-switches -specs=/usr/lib/rpm/redhat/redhat-hardened-cc1 -specs=/usr/lib/rpm/redhat/redhat-annobin-cc1 -m64 -mtune=generic -fasynchronous-unwind-tables -fstack-clash-protection -fcf-protection' --extra-ldflags='-Wl,-z,relro -Wl,--as-needed -Wl,-z,now -specs=/usr/lib/rpm/redhat/redhat-hardened-ld ' --extra-cflags=' ' --enable-libopencore-amrnb --enable-libopencore-amrwb --enable-libvo-amrwbenc --enable-version3 --enable-bzlib --disable-crystalhd --enable-fontconfig --enable-frei0r --enable-gcrypt --enable-gnutls --enable-ladspa --enable-libaom --enable-libass --enable-libbluray --enable-libcdio --enable-libdrm --enable-libjack --enable-libfreetype --enable-libfribidi --enable-libgsm --enable-libmp3lame --enable-nvenc --enable-openal --enable-opencl --enable-opengl --enable-libopenjpeg --enable-libopus --enable-libpulse --enable-librsvg --enable-libsoxr --enable-libspeex --enable-libssh --enable-libtheora --enable-libvorbis --enable-libv4l2 --enable-libvidstab --enable-libvmaf --enable-libvpx --enable-libx264 --enable-libx265 --enable-libxvid --enable-libzvbi --enable-avfilter --enable-avresample --enable-postproc --enable-pthreads --disable-static --enable-shared --enable-gpl --disable-debug --disable-stripping --shlibdir=/usr/lib64 --enable-libmfx --enable-runtime-cpudetect
-  libavutil      56. 22.100 / 56. 22.100
-  libavcodec     58. 35.100 / 58. 35.100
-  libavformat    58. 20.100 / 58. 20.100
-  libavdevice    58.  5.100 / 58.  5.100
-  libavfilter     7. 40.101 /  7. 40.101
-  libavresample   4.  0.  0 /  4.  0.  0
-  libswscale      5.  3.100 /  5.  3.100
-  libswresample   3.  3.100 /  3.  3.100
-  libpostproc    55.  3.100 / 55.  3.100
-Input #0, matroska,webm, from 'pCU2GE07KW4.mkv':
-  Metadata:
-    COMPATIBLE_BRANDS: iso6avc1mp41
-    MAJOR_BRAND     : dash
-    MINOR_VERSION   : 0
-    ENCODER         : Lavf58.20.100
-  Duration: 00:41:45.28, start: -0.007000, bitrate: 1303 kb/s
-    Stream #0:0: Video: h264 (High), yuv420p(tv, bt709, progressive), 1920x1080 [SAR 1:1 DAR 16:9], 29.97 fps, 29.97 tbr, 1k tbn, 59.94 tbc (default)
-    Metadata:
-      HANDLER_NAME    : ISO Media file produced by Google Inc.
-      DURATION        : 00:41:45.269000000
-    Stream #0:1(eng): Audio: opus, 48000 Hz, stereo, fltp (default)
-    Metadata:
-      DURATION        : 00:41:45.281000000
-    ''')
+        fmd = gnomecast.FileMetadata('pCU2GE07KW4.mkv', _ffprobe_output=json.dumps({
+            'streams': [
+                {'index': 0, 'codec_name': 'h264', 'profile': 'High', 'codec_type': 'video', 'width': 1920,
+                 'height': 1080, 'pix_fmt': 'yuv420p', 'level': 40, 'r_frame_rate': '30000/1001',
+                 'avg_frame_rate': '30000/1001', 'disposition': {'default': 1},
+                 'tags': {'HANDLER_NAME': 'ISO Media file produced by Google Inc.',
+                          'DURATION': '00:41:45.269000000'}},
+                {'index': 1, 'codec_name': 'opus', 'codec_type': 'audio', 'sample_fmt': 'fltp',
+                 'sample_rate': '48000', 'channels': 2, 'channel_layout': 'stereo', 'disposition': {'default': 1},
+                 'tags': {'language': 'eng', 'DURATION': '00:41:45.281000000'}},
+            ],
+            'format': {'filename': 'pCU2GE07KW4.mkv', 'nb_streams': 2, 'format_name': 'matroska,webm',
+                       'start_time': '-0.007000', 'duration': '2505.281000', 'bit_rate': '1303000',
+                       'tags': {'COMPATIBLE_BRANDS': 'iso6avc1mp41', 'MAJOR_BRAND': 'dash', 'MINOR_VERSION': '0',
+                                'ENCODER': 'Lavf58.20.100'}},
+        }))
         fmd.wait()
 
         self.assertEqual(fmd.container, 'mkv')
@@ -57,146 +82,41 @@ Input #0, matroska,webm, from 'pCU2GE07KW4.mkv':
         self.assertEqual(fmd.audio_streams[0].title, 'eng')
         self.assertEqual(fmd.audio_streams[0].channels, 2)
         self.assertEqual(len(fmd.subtitles), 0)
+        self.assertEqual(fmd.duration, 2505.281)
 
         cast = FakeCast(cast_type='video', manufacturer='Unknown manufacturer', model_name='Chromecast')
-        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, fake=True)
+        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, None, fake=True)
 
         self.assertEqual(transcoder.transcode_cmd[:-1],
                          ['ffmpeg', '-i', 'pCU2GE07KW4.mkv', '-map', '0:0', '-map', '0:1', '-c:v', 'copy', '-c:a',
-                          'mp3', '-b:a', '256k'])
+                          'mp3', '-b:a', '256k',
+                          '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'])
 
     def test_2(self):
-        fmd = gnomecast.FileMetadata(
-            'Godzilla - King of the Monsters (2019) (2160p BluRay x265 10bit HDR Tigole).mkv',
-            _ffmpeg_output='''
-Input #0, matroska,webm, from 'Godzilla - King of the Monsters (2019) (2160p BluRay x265 10bit HDR Tigole).mkv':
-  Metadata:
-    title           : Godzilla: King of the Monsters
-    encoder         : libebml v1.3.7 + libmatroska v1.5.0
-    creation_time   : 2019-08-23T10:49:27.000000Z
-  Duration: 02:11:43.19, start: 0.000000, bitrate: 18112 kb/s
-    Chapter #0:0: start 0.000000, end 653.694708
-    Metadata:
-      title           : Chapter 01
-    Chapter #0:1: start 653.694708, end 1086.585500
-    Metadata:
-      title           : Chapter 02
-    Chapter #0:2: start 1086.585500, end 1827.325500
-    Metadata:
-      title           : Chapter 03
-    Chapter #0:3: start 1827.325500, end 2718.632583
-    Metadata:
-      title           : Chapter 04
-    Chapter #0:4: start 2718.632583, end 3250.830917
-    Metadata:
-      title           : Chapter 05
-    Chapter #0:5: start 3250.830917, end 3941.646042
-    Metadata:
-      title           : Chapter 06
-    Chapter #0:6: start 3941.646042, end 4171.292125
-    Metadata:
-      title           : Chapter 07
-    Chapter #0:7: start 4171.292125, end 4771.308208
-    Metadata:
-      title           : Chapter 08
-    Chapter #0:8: start 4771.308208, end 5406.067333
-    Metadata:
-      title           : Chapter 09
-    Chapter #0:9: start 5406.067333, end 5916.785875
-    Metadata:
-      title           : Chapter 10
-    Chapter #0:10: start 5916.785875, end 6598.508583
-    Metadata:
-      title           : Chapter 11
-    Chapter #0:11: start 6598.508583, end 7168.536375
-    Metadata:
-      title           : Chapter 12
-    Chapter #0:12: start 7168.536375, end 7903.104000
-    Metadata:
-      title           : Chapter 13
-    Stream #0:0: Video: hevc (Main 10), yuv420p10le(tv, bt2020nc/bt2020/smpte2084), 3840x1600, SAR 1:1 DAR 12:5, 23.98 fps, 23.98 tbr, 1k tbn, 23.98 tbc (default)
-    Metadata:
-      BPS-eng         : 17115721
-      DURATION-eng    : 02:11:43.104000000
-      NUMBER_OF_FRAMES-eng: 189485
-      NUMBER_OF_BYTES-eng: 16908415995
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    Stream #0:1(eng): Audio: aac (LC), 48000 Hz, 7.1, fltp (default)
-    Metadata:
-      BPS-eng         : 901426
-      DURATION-eng    : 02:11:43.104000000
-      NUMBER_OF_FRAMES-eng: 370458
-      NUMBER_OF_BYTES-eng: 890507991
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    Stream #0:2(eng): Audio: aac (HE-AAC), 48000 Hz, stereo, fltp
-    Metadata:
-      title           : Commentary
-      BPS-eng         : 65862
-      DURATION-eng    : 02:11:43.147000000
-      NUMBER_OF_FRAMES-eng: 185230
-      NUMBER_OF_BYTES-eng: 65064850
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    Stream #0:3(eng): Subtitle: dvd_subtitle, 1920x1080
-    Metadata:
-      BPS-eng         : 8966
-      DURATION-eng    : 02:11:18.819000000
-      NUMBER_OF_FRAMES-eng: 1661
-      NUMBER_OF_BYTES-eng: 8830829
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    Stream #0:4(ara): Subtitle: dvd_subtitle, 1920x1080
-    Metadata:
-      BPS-eng         : 4132
-      DURATION-eng    : 02:10:49.414000000
-      NUMBER_OF_FRAMES-eng: 1373
-      NUMBER_OF_BYTES-eng: 4055035
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    Stream #0:5(chi): Subtitle: dvd_subtitle, 1920x1080
-    Metadata:
-      BPS-eng         : 6291
-      DURATION-eng    : 02:10:44.329000000
-      NUMBER_OF_FRAMES-eng: 1246
-      NUMBER_OF_BYTES-eng: 6169396
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    Stream #0:6(fre): Subtitle: dvd_subtitle, 1920x1080
-    Metadata:
-      BPS-eng         : 6451
-      DURATION-eng    : 02:10:49.539000000
-      NUMBER_OF_FRAMES-eng: 1276
-      NUMBER_OF_BYTES-eng: 6330309
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    Stream #0:7(kor): Subtitle: dvd_subtitle, 1920x1080
-    Metadata:
-      BPS-eng         : 4593
-      DURATION-eng    : 02:10:44.333000000
-      NUMBER_OF_FRAMES-eng: 1359
-      NUMBER_OF_BYTES-eng: 4504269
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    Stream #0:8(spa): Subtitle: dvd_subtitle, 1920x1080
-    Metadata:
-      BPS-eng         : 7522
-      DURATION-eng    : 02:10:44.409000000
-      NUMBER_OF_FRAMES-eng: 1392
-      NUMBER_OF_BYTES-eng: 7376389
-      _STATISTICS_WRITING_APP-eng: mkvmerge v32.0.0 ('Astral Progressions') 64-bit
-      _STATISTICS_WRITING_DATE_UTC-eng: 2019-08-23 10:49:27
-      _STATISTICS_TAGS-eng: BPS DURATION NUMBER_OF_FRAMES NUMBER_OF_BYTES
-    ''')
+        fn = 'Godzilla - King of the Monsters (2019) (2160p BluRay x265 10bit HDR Tigole).mkv'
+        subtitle_streams = [
+            {'index': i, 'codec_name': 'dvd_subtitle', 'codec_type': 'subtitle', 'width': 1920, 'height': 1080,
+             'tags': {'language': language, 'BPS-eng': '8966'}}
+            for i, language in enumerate(['eng', 'ara', 'chi', 'fre', 'kor', 'spa'], start=3)
+        ]
+        fmd = gnomecast.FileMetadata(fn, _ffprobe_output=json.dumps({
+            'streams': [
+                {'index': 0, 'codec_name': 'hevc', 'profile': 'Main 10', 'codec_type': 'video', 'width': 3840,
+                 'height': 1600, 'pix_fmt': 'yuv420p10le', 'level': 153, 'color_transfer': 'smpte2084',
+                 'r_frame_rate': '24000/1001', 'avg_frame_rate': '24000/1001', 'disposition': {'default': 1},
+                 'tags': {'BPS-eng': '17115721', 'DURATION-eng': '02:11:43.104000000'}},
+                {'index': 1, 'codec_name': 'aac', 'profile': 'LC', 'codec_type': 'audio', 'sample_fmt': 'fltp',
+                 'sample_rate': '48000', 'channels': 8, 'channel_layout': '7.1', 'disposition': {'default': 1},
+                 'tags': {'language': 'eng', 'BPS-eng': '901426'}},
+                {'index': 2, 'codec_name': 'aac', 'profile': 'HE-AAC', 'codec_type': 'audio', 'sample_fmt': 'fltp',
+                 'sample_rate': '48000', 'channels': 2, 'channel_layout': 'stereo', 'disposition': {'default': 0},
+                 'tags': {'language': 'eng', 'title': 'Commentary', 'BPS-eng': '65862'}},
+            ] + subtitle_streams,
+            'format': {'filename': fn, 'nb_streams': 9, 'format_name': 'matroska,webm', 'start_time': '0.000000',
+                       'duration': '7903.190000', 'bit_rate': '18112000',
+                       'tags': {'title': 'Godzilla: King of the Monsters',
+                                'encoder': 'libebml v1.3.7 + libmatroska v1.5.0'}},
+        }))
         fmd.wait()
         self.assertEqual(fmd.container, 'mkv')
         self.assertEqual(len(fmd.video_streams), 1)
@@ -218,38 +138,881 @@ Input #0, matroska,webm, from 'Godzilla - King of the Monsters (2019) (2160p Blu
 
         cast = FakeCast(cast_type='video', manufacturer='Unknown manufacturer', model_name='Chromecast Ultra')
 
-        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, fake=True)
-        self.assertEqual(transcoder.transcode_cmd[:-1], ['ffmpeg', '-i',
-                                                         'Godzilla - King of the Monsters (2019) (2160p BluRay x265 10bit HDR Tigole).mkv',
-                                                         '-map', '0:0', '-map', '0:1', '-c:v', 'copy', '-c:a', 'ac3',
-                                                         '-b:a', '256k'])
+        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, None, fake=True)
+        self.assertEqual(transcoder.transcode_cmd[:-1],
+                         ['ffmpeg', '-i', fn, '-map', '0:0', '-map', '0:1', '-c:v', 'copy', '-c:a', 'ac3', '-b:a', '256k',
+                          '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'])
 
-        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[1], None, fake=True)
-        self.assertEqual(transcoder.transcode_cmd[:-1], ['ffmpeg', '-i',
-                                                         'Godzilla - King of the Monsters (2019) (2160p BluRay x265 10bit HDR Tigole).mkv',
-                                                         '-map', '0:0', '-map', '0:2', '-c:v', 'copy', '-c:a', 'mp3',
-                                                         '-b:a', '256k'])
+        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[1], None, None, fake=True)
+        self.assertEqual(transcoder.transcode_cmd[:-1],
+                         ['ffmpeg', '-i', fn, '-map', '0:0', '-map', '0:2', '-c:v', 'copy', '-c:a', 'copy',
+                          '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'])
 
         cast = FakeCast(cast_type='video', manufacturer='Unknown manufacturer', model_name='Chromecast')
-        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, fake=True)
-        self.assertEqual(transcoder.transcode_cmd[:-1], ['ffmpeg', '-i',
-                                                         'Godzilla - King of the Monsters (2019) (2160p BluRay x265 10bit HDR Tigole).mkv',
-                                                         '-map', '0:0', '-map', '0:1', '-c:v', 'h264', '-c:a', 'mp3',
-                                                         '-b:a', '256k'])
+        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, None, fake=True)
+        self.assertEqual(transcoder.transcode_cmd[:-1],
+                         ['ffmpeg', '-i', fn, '-map', '0:0', '-map', '0:1', '-c:v', 'h264',
+                          '-vf', 'scale=1920:800,' + ','.join(gnomecast.HDR_TONEMAP_FILTERS),
+                          '-color_primaries', 'bt709', '-color_trc', 'bt709', '-colorspace', 'bt709',
+                          '-c:a', 'mp3', '-b:a', '256k', '-preset', 'veryfast', '-crf', '23',
+                          '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'])
 
         cast = FakeCast(cast_type='video', manufacturer='VIZIO', model_name='P75-F1')
-        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, fake=True)
-        self.assertEqual(transcoder.transcode_cmd[:-1], ['ffmpeg', '-i',
-                                                         'Godzilla - King of the Monsters (2019) (2160p BluRay x265 10bit HDR Tigole).mkv',
-                                                         '-map', '0:0', '-map', '0:1', '-c:v', 'copy', '-c:a', 'ac3',
-                                                         '-b:a', '256k'])
+        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, None, fake=True)
+        self.assertEqual(transcoder.transcode_cmd[:-1],
+                         ['ffmpeg', '-i', fn, '-map', '0:0', '-map', '0:1', '-c:v', 'copy', '-c:a', 'ac3', '-b:a', '256k',
+                          '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'])
 
+        # devices that aren't in the database only get what every Chromecast plays, so no 4K, HEVC or HDR
         cast = FakeCast(cast_type='video', manufacturer='UNK', model_name='UNK')
-        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, fake=True)
-        self.assertEqual(transcoder.transcode_cmd[:-1], ['ffmpeg', '-i',
-                                                         'Godzilla - King of the Monsters (2019) (2160p BluRay x265 10bit HDR Tigole).mkv',
-                                                         '-map', '0:0', '-map', '0:1', '-c:v', 'copy', '-c:a', 'ac3',
-                                                         '-b:a', '256k'])
+        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], fmd.audio_streams[0], None, None, fake=True)
+        self.assertEqual(transcoder.transcode_cmd[:-1],
+                         ['ffmpeg', '-i', fn, '-map', '0:0', '-map', '0:1', '-c:v', 'h264',
+                          '-vf', 'scale=1920:800,' + ','.join(gnomecast.HDR_TONEMAP_FILTERS),
+                          '-color_primaries', 'bt709', '-color_trc', 'bt709', '-colorspace', 'bt709',
+                          '-c:a', 'ac3', '-b:a', '256k', '-preset', 'veryfast', '-crf', '23',
+                          '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'])
+
+    def test_transcode_plan(self):
+        def plan(container, profile='High', pix_fmt='yuv420p', audio_codec='aac', channels=2):
+            fmd = make_fmd(video={'codec_name': 'h264', 'profile': profile, 'pix_fmt': pix_fmt},
+                           audio={'codec_name': audio_codec, 'profile': 'LC', 'channels': channels},
+                           fn='movie.' + container)
+            return make_transcoder(fmd, done_callback=lambda **kw: None)
+
+        transcoder = plan('mkv')
+        self.assertEqual(transcoder.plan.action, 'remux')
+        self.assertEqual((transcoder.plan.video.action, transcoder.plan.audio.action), ('copy', 'copy'))
+        self.assertEqual(transcoder.codec_args(), ['-c:v', 'copy', '-c:a', 'copy'])
+
+        transcoder = plan('mp4')
+        self.assertEqual(transcoder.plan.action, 'direct')
+        self.assertFalse(transcoder.transcode)
+
+        transcoder = plan('mkv', profile='High 10', pix_fmt='yuv420p10le')
+        self.assertEqual(transcoder.plan.action, 'transcode')
+        self.assertEqual(transcoder.plan.video.codec, 'h264')
+        self.assertEqual(transcoder.plan.audio.action, 'copy')
+
+        transcoder = plan('mp4', channels=6)
+        self.assertEqual(transcoder.plan.action, 'transcode')
+        self.assertEqual(transcoder.plan.audio.codec, 'mp3')  # no ac3 passthrough on this device
+
+    def high_frame_rate_fmd(self):
+        return make_fmd(video={'codec_name': 'h264', 'profile': 'High', 'pix_fmt': 'yuv420p', 'level': 52,
+                               'width': 1920, 'height': 1080, 'avg_frame_rate': '120/1'},
+                        audio={'codec_name': 'eac3', 'channels': 6})
+
+    def test_device_lookup(self):
+        fmd = self.high_frame_rate_fmd()
+        video, audio = fmd.video_streams[0], fmd.audio_streams[0]
+        chromecast = gnomecast.DEVICES.lookup('Unknown manufacturer', 'Chromecast', 'cast')
+        self.assertEqual(chromecast.name, 'Chromecast')
+        self.assertEqual(chromecast.video_problem(video), 'h264 level 52 not supported')
+        self.assertEqual(chromecast.audio_problem(audio), 'eac3 not supported')
+        self.assertEqual(chromecast.audio_transcode_codec(audio), 'mp3')
+        self.assertEqual(gnomecast.DEVICES.lookup('Google Inc.', 'Google Home Mini', 'audio').name, 'Google Home')
+        self.assertEqual(gnomecast.DEVICES.lookup('Google Inc.', 'Nest Audio', 'audio').name, 'audio')
+        self.assertEqual(gnomecast.DEVICES.lookup('Sony', 'BRAVIA', 'cast').name, 'default')
+
+    def test_device_frame_rate_limit(self):
+        transcoder = make_transcoder(self.high_frame_rate_fmd(), model_name='Chromecast Ultra')
+        self.assertEqual(transcoder.plan.video.reason, '120 fps not supported')
+        self.assertEqual(transcoder.plan.audio.action, 'copy')
+        self.assertEqual(transcoder.codec_args(), ['-c:v', 'h264', '-r', '60', '-c:a', 'copy'])
+
+    def test_user_device_database(self):
+        fmd = self.high_frame_rate_fmd()
+        with tempfile.TemporaryDirectory() as config_home:
+            fn = os.path.join(config_home, 'devices.json')
+            with open(fn, 'w') as f:
+                json.dump({'Living Room TV': {'extends': 'Chromecast', 'match': [{'manufacturer': 'ACME',
+                                                                                  'model_name': 'TV 9000'}],
+                                              'max_frame_rate': 120, 'video': {'h264': {'max_level': 52}},
+                                              'audio': {'eac3': {'max_channels': 8}}}}, f)
+            devices = gnomecast.DeviceDatabase(gnomecast.device_database_fns()[:1] + [fn])
+            tv = devices.lookup('ACME', 'TV 9000', 'cast')
+            self.assertEqual(tv.name, 'Living Room TV')
+            self.assertIsNone(tv.video_problem(fmd.video_streams[0]))
+            self.assertIsNone(tv.audio_problem(fmd.audio_streams[0]))
+            self.assertEqual((tv.max_width, sorted(tv.audio)), (1920, ['aac', 'eac3', 'mp3']))
+
+    def test_hdr_tonemap(self):
+        fmd = make_fmd(video={'codec_name': 'hevc', 'profile': 'Main 10', 'pix_fmt': 'yuv420p10le', 'level': 120,
+                              'width': 1920, 'height': 1080, 'color_transfer': 'arib-std-b67'})
+        transcoder = make_transcoder(fmd)
+        self.assertIn('tonemap=hable:desat=0', transcoder.transcode_cmd[transcoder.transcode_cmd.index('-vf') + 1])
+        self.assertEqual(transcoder.codec_args(), ['-c:v', 'h264', '-vf', ','.join(gnomecast.HDR_TONEMAP_FILTERS),
+                                                   '-color_primaries', 'bt709', '-color_trc', 'bt709',
+                                                   '-colorspace', 'bt709'])
+
+        transcoder = make_transcoder(fmd, model_name='Chromecast Ultra')
+        self.assertEqual(transcoder.codec_args(), ['-c:v', 'copy'])  # plays HLG as is
+
+    def test_metadata_cache(self):
+        with tempfile.TemporaryDirectory() as cache_home, mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}):
+            media_fn = os.path.join(cache_home, 'episode.mkv')
+            with open(media_fn, 'wb') as f:
+                f.write(b'not really a video')
+            fmd = make_fmd(video={'codec_name': 'h264', 'profile': 'High'},
+                           audio={'codec_name': 'aac', 'profile': 'LC', 'channels': 6, 'channel_layout': '5.1',
+                                  'tags': {'language': 'eng'}},
+                           fn=media_fn, duration='2505.280000', bit_rate='1303000')
+            fmd._cache_key = gnomecast.file_identity(media_fn)
+            fmd.save_cached()
+            thumbnail_fn = os.path.join(cache_home, 'thumbnail.jpg')
+            with open(thumbnail_fn, 'wb') as f:
+                f.write(b'\xff\xd8\xff')
+            thumbnail_fn = gnomecast.THUMBNAIL_CACHE.add(fmd._cache_key, '.jpg', thumbnail_fn)
+
+            with mock.patch('subprocess.check_output', side_effect=AssertionError('probed a cached file')):
+                cached = gnomecast.FileMetadata(media_fn)
+            self.assertTrue(cached.ready)
+            self.assertEqual(cached.duration, fmd.duration)
+            self.assertEqual(cached.thumbnail_fn, thumbnail_fn)
+            self.assertEqual(cached.container, 'mkv')
+            self.assertEqual([s.codec for s in cached.video_streams], ['h264'])
+            self.assertEqual([(s.index, s.codec, s.channels) for s in cached.audio_streams], [('0:1', 'aac', 6)])
+
+            os.utime(media_fn, ns=(0, 0))
+            self.assertNotEqual(gnomecast.file_identity(media_fn), fmd._cache_key)
+
+    def test_make_thumbnail(self):
+        fmd = make_fmd(video='h264')
+        fmd._cache_key = 'movie'
+
+        def ffmpeg(cmd, **kwargs):
+            with open(cmd[-1], 'wb') as f:
+                f.write(b'jpeg')
+        with tempfile.TemporaryDirectory() as cache_home, \
+                mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}), \
+                mock.patch('subprocess.check_output', side_effect=ffmpeg):
+            self.assertTrue(fmd.make_thumbnail())
+            root = os.path.join(cache_home, 'gnomecast', 'thumbnails')
+            self.assertEqual(fmd.thumbnail_fn, os.path.join(root, 'movie.jpg'))
+            self.assertEqual(os.listdir(root), ['movie.jpg'])
+
+    def test_subtitle_cache(self):
+        with tempfile.TemporaryDirectory() as cache_home, mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}):
+            media_fn = os.path.join(cache_home, 'episode.mkv')
+            with open(media_fn, 'wb') as f:
+                f.write(b'not really a video')
+            fmd = gnomecast.FileMetadata(media_fn, _ffprobe_output=json.dumps({
+                'streams': [
+                    {'index': 0, 'codec_name': 'h264', 'codec_type': 'video'},
+                    {'index': 1, 'codec_name': 'subrip', 'codec_type': 'subtitle', 'tags': {'language': 'eng'}},
+                    {'index': 2, 'codec_name': 'subrip', 'codec_type': 'subtitle', 'tags': {'language': 'fre'}},
+                ],
+                'format': {'duration': '60.0'},
+            }))
+            fmd.wait()
+            self.assertEqual([s._subtitles for s in fmd.subtitles], [None, None])
+
+            fmd._cache_key = gnomecast.file_identity(media_fn)
+            for stream in fmd.subtitles:
+                gnomecast.SUBTITLE_CACHE.put_text(fmd.subtitle_cache_key(stream), '.vtt', 'WEBVTT\n\n' + stream.title)
+            with mock.patch('subprocess.check_output', side_effect=AssertionError('extracted cached subtitles')):
+                fmd.load_subtitles()
+            self.assertEqual([s._subtitles for s in fmd.subtitles], ['WEBVTT\n\neng', 'WEBVTT\n\nfre'])
+
+    def test_subtitle_conversion_error(self):
+        fmd = gnomecast.FileMetadata('movie.mkv', _ffprobe_output=json.dumps({
+            'streams': [{'index': 1, 'codec_name': 'subrip', 'codec_type': 'subtitle', 'tags': {'language': 'eng'}},
+                        {'index': 2, 'codec_name': 'subrip', 'codec_type': 'subtitle', 'tags': {'language': 'fre'}}],
+            'format': {'duration': '60.0'},
+        }))
+        fmd.wait()
+
+        def convert(fn):
+            future = concurrent.futures.Future()
+            if len(convert.calls) == 0:
+                future.set_result('WEBVTT\n\neng')
+            else:
+                future.set_exception(ValueError('not really subtitles'))
+            convert.calls.append(fn)
+            return future
+        convert.calls = []
+        with mock.patch('subprocess.check_output'), mock.patch.object(gnomecast, 'convert_subtitles_async', convert), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            fmd.load_subtitles()
+        self.assertEqual([s._subtitles for s in fmd.subtitles], ['WEBVTT\n\neng', None])
+        self.assertIn('ERROR converting subtitles 0:2', output.getvalue())
+        self.assertEqual(fmd._subtitles_loading, {})
+        self.assertFalse(any(os.path.exists(fn) for fn in convert.calls))
+
+    def save_transcode(self, media_fn, done_callback=None):
+        """Transcode media_fn for a Chromecast into the transcode cache, and return its metadata."""
+        with open(media_fn, 'wb') as f:
+            f.write(b'not really a video')
+        fmd = make_fmd(audio='opus', fn=media_fn)
+        transcoder = make_transcoder(fmd, done_callback=done_callback)
+        self.assertTrue(transcoder.cache_key)
+        self.assertFalse(transcoder.cached)
+
+        def faststart(cmd, **kwargs):
+            self.assertIn('+faststart', cmd)
+            with open(cmd[-1], 'wb') as f:
+                f.write(b'moov mdat')
+        with open(transcoder.trans_fn, 'wb') as f:
+            f.write(b'moov moof mdat')
+        with mock.patch('subprocess.run', side_effect=faststart):
+            transcoder.save_to_cache()
+        transcoder.destroy()
+        return fmd
+
+    def test_transcode_cache(self):
+        with tempfile.TemporaryDirectory() as cache_home, mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}):
+            done = []
+            done_callback = lambda did_transcode=None: done.append(did_transcode)
+            fmd = self.save_transcode(os.path.join(cache_home, 'episode.mkv'), done_callback)
+            transcoder = make_transcoder(fmd, done_callback=done_callback)
+            self.assertTrue(transcoder.cached)
+            self.assertTrue(transcoder.done)
+            self.assertEqual(transcoder.progress.total_size, len(b'moov mdat'))
+            self.assertEqual(done, [True, True])  # the fake transcode finishes straight away too
+            transcoder.destroy()
+            self.assertTrue(os.path.isfile(transcoder.fn))
+
+    def test_transcode_cache_key(self):
+        with tempfile.TemporaryDirectory() as cache_home, mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}):
+            fmd = self.save_transcode(os.path.join(cache_home, 'episode.mkv'))
+            # the thread count doesn't change the output, the encoder profile does
+            transcoder = make_transcoder(fmd, threads=1)
+            self.assertTrue(transcoder.cached)
+            transcoder.destroy()
+            transcoder = make_transcoder(fmd, encoder_profile='best')
+            self.assertFalse(transcoder.cached)
+            transcoder.destroy()
+
+            # another device needing a different conversion misses
+            transcoder = make_transcoder(fmd, model_name='Chromecast Ultra')
+            self.assertFalse(transcoder.cached)
+
+    def test_disk_cache_evict(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = gnomecast.DiskCache('test', 10, root=root)
+            building = cache.tmp_path('.mp4')  # a transcode still being written
+            with open(building, 'wb') as f:
+                f.write(b'x' * 100)
+            stale = cache.tmp_path('.mp4')  # left by a gnomecast that was killed
+            os.utime(stale, (0, 0))
+            cache.put_text('a', '.txt', 'aaaaaa')
+            os.utime(cache.path('a', '.txt'), (1, 1))
+            cache.put_text('b', '.txt', 'bbbbbb')
+            self.assertEqual(sorted(os.listdir(root)), sorted(['b.txt', os.path.basename(building)]))
+
+    def test_convert_subtitles(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srt_fn = os.path.join(tmpdir, 'movie.srt')
+            with open(srt_fn, 'wb') as f:
+                f.write('\ufeff1\r\n00:00:01,500 --> 00:00:04,000\r\n{\\an8}<font color="red">Hello,</font> <i>world</i>\r\n\r\n'
+                        '2\r\n01:02:03,004 --> 01:02:05,000\r\nCafé\r\n'.encode())
+            self.assertEqual(gnomecast.convert_subtitles(srt_fn),
+                             'WEBVTT\n\n1\n00:00:01.500 --> 00:00:04.000\nHello, <i>world</i>\n\n'
+                             '2\n01:02:03.004 --> 01:02:05.000\nCafé\n')
+
+            with open(srt_fn, 'wb') as f:
+                f.write('1\n00:00:01,500 --> 00:00:04,000\nCafé\n'.encode('latin-1'))
+            self.assertEqual(gnomecast.convert_subtitles_async(srt_fn).result(),
+                             'WEBVTT\n\n1\n00:00:01.500 --> 00:00:04.000\nCafé\n')
+
+            vtt_fn = os.path.join(tmpdir, 'movie.vtt')
+            with open(vtt_fn, 'w') as f:
+                f.write('WEBVTT\n\n00:01.000 --> 00:02.000\nHi\n')
+            self.assertEqual(gnomecast.convert_subtitles(vtt_fn), 'WEBVTT\n\n00:01.000 --> 00:02.000\nHi\n')
+
+    FFMPEG = '''import sys
+for i in range(300):
+    sys.stderr.write('log line ' + str(i) + '\\n')
+sys.stdout.write('frame=120\\nfps=48.00\\ntotal_size=1048576\\nout_time_us=5000000\\nspeed=2.5x\\nprogress=continue\\n')
+sys.stdout.write('frame=240\\nfps=N/A\\ntotal_size=N/A\\nout_time_us=-9000\\nspeed=N/A\\nprogress=end\\n')
+sys.exit(%i)'''
+
+    def test_transcode_progress(self):
+        done = []
+        transcoder = make_transcoder(make_fmd())
+        transcoder.done_callback = lambda did_transcode: done.append(did_transcode)  # after the fake transcode
+        transcoder.done = False
+        transcoder.p = subprocess.Popen([sys.executable, '-c', self.FFMPEG % 0], stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        transcoder.monitor()
+        self.assertEqual(done, [True])
+        self.assertEqual((transcoder.progress.frame, transcoder.progress.done), (240, True))
+
+    def test_transcode_progress_from_ffmpeg(self):
+        first = gnomecast.TranscodeProgress.from_ffmpeg(
+            {'frame': '120', 'fps': '48.00', 'total_size': '1048576', 'out_time_us': '5000000', 'speed': '2.5x'})
+        self.assertEqual((first.frame, first.fps, first.total_size, first.out_time, first.speed),
+                         (120, 48.0, 1048576, 5.0, 2.5))
+
+    def test_transcode_failure(self):
+        errors = []
+        transcoder = make_transcoder(make_fmd(), error_callback=errors.append)
+        transcoder.done = False
+        transcoder.p = subprocess.Popen([sys.executable, '-c', self.FFMPEG % 1], stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+        transcoder.monitor()
+        self.assertFalse(transcoder.done)
+        self.assertEqual(len(transcoder.log), 200)
+        self.assertTrue(errors[0].endswith('log line 299'))
+
+    def test_encoder_profile_follows_speed(self):
+        transcoder = make_transcoder(make_fmd())
+        self.assertEqual(transcoder.running_profile, 'balanced')
+
+        # the same slow ffmpeg reporting again doesn't keep stepping down
+        transcoder.observe_speed(1.1, 'balanced')
+        transcoder.observe_speed(1.0, 'balanced')
+        self.assertEqual(transcoder.encoder_profile, 'fast')
+        self.assertEqual(transcoder.encoder_args()[:2], ['-preset', 'superfast'])
+        transcoder.observe_speed(1.2, 'fast')
+        transcoder.observe_speed(0.9, 'fastest')
+        self.assertEqual(transcoder.encoder_profile, 'fastest')
+
+        transcoder.observe_speed(1.8, 'fastest')  # keeping up, but not by enough to risk it
+        self.assertEqual(transcoder.encoder_profile, 'fastest')
+        transcoder.observe_speed(4, 'fastest')
+        self.assertEqual(transcoder.encoder_profile, 'fast')
+        transcoder.observe_speed(6, 'best')
+        self.assertEqual(transcoder.encoder_profile, 'best')
+
+    def test_wait_for_byte(self):
+        transcoder = make_transcoder(make_fmd(fn='movie.mp4', bit_rate='8000000'))
+        transcoder.done = False
+        self.assertEqual(transcoder.lead_bytes(2), 2000000)  # from the source bitrate until we've measured
+
+        waiter = threading.Thread(target=transcoder.wait_for_byte, args=(0,), kwargs={'lead_seconds': 2})
+        waiter.start()
+        for total_size, out_time in [(1000000, 0.5), (3000000, 1.5), (5000000, 2.5)]:
+            self.assertTrue(waiter.is_alive())
+            with transcoder.progress_cond:
+                transcoder.progress = gnomecast.TranscodeProgress(total_size=total_size, out_time=out_time)
+                transcoder.progress_cond.notify_all()
+            waiter.join(0.2)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(transcoder.lead_bytes(2), 4000000)
+
+    def test_follow_growing_transcode(self):
+        transcoder = make_transcoder(make_fmd())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            transcoder.trans_fn = os.path.join(tmpdir, 'growing.mp4')
+            transcoder.done = False
+            with open(transcoder.trans_fn, 'wb') as f:
+                f.write(b'moov')
+
+            def write_rest():
+                with open(transcoder.trans_fn, 'ab') as f:
+                    f.write(b'moof1')
+                    f.flush()
+                    time.sleep(0.1)
+                    f.write(b'moof2')
+                with transcoder.progress_cond:
+                    transcoder.done = True
+                    transcoder.progress_cond.notify_all()
+
+            writer = threading.Thread(target=write_rest)
+            writer.start()
+            self.assertEqual(b''.join(transcoder.follow(2, chunk_size=3)), b'ovmoof1moof2')
+            writer.join()
+
+    def test_hls_segments(self):
+        transcoder = make_transcoder(make_fmd(video='h264', audio='opus', duration='16.0'),
+                                     cls=gnomecast.HLSTranscoder)
+        try:
+            self.assertEqual(transcoder.segments, [(0.0, 6.0), (6.0, 6.0), (12.0, 4.0)])
+
+            transcoder.find_segments(keyframes=[0, 2.5, 5, 7.5, 10, 12.5, 15])
+            self.assertEqual(transcoder.segments, [(0.0, 7.5), (7.5, 7.5), (15.0, 1.0)])
+            self.assertEqual(transcoder.playlist(), '\n'.join([
+                '#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-PLAYLIST-TYPE:VOD', '#EXT-X-MEDIA-SEQUENCE:0',
+                '#EXT-X-TARGETDURATION:8',
+                '#EXTINF:7.500,', '0.ts', '#EXTINF:7.500,', '1.ts', '#EXTINF:1.000,', '2.ts',
+                '#EXT-X-ENDLIST', '']))
+            self.assertEqual(transcoder.segment_cmd(1, 'out.ts'),
+                             ['ffmpeg', '-y', '-v', 'error', '-ss', '7.500', '-i', 'movie.mkv', '-t', '7.500',
+                              '-map', '0:0', '-map', '0:1', '-c:v', 'copy', '-c:a', 'mp3', '-b:a', '256k',
+                              '-output_ts_offset', '7.500', '-f', 'mpegts', 'out.ts'])
+            self.assertIsNone(transcoder.segment(3))
+        finally:
+            transcoder.destroy()
+        self.assertFalse(os.path.exists(transcoder.trans_fn))
+
+    def test_hls_segments_error(self):
+        error_callback = mock.Mock()
+        transcoder = make_transcoder(make_fmd(video='h264', audio='opus', duration='16.0'),
+                                     cls=gnomecast.HLSTranscoder, error_callback=error_callback)
+        try:
+            transcoder.segments = None
+            with mock.patch('subprocess.check_output',
+                            side_effect=subprocess.CalledProcessError(1, 'ffprobe', stderr=b'bad packet')), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                transcoder.find_segments()
+            self.assertEqual(transcoder.wait_for_segments(), [])
+            self.assertIn('bad packet', transcoder.error)
+            error_callback.assert_called_once_with(transcoder.error)
+        finally:
+            transcoder.destroy()
+
+    def test_chunked_transcode(self):
+        transcoder = make_transcoder(make_fmd(audio='opus', duration='80.0'), cls=gnomecast.ChunkedTranscoder,
+                                     threads=2)
+        try:
+            # split on the source's keyframes even though the video is re-encoded
+            transcoder.find_segments(keyframes=[0, 10, 20, 35, 50, 70])
+            self.assertEqual(transcoder.segments, [(0.0, 35.0), (35.0, 35.0), (70.0, 10.0)])
+            self.assertEqual(transcoder.segment_cmd(1, 'out.ts'),
+                             ['ffmpeg', '-y', '-v', 'error', '-ss', '35.000', '-i', 'movie.mkv', '-t', '35.000',
+                              '-map', '0:0', '-map', '0:1', '-c:v', 'h264', '-c:a', 'mp3', '-b:a', '256k',
+                              '-preset', 'veryfast', '-crf', '23', '-threads', '2', '-output_ts_offset', '35.000', '-f', 'mpegts', 'out.ts'])
+
+            def segment(n, requested=True):
+                time.sleep([0.3, 0.1, 0][n])  # later chunks finish first
+                fn = transcoder.segment_fn(n)
+                with open(fn, 'wb') as f:
+                    f.write(b'chunk%i ' % n)
+                return fn
+            transcoder.segment = segment
+            out_fn = os.path.join(transcoder.chunk_dir, 'stitched')
+            transcoder.p = subprocess.Popen(
+                [sys.executable, '-c', 'import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], "wb"))',
+                 out_fn], stdin=subprocess.PIPE)
+            transcoder.stitch()
+            transcoder.p.wait(5)
+            with open(out_fn, 'rb') as f:
+                self.assertEqual(f.read(), b'chunk0 chunk1 chunk2 ')
+        finally:
+            transcoder.destroy()
+        self.assertFalse(os.path.exists(transcoder.chunk_dir))
+
+    def test_seek_regions(self):
+        transcoder = make_transcoder(make_fmd(duration='7200.0'))
+        transcoder.done = False
+        transcoder.progress = gnomecast.TranscodeProgress(out_time=100)
+        self.assertIs(transcoder.region_for(150), transcoder)
+
+        with mock.patch('subprocess.Popen'), mock.patch.object(gnomecast.Transcoder, 'monitor'):
+            region = transcoder.region_for(5400)
+            self.assertEqual(region.start_at, 5400)
+            self.assertEqual(region.transcode_cmd[:4], ['ffmpeg', '-ss', '5400.000', '-i'])
+            self.assertIs(transcoder.region(5400.0), region)
+            self.assertIs(transcoder.region_for(5430), region)
+            self.assertIs(transcoder.region_for(150), transcoder)
+            transcoder.region_for(6000)
+            transcoder.region_for(7000)
+        self.assertIsNone(transcoder.region(5400.0))
+        self.assertEqual([r.start_at for r in transcoder.regions], [6000, 7000])
+
+    def bottle_get(self, caster):
+        """Build caster's bottle app without serving it, and return a get() of a path's status."""
+        import wsgiref.util
+        with mock.patch.object(gnomecast, 'MediaServer'):
+            caster.start_server()  # builds the bottle app, but doesn't serve it
+
+        def get(path, query=''):
+            environ = {'PATH_INFO': path, 'QUERY_STRING': query}
+            wsgiref.util.setup_testing_defaults(environ)
+            statuses = []
+            b''.join(caster.app(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+            return statuses[0]
+        return get
+
+    def test_bottle_routes_without_transcoder(self):
+        get = self.bottle_get(gnomecast.Gnomecast())
+        with mock.patch.object(gnomecast, 'METRICS', gnomecast.Metrics()):
+            self.assertEqual(get('/media/1.mp4'), '404 Not Found')
+            self.assertEqual(get('/media/1.mp4', 'start=x'), '400 Bad Request')
+            self.assertEqual(get('/hls/1/playlist.m3u8'), '404 Not Found')
+            self.assertEqual(get('/hls/1/0.ts'), '404 Not Found')
+
+    def test_hls_routes_without_hls(self):
+        # playing without --hls, so there's no playlist or segments to serve
+        caster = gnomecast.Gnomecast()
+        get = self.bottle_get(caster)
+        caster.transcoder = make_transcoder(make_fmd())
+        with mock.patch.object(gnomecast, 'METRICS', gnomecast.Metrics()):
+            self.assertEqual(get('/hls/1/playlist.m3u8'), '404 Not Found')
+            self.assertEqual(get('/hls/1/0.ts'), '404 Not Found')
+
+    def test_transcode_threads(self):
+        transcoder = make_transcoder(make_fmd(), threads=3, nice=gnomecast.LOOKAHEAD_NICE)
+        self.assertEqual(transcoder.codec_args(), ['-c:v', 'h264'])
+        self.assertEqual(transcoder.encoder_args(), ['-preset', 'veryfast', '-crf', '23', '-threads', '3'])
+
+    def test_transcode_renice(self):
+        transcoder = make_transcoder(make_fmd(), nice=gnomecast.LOOKAHEAD_NICE)
+        transcoder.p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+        try:
+            self.assertTrue(transcoder.renice(gnomecast.LOOKAHEAD_NICE + 1))
+            self.assertEqual(os.getpriority(os.PRIO_PROCESS, transcoder.p.pid), gnomecast.LOOKAHEAD_NICE + 1)
+            with contextlib.redirect_stdout(io.StringIO()):
+                if transcoder.renice(0):  # needs CAP_SYS_NICE
+                    self.assertEqual(os.getpriority(os.PRIO_PROCESS, transcoder.p.pid), 0)
+            self.assertEqual(transcoder.nice, os.getpriority(os.PRIO_PROCESS, transcoder.p.pid))
+        finally:
+            transcoder.destroy()
+
+    def test_transcode_pause(self):
+        transcoder = make_transcoder(make_fmd())
+        transcoder.p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+        transcoder.pause()
+        self.assertTrue(transcoder.paused)
+        transcoder.resume()
+        self.assertFalse(transcoder.paused)
+        transcoder.pause()
+        transcoder.destroy()  # has to wake it up to let it terminate
+        self.assertEqual(transcoder.p.wait(5), -15)
+
+    def test_share_cpu(self):
+        ahead = [mock.Mock(), None, mock.Mock()]
+        playing = mock.Mock(nice=gnomecast.LOOKAHEAD_NICE, done=False)  # couldn't be reniced back up
+        gnomecast.Gnomecast.share_cpu(playing, ahead)
+        self.assertTrue(all(t.pause.called and not t.resume.called for t in ahead if t))
+
+        for playing in (mock.Mock(nice=0, done=False), mock.Mock(nice=gnomecast.LOOKAHEAD_NICE, done=True), None):
+            ahead = [mock.Mock(), mock.Mock()]
+            gnomecast.Gnomecast.share_cpu(playing, ahead)
+            self.assertTrue(all(t.resume.called and not t.pause.called for t in ahead))
+
+    def test_arg_parse_flags(self):
+        calls = []
+        gnomecast.arg_parse(['--parallel-chunks', 'a.mkv', 'b.mkv', '--chunk-workers', '3', '-d', 'TV'],
+                            {'d': 'device', 'parallel-chunks': 'parallel_chunks', 'chunk-workers': 'chunk_workers'},
+                            lambda *args, **kwargs: calls.append((args, kwargs)), '', flags=('parallel_chunks',))
+        self.assertEqual(calls, [(('a.mkv', 'b.mkv'), {'parallel_chunks': True, 'chunk_workers': '3', 'device': 'TV'})])
+
+    @contextlib.contextmanager
+    def media_server(self):
+        """Serve a finished fake transcode of b'0123456789', yielding it and a get() on one keep-alive connection."""
+        import http.client
+        transcoder = make_transcoder(make_fmd(bit_rate='8'))
+        with open(transcoder.trans_fn, 'wb') as f:
+            f.write(b'0123456789')
+        server = gnomecast.MediaServer('127.0.0.1', 0, lambda start: transcoder)
+        server.start_in_thread()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+
+            def get(headers=None, method='GET', path='/media/1.mp4'):
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+                return response.status, dict(response.getheaders()), response.read()
+            with mock.patch.object(gnomecast, 'METRICS', gnomecast.Metrics()):
+                yield transcoder, get
+        finally:
+            server.stop()
+            transcoder.destroy()
+
+    def test_media_server(self):
+        with self.media_server() as (transcoder, get):
+            self.assertEqual(get()[::2], (200, b'0123456789'))
+            status, headers, body = get({'Range': 'bytes=2-5'})
+            self.assertEqual((status, headers['Content-Range'], body), (206, 'bytes 2-5/10', b'2345'))
+            self.assertEqual(get({'Range': 'bytes=-3'})[2], b'789')
+            self.assertEqual(get({'Range': 'bytes=20-'})[0], 416)
+            status, headers, body = get(method='HEAD')
+            self.assertEqual((status, headers['Content-Length'], body), (200, '10', b''))
+            status, headers, body = get({'Range': 'bytes=0-1,8-'})
+            boundary = headers['Content-Type'].split('boundary=')[1]
+            self.assertEqual(body.decode(), '\r\n'.join([
+                '--' + boundary, 'Content-Type: video/mp4', 'Content-Range: bytes 0-1/10', '', '01',
+                '--' + boundary, 'Content-Type: video/mp4', 'Content-Range: bytes 8-9/10', '', '89',
+                '--' + boundary + '--', '']))
+            self.assertEqual(int(headers['Content-Length']), len(body))
+            self.assertEqual(gnomecast.METRICS.snapshot()['counters']['requests']['1'], 6)
+
+    def test_media_server_bad_start(self):
+        with self.media_server() as (transcoder, get):
+            for start in ('movie.mkv', 'nan', '-5'):
+                self.assertEqual(get(path='/media/1.mp4?start=' + start)[::2], (400, b'400 Bad Request'))
+            self.assertEqual(get()[0], 200)  # and the connection is still good
+
+    def test_media_server_waits_for_transcode(self):
+        # while transcoding, requests wait for progress without holding a thread
+        with self.media_server() as (transcoder, get):
+            transcoder.done = False
+
+            def progress():
+                for data, total_size in [(b'abc', 2 * gnomecast.MIN_LEAD_BYTES), (b'def', None)]:
+                    time.sleep(0.2)
+                    with open(transcoder.trans_fn, 'ab') as f:
+                        f.write(data)
+                    with transcoder.progress_cond:
+                        if total_size:
+                            transcoder.progress = gnomecast.TranscodeProgress(total_size=total_size, out_time=60)
+                        else:
+                            transcoder.done = True
+                        transcoder.progress_cond.notify_all()
+            writer = threading.Thread(target=progress)
+            writer.start()
+            status, headers, body = get({'Range': 'bytes=0-'})
+            writer.join()
+            self.assertEqual((status, body), (200, b'0123456789abcdef'))
+
+    def test_play_on_fake_chromecast(self):
+        fmd = make_fmd()
+        cast = fakecast.FakeChromecast(bitrate=8 * 1024 * 1024)  # so the 512k below is half a second
+        transcoder = gnomecast.Transcoder(cast, fmd, fmd.video_streams[0], None, None, None, fake=True)
+        with open(transcoder.trans_fn, 'wb') as f:
+            f.write(b'x' * 512 * 1024)
+        caster = gnomecast.Gnomecast()
+        caster.ip = '127.0.0.1'
+        caster.cast, caster.fn, caster.transcoder = cast, fmd.fn, transcoder
+        t = threading.Thread(target=caster.start_server)
+        t.daemon = True
+        t.start()
+        states = []
+        listener = mock.Mock(new_media_status=lambda status: states.append(status.player_state))
+        cast.media_controller.register_status_listener(listener)
+        try:
+            for i in range(100):
+                if getattr(caster, 'media_server', None) and caster.media_server.started.is_set(): break
+                time.sleep(0.05)
+            caster.play_media(0)
+            for i in range(100):
+                if cast.media_controller.status.player_state == 'IDLE': break
+                time.sleep(0.05)
+            self.assertEqual(states, ['BUFFERING', 'PLAYING', 'IDLE'])
+            self.assertEqual(cast.media_controller.status.idle_reason, 'FINISHED')
+            self.assertEqual(cast.metrics['requests'][0], ('bytes=0-', 206))
+            self.assertEqual(cast.metrics['bytes_fetched'], 512 * 1024)
+            self.assertEqual((len(cast.metrics['time_to_first_frame']), cast.metrics['stalls']), (1, 0))
+
+            caster.play_media(0)
+            cast.media_controller.seek(0.25)
+            for i in range(100):
+                if cast.media_controller.status.player_state == 'IDLE': break
+                time.sleep(0.05)
+            self.assertEqual(len(cast.metrics['seek_latency']), 1)
+            self.assertEqual(cast.metrics['requests'][-1], ('bytes=262144-', 206))
+        finally:
+            caster.media_server.stop()
+            transcoder.destroy()
+
+    def test_headless(self):
+        FileMetadata = gnomecast.FileMetadata
+        probe = json.dumps({
+            'streams': [{'index': 0, 'codec_name': 'h264', 'codec_type': 'video'},
+                        {'index': 1, 'codec_name': 'aac', 'codec_type': 'audio', 'channels': 2}],
+            'format': {'duration': '1.0'},
+        })
+        cast = fakecast.FakeChromecast('Living Room', bitrate=8 * 1024 * 1024)
+        casters = []
+
+        class Gnomecast(gnomecast.Gnomecast):
+            def __init__(self):
+                super().__init__()
+                self.ip = '127.0.0.1'
+                casters.append(self)
+
+        def main(*args):
+            with mock.patch.object(sys, 'argv', ['gnomecast.py'] + list(args)), self.assertRaises(SystemExit) as cm:
+                gnomecast.main()
+            return cm.exception.code
+
+        with tempfile.TemporaryDirectory() as dir:
+            fns = [os.path.join(dir, 'movie%i.mp4' % i) for i in range(2)]
+            for fn in fns:
+                with open(fn, 'wb') as f:
+                    f.write(b'x' * 512 * 1024)
+            output = io.StringIO()
+            with mock.patch.object(gnomecast, 'Gnomecast', Gnomecast), \
+                    mock.patch.object(gnomecast, 'delete_old_transcodes'), \
+                    mock.patch.object(gnomecast.CastDiscovery, 'find',
+                                      lambda self, name: {'uuid': str(cast.uuid)} if name == 'Living Room' else None), \
+                    mock.patch.object(gnomecast.CastDiscovery, 'connect', lambda self, cast_device: cast), \
+                    mock.patch.object(gnomecast.CastDiscovery, 'stop'), \
+                    mock.patch.object(gnomecast, 'FileMetadata',
+                                      lambda fn, scheduler=None: FileMetadata(fn, _ffprobe_output=probe)), \
+                    mock.patch.object(gnomecast.Gnomecast, 'transcoder_class', autospec=True,
+                                      side_effect=gnomecast.Gnomecast.transcoder_class) as transcoder_class, \
+                    contextlib.redirect_stdout(output):
+                self.assertEqual(main('--headless', fns[0], '-d', 'Kitchen'), 2)
+                status = main('--headless', *fns, '-d', 'Living Room')
+            for caster in casters:
+                try:
+                    caster.media_server.stop()
+                except AttributeError:
+                    pass
+        output = output.getvalue()
+        self.assertEqual(status, 0, output)
+        self.assertIn("the Chromecast 'Kitchen' wasn't found", output)
+        self.assertIn('[1/2] movie0.mp4: FINISHED', output)
+        self.assertIn('[2/2] movie1.mp4: FINISHED', output)
+        self.assertEqual(cast.metrics['bytes_fetched'], 2 * 512 * 1024)
+        # the second file was transcoded ahead, with the same options as the first
+        self.assertEqual([call.args[1].fn for call in transcoder_class.call_args_list], fns)
+        self.assertIsNone(gnomecast.Gtk)
+
+    def test_gui_queues_every_file(self):
+        methods = {name: mock.DEFAULT for name in ('build_gui', 'init_casts', 'check_ffmpeg', 'start_server',
+                                                   'queue_files', 'select_subtitles_file')}
+        with mock.patch.object(sys, 'argv', ['gnomecast.py', 'a.mkv', 'b.mkv', '-s', 'a.srt']), \
+                mock.patch.object(gnomecast, 'delete_old_transcodes'), \
+                mock.patch.object(gnomecast, 'import_gtk'), mock.patch.object(gnomecast, 'Gtk') as gtk, \
+                mock.patch.object(gnomecast.Gnomecast, 'win', create=True), \
+                mock.patch.multiple(gnomecast.Gnomecast, **methods) as mocks:
+            gnomecast.main()
+        mocks['queue_files'].assert_called_once_with(['a.mkv', 'b.mkv'])
+        mocks['select_subtitles_file'].assert_called_once_with('a.srt')
+        gtk.main.assert_called_once_with()
+
+    def test_chunk_workers(self):
+        caster = gnomecast.Gnomecast()
+        with mock.patch.object(gnomecast.ChunkedTranscoder, 'workers', 2), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            caster.configure(chunk_workers='movie.mkv')
+            self.assertEqual(gnomecast.ChunkedTranscoder.workers, 2)
+            self.assertIn('ignoring bad --chunk-workers', output.getvalue())
+            caster.configure(chunk_workers='3')
+            self.assertEqual(gnomecast.ChunkedTranscoder.workers, 3)
+        self.assertTrue(caster.parallel_chunks)
+
+    def test_cast_discovery(self):
+        info = mock.Mock(friendly_name='Living Room', host='192.168.1.20', port=8009, model_name='Chromecast',
+                         manufacturer='Google Inc.', cast_type='cast')
+        id = uuid.uuid4()
+        with tempfile.TemporaryDirectory() as cache_home, mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home}):
+            discovery = gnomecast.CastDiscovery()
+            self.assertEqual(discovery.known(), [])
+            events = []
+            discovery.listen(lambda device: events.append(('add', device['friendly_name'])),
+                             lambda device: events.append(('remove', device['friendly_name'])))
+            discovery.browser = mock.Mock(devices={id: info})
+            discovery.add(id, 'Chromecast-%s._googlecast._tcp.local.' % id)
+            discovery.add(id, 'Chromecast-%s._googlecast._tcp.local.' % id)  # unchanged, so no event
+            self.assertEqual(events, [('add', 'Living Room')])
+
+            # the next start knows about it before discovery has found anything
+            cached = gnomecast.CastDiscovery()
+            self.assertEqual([(d['friendly_name'], d['host'], d['uuid']) for d in cached.known()],
+                             [('Living Room', '192.168.1.20', str(id))])
+            with mock.patch.object(cached, 'start', side_effect=AssertionError('no need to browse')), \
+                    mock.patch.object(gnomecast, 'import_pychromecast'), \
+                    mock.patch.object(gnomecast, 'pychromecast', create=True) as pychromecast:
+                device = cached.find('Living Room')
+                cast = cached.connect(device)
+                self.assertIs(cached.connect(device), cast)
+            pychromecast.get_chromecast_from_host.assert_called_once_with(
+                ('192.168.1.20', 8009, id, 'Chromecast', 'Living Room'))
+
+            discovery.remove(id, 'Chromecast-%s._googlecast._tcp.local.' % id, info)
+            self.assertEqual(events, [('add', 'Living Room'), ('remove', 'Living Room')])
+            self.assertEqual(gnomecast.CastDiscovery().known(), [])
+
+    def test_lazy_imports(self):
+        output = subprocess.check_output([sys.executable, '-c', """if True:
+            import json, sys
+            import gnomecast
+            gnomecast.Gnomecast()
+            print(json.dumps([sorted(m for m in ('gi', 'pychromecast', 'bottle', 'html5lib', 'pycaption', 'dbus')
+                                     if m in sys.modules), gnomecast.STARTUP.report()]))
+        """], cwd=os.path.dirname(os.path.abspath(__file__)))
+        modules, report = json.loads(output.decode().strip().split('\n')[-1])
+        self.assertEqual(modules, [])
+        self.assertEqual(sorted(report), ['import', 'python', 'total'])
+        self.assertAlmostEqual(report['total'], report['python'] + report['import'], places=3)
+        with tempfile.NamedTemporaryFile('w', suffix='.ttml') as f:
+            f.write('<tt xmlns="http://www.w3.org/ns/ttml"><body><div>'
+                    '<p begin="00:00:01.000" end="00:00:02.000">Hello</p></div></body></tt>')
+            f.flush()
+            self.assertIn('Hello', gnomecast.convert_subtitles(f.name))
+        self.assertIsNotNone(gnomecast.pycaption)
+
+    def test_cast_status_listener(self):
+        caster = gnomecast.Gnomecast()
+        caster.files_store = []
+        caster.scrubber_adj = mock.Mock()
+        for method in ('update_media_button_states', 'check_for_next_in_queue', 'inhibit_screensaver',
+                       'restore_screensaver'):
+            setattr(caster, method, mock.Mock())
+        cast, other = fakecast.FakeChromecast(), fakecast.FakeChromecast('Other')
+        glib = mock.Mock(idle_add=lambda f, *args: f(*args))
+        with mock.patch.object(gnomecast, 'GLib', glib):
+            caster.cast = cast
+            caster.watch_cast(cast)
+            caster.watch_cast(cast)
+            caster.watch_cast(other)
+            self.assertEqual(len(cast.media_controller.listeners), 1)
+            caster.play_requested_at = time.time()
+
+            cast.media_controller.set_state('BUFFERING')
+            self.assertFalse(glib.timeout_add.called)  # nothing to move until it's playing
+            cast.media_controller.status.current_time = 5.0
+            cast.media_controller.set_state('PLAYING')
+            glib.timeout_add.assert_called_once_with(gnomecast.SCRUBBER_INTERVAL_MS, caster.move_scrubber)
+            caster.scrubber_timer = 1
+            self.assertIsNone(caster.play_requested_at)
+            caster.inhibit_screensaver.assert_called_once_with()
+            self.assertTrue(caster.move_scrubber())
+            self.assertAlmostEqual(caster.scrubber_adj.set_value.call_args[0][0], 5.0, places=1)
+
+            other.media_controller.set_state('PLAYING')
+            other.media_controller.set_state('IDLE', 'FINISHED')
+            self.assertFalse(caster.check_for_next_in_queue.called)  # not the selected cast
+
+            cast.media_controller.set_state('IDLE', 'FINISHED')
+            caster.check_for_next_in_queue.assert_called_once_with()
+            self.assertFalse(caster.move_scrubber())  # the timer stops itself
+            self.assertIsNone(caster.scrubber_timer)
+            self.assertEqual(glib.timeout_add.call_count, 1)
+            self.assertFalse(glib.timeout_add_seconds.called)  # nothing was transcoding
+
+    def test_metrics(self):
+        metrics = gnomecast.Metrics()
+        events = []
+        metrics.sinks = [events.append]
+        with metrics.span('probe', fn='a.mkv'):
+            pass
+        metrics.record('probe', 3.0, fn='b.mkv')
+        metrics.count('bytes_served', '123', 100)
+        metrics.count('bytes_served', '123', 50)
+        metrics.count('requests', '123')
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['spans']['probe']['count'], 2)
+        self.assertEqual((snapshot['spans']['probe']['last'], snapshot['spans']['probe']['max']), (3.0, 3.0))
+        self.assertEqual(snapshot['counters'], {'bytes_served': {'123': 150}, 'requests': {'123': 1}})
+        self.assertEqual([(e['span'], e['fn']) for e in events], [('probe', 'a.mkv'), ('probe', 'b.mkv')])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            log_fn = os.path.join(tmp, 'metrics.jsonl')
+            metrics.sinks = [gnomecast.file_sink(log_fn)]
+            metrics.record('time_to_playing', 1.5)
+            with open(log_fn) as f:
+                self.assertEqual(json.loads(f.read())['seconds'], 1.5)
+
+    def test_probe_scheduler_priority(self):
+        scheduler = gnomecast.ProbeScheduler(workers=1)
+        started, release, finished = threading.Event(), threading.Event(), threading.Event()
+        order = []
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        scheduler.submit('busy', blocker)
+        started.wait()
+        for key in ['a', 'b', 'c', 'd']:
+            scheduler.submit(key, lambda key=key: order.append(key))
+        scheduler.submit('done', finished.set)
+        scheduler.prioritize(['c', 'b'])
+        release.set()
+        finished.wait(5)
+        self.assertEqual(order, ['c', 'b', 'a', 'd'])
+        self.assertEqual(len(scheduler.threads), 1)
+
+    def test_wait_for_failed_probe(self):
+        with mock.patch.object(threading, 'excepthook') as excepthook, \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            fmd = gnomecast.FileMetadata('movie.mkv', _ffprobe_output='not json')
+            waiter = threading.Thread(target=fmd.wait)
+            waiter.start()
+            waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertFalse(fmd.ready)
+        self.assertIsInstance(fmd.error, ValueError)
+        self.assertFalse(excepthook.called)  # reported once, not with a traceback from the probe thread
+        self.assertEqual(output.getvalue().count('ERROR probing movie.mkv'), 1)
 
 
 if __name__ == '__main__':